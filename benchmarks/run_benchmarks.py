@@ -0,0 +1,248 @@
+"""
+Benchmark the scanner against a stub Clair and synthetic images, so no
+docker daemon or Clair DB is needed. For each fleet size, every image is
+taken through Clair.analyse, Clair.get_layers_vulnerabilities and
+ImageScan.write_to_file, and the time, throughput and peak memory of each
+is printed along with the time spent in each stage of the scan.
+
+    python benchmarks/run_benchmarks.py --images 10 100 1000
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import multiprocessing
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from prettytable import PrettyTable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'docker_scan'))
+
+from clair import Clair  # noqa: E402
+from image_scan import ImageScan  # noqa: E402
+from metrics import registry  # noqa: E402
+from stub_clair import StubClair  # noqa: E402
+from synthetic_images import make_fleet  # noqa: E402
+
+STAGES = ('export', 'extract', 'submit', 'fetch', 'render')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+                description=('Benchmark the scanner against a stub Clair and'
+                             ' synthetic images'))
+    parser.add_argument('--images', help='The fleet sizes to run',
+                        type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('-j', '--jobs', help='Images to scan at once',
+                        type=int, default=4)
+    parser.add_argument('--bases', help='How many base images there are',
+                        type=int, default=5)
+    parser.add_argument('--base-layers', help='Layers in each base image',
+                        type=int, default=3)
+    parser.add_argument('--groups', help=('How many middle layers are shared'
+                                          ' by groups of images'),
+                        type=int, default=20)
+    parser.add_argument('--unique-layers', help='Layers only one image has',
+                        type=int, default=2)
+    parser.add_argument('--layer-kb', help='The size of each layer',
+                        type=int, default=256)
+    parser.add_argument('--post-latency', help='Seconds each layer POST takes',
+                        type=float, default=0.02)
+    parser.add_argument('--get-latency', help='Seconds each layer GET takes',
+                        type=float, default=0.01)
+    parser.add_argument('--features', help='Features each layer adds',
+                        type=int, default=20)
+    parser.add_argument('--vulnerabilities',
+                        help='Vulnerabilities of each vulnerable feature',
+                        type=int, default=2)
+    parser.add_argument('--no-memory',
+                        help=('Don\'t trace the peak memory, which slows'
+                              ' everything down'),
+                        dest='trace_memory', action='store_false')
+    parser.add_argument('--json', help='Write the results to this file',
+                        type=str)
+    return parser.parse_args()
+
+
+def serve_stub(conn, kwargs):
+    """
+    serve_stub
+
+    Run a StubClair in this process, sending its url back over conn
+
+    :param conn multiprocessing.Connection: Where to send the url
+    :param kwargs dict: The args for StubClair
+    """
+    stub = StubClair(**kwargs)
+    conn.send(stub.url)
+    stub.serve_forever()
+
+
+def run_phase(name, func, count, trace_memory):
+    """
+    run_phase
+
+    :param name str: What is being run
+    :param func function: Runs the phase, returns its results
+    :param count int: How many images it is for
+    :param trace_memory bool: Measure the peak memory
+    :return: (results, {'phase', 'seconds', 'images_per_second',
+        'peak_mb'})
+    """
+    if trace_memory:
+        tracemalloc.start()
+    start = time.monotonic()
+    try:
+        results = func()
+        seconds = time.monotonic() - start
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    return results, {'phase': name,
+                     'seconds': seconds,
+                     'images_per_second': count / seconds if seconds else 0.0,
+                     'peak_mb': peak / 1024 / 1024 if peak else None}
+
+
+def run_benchmark(count, args):
+    """
+    run_benchmark
+
+    :param count int: How many images to scan
+    :param args argparse.Namespace: The benchmark args
+    :return: {'images', 'phases', 'stages', 'clair'} results
+    """
+    parent_conn, child_conn = multiprocessing.Pipe()
+    # In its own process, so it doesn't share the GIL or count in the
+    # memory traced
+    stub = multiprocessing.Process(
+                target=serve_stub, daemon=True,
+                args=(child_conn, {'post_latency': args.post_latency,
+                                   'get_latency': args.get_latency,
+                                   'features': args.features,
+                                   'vulnerabilities': args.vulnerabilities}))
+    stub.start()
+    url = parent_conn.recv()
+    output_dir = tempfile.mkdtemp(suffix='-docker-scan-bench')
+    try:
+        clair_obj = Clair({'clair.host': url,
+                           'clair.pool_size': max(10, args.jobs * 2)}, None)
+        images = make_fleet(count, args.bases, args.base_layers, args.groups,
+                            args.unique_layers, args.layer_kb * 1024)
+        ImageScan.layer_sections.clear()
+        before = registry.to_json()['histograms']
+        phases = []
+
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            layers, phase = run_phase(
+                'analyse',
+                lambda: list(executor.map(clair_obj.analyse, images)),
+                count, args.trace_memory)
+            phases.append(phase)
+
+            def get_vulnerabilities(image_layers):
+                return clair_obj.get_layers_vulnerabilities(
+                                [layer['id'] for layer in image_layers])
+            vulnerabilities, phase = run_phase(
+                'get_layers_vulnerabilities',
+                lambda: list(executor.map(get_vulnerabilities, layers)),
+                count, args.trace_memory)
+            phases.append(phase)
+
+            def write(item):
+                image, image_vulnerabilities = item
+                ImageScan(image, None, image_vulnerabilities).write_to_file(
+                                output_dir, image.tags[0].replace('/', '-'))
+            _, phase = run_phase(
+                'write_to_file',
+                lambda: list(executor.map(write, zip(images,
+                                                     vulnerabilities))),
+                count, args.trace_memory)
+            phases.append(phase)
+
+        seconds = sum(phase['seconds'] for phase in phases)
+        phases.append({'phase': 'total',
+                       'seconds': seconds,
+                       'images_per_second': count / seconds,
+                       'peak_mb': max([phase['peak_mb'] or 0
+                                       for phase in phases]) or None})
+        with urllib.request.urlopen(url + '/stats') as r:
+            clair_stats = json.loads(r.read().decode('utf-8'))
+        return {'images': count,
+                'phases': phases,
+                'stages': get_stages(before, registry.to_json()['histograms']),
+                'clair': clair_stats}
+    finally:
+        stub.terminate()
+        stub.join()
+        shutil.rmtree(output_dir)
+
+
+def get_stages(before, after):
+    """
+    get_stages
+
+    :param before dict: The metrics histograms before the run
+    :param after dict: The metrics histograms after the run
+    :return: {stage:{'count', 'seconds'}} of the run alone
+    """
+    stages = {}
+    for stage in STAGES:
+        key = 'docker_scan_stage_seconds{{stage="{}"}}'.format(stage)
+        old = before.get(key, {'count': 0, 'sum': 0.0})
+        new = after.get(key, {'count': 0, 'sum': 0.0})
+        stages[stage] = {'count': new['count'] - old['count'],
+                         'seconds': new['sum'] - old['sum']}
+    return stages
+
+
+def print_results(results):
+    phases = PrettyTable(['Images', 'Phase', 'Seconds', 'Images/s',
+                          'Peak MB'])
+    stages = PrettyTable(['Images', 'Stage', 'Count', 'Seconds',
+                          'Mean ms'])
+    clair = PrettyTable(['Images', 'Layers', 'POSTs', 'GETs', 'Failed'])
+    for result in results:
+        for phase in result['phases']:
+            peak = phase['peak_mb']
+            phases.add_row([result['images'], phase['phase'],
+                            '{:.3f}'.format(phase['seconds']),
+                            '{:.1f}'.format(phase['images_per_second']),
+                            '-' if peak is None else '{:.1f}'.format(peak)])
+        for stage in STAGES:
+            times = result['stages'][stage]
+            mean = times['seconds'] / times['count'] if times['count'] else 0
+            stages.add_row([result['images'], stage, times['count'],
+                            '{:.3f}'.format(times['seconds']),
+                            '{:.2f}'.format(mean * 1000)])
+        calls = result['clair']
+        clair.add_row([result['images'], calls['layers'],
+                       calls['POST /v1/layers'], calls['GET /v1/layers'],
+                       calls['failed']])
+    print(phases)
+    print(stages)
+    print(clair)
+
+
+def main():
+    args = parse_args()
+    results = []
+    for count in args.images:
+        print('Scanning {} images...'.format(count))
+        results.append(run_benchmark(count, args))
+    print_results(results)
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,265 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'docker_scan'))
+
+from http_server import ThreadingHTTPServer  # noqa: E402
+
+SEVERITIES = ('Unknown', 'High', 'Medium', 'Low', 'Negligible')
+
+
+class StubClair:
+    """
+    StubClair
+
+    A stand in for the Clair v1 API (POST and GET /v1/layers and GET
+    /v1/namespaces) that answers with made up vulnerabilities, so the
+    scanner can be benchmarked without a Clair DB. How long each call takes
+    and how big the answers are can be set. GET /stats gives how many calls
+    it has had.
+    """
+    def __init__(self, host='127.0.0.1', port=0, post_latency=0.0,
+                 get_latency=0.0, features=20, vulnerabilities=2,
+                 description_size=200, read_layers=True):
+        """
+        __init__
+
+        :param host str: The address to listen on
+        :param port int: The port to listen on, 0 picks a free one
+        :param post_latency float: Seconds each layer POST takes, on top of
+            reading the layer
+        :param get_latency float: Seconds each layer GET takes
+        :param features int: How many features each layer adds
+        :param vulnerabilities int: How many vulnerabilities each feature has
+        :param description_size int: How long each description is
+        :param read_layers bool: Read every layer it is sent, like Clair
+            does, which fails the POST if the layer is gone
+        """
+        self._server = _StubServer((host, port), _StubHandler)
+        self._server.stub = self
+        self.post_latency = post_latency
+        self.get_latency = get_latency
+        self.features = features
+        self.vulnerabilities = vulnerabilities
+        self.description_size = description_size
+        self.read_layers = read_layers
+        self.layers = {}  # {layer name:parent name}
+        self.calls = {'POST /v1/layers': 0, 'GET /v1/layers': 0,
+                      'GET /v1/namespaces': 0, 'failed': 0}
+        self.lock = threading.Lock()
+        self._features = {}  # {layer name:[feature]}
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self._server.server_address[:2])
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self):
+        """
+        start
+
+        Start serving on a background thread
+        """
+        threading.Thread(target=self._server.serve_forever,
+                         daemon=True).start()
+
+    def close(self):
+        """
+        close
+
+        Stop the server
+        """
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_layer(self, layer):
+        """
+        add_layer
+
+        :param layer dict: The Layer of a POST /v1/layers
+        :return: True if the layer was taken
+        """
+        if self.read_layers:
+            try:
+                _read_layer(layer['Path'], layer.get('Headers') or {})
+            except (OSError, ValueError):
+                return False
+        time.sleep(self.post_latency)
+        with self.lock:
+            parent = layer.get('ParentName', '')
+            if parent and parent not in self.layers:
+                return False
+            self.layers[layer['Name']] = parent
+        return True
+
+    def get_layer(self, name):
+        """
+        get_layer
+
+        :param name str: The layer to get
+        :return: The GET /v1/layers response, with the features of the layer
+            and every layer under it, or None if it isn't known
+        """
+        time.sleep(self.get_latency)
+        with self.lock:
+            if name not in self.layers:
+                return None
+            chain = []
+            layer = name
+            while layer:
+                chain.append(layer)
+                layer = self.layers[layer]
+            parent = self.layers[name]
+        features = []
+        for layer in reversed(chain):
+            features.extend(self._get_features(layer))
+        return {'Layer': {'Name': name,
+                          'ParentName': parent,
+                          'IndexedByVersion': 3,
+                          'NamespaceName': 'debian:9',
+                          'Features': features}}
+
+    def _get_features(self, layer):
+        """
+        _get_features
+
+        :param layer str: The layer name
+        :return: The features the layer adds, the same every time
+        """
+        with self.lock:
+            if layer in self._features:
+                return self._features[layer]
+        rand = random.Random(layer)
+        features = []
+        for i in range(self.features):
+            feature = {'Name': 'package-{}-{}'.format(layer[:8], i),
+                       'NamespaceName': 'debian:9',
+                       'VersionFormat': 'dpkg',
+                       'Version': '1.{}.{}'.format(i, rand.randrange(10)),
+                       'AddedBy': layer}
+            # Most packages don't have any
+            if rand.random() < 0.3:
+                feature['Vulnerabilities'] = [
+                    {'Name': 'CVE-2018-{}'.format(rand.randrange(10000)),
+                     'NamespaceName': 'debian:9',
+                     'Link': 'https://security-tracker.debian.org/',
+                     'Severity': rand.choice(SEVERITIES),
+                     'Description': 'x' * self.description_size}
+                    for _ in range(self.vulnerabilities)]
+            features.append(feature)
+        with self.lock:
+            self._features[layer] = features
+        return features
+
+    def count(self, call):
+        with self.lock:
+            self.calls[call] += 1
+
+
+def _read_layer(path, headers):
+    """
+    _read_layer
+
+    :param path str: The layer's path or url
+    :param headers dict: The headers to download it with
+    """
+    if '://' in path:
+        with urllib.request.urlopen(urllib.request.Request(
+                path, headers=headers)) as r:
+            while r.read(1024 * 1024):
+                pass
+        return
+    with open(path, 'rb') as f:
+        while f.read(1024 * 1024):
+            pass
+
+
+class _StubServer(ThreadingHTTPServer):
+    # Room for every submit of a big benchmark run at once
+    request_queue_size = 128
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        stub = self.server.stub
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length).decode('utf-8'))
+        stub.count('POST /v1/layers')
+        if self.path != '/v1/layers' or 'Layer' not in body:
+            self._send(404, {})
+        elif stub.add_layer(body['Layer']):
+            self._send(201, {'Layer': body['Layer']})
+        else:
+            stub.count('failed')
+            self._send(400, {'Error': {'Message': 'could not read layer'}})
+
+    def do_GET(self):
+        stub = self.server.stub
+        path = self.path.partition('?')[0]
+        if path == '/v1/namespaces':
+            stub.count('GET /v1/namespaces')
+            self._send(200, {'Namespaces': [{'Name': 'debian:9',
+                                             'VersionFormat': 'dpkg'}]})
+        elif path.startswith('/v1/layers/'):
+            stub.count('GET /v1/layers')
+            layer = stub.get_layer(path[len('/v1/layers/'):])
+            if layer is None:
+                stub.count('failed')
+                self._send(404, {'Error': {'Message': 'layer not found'}})
+            else:
+                self._send(200, layer)
+        elif path == '/stats':
+            with stub.lock:
+                self._send(200, dict(stub.calls, layers=len(stub.layers)))
+        else:
+            self._send(404, {})
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                description='A stub Clair v1 API for benchmarking')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6060)
+    parser.add_argument('--post-latency', type=float, default=0.0)
+    parser.add_argument('--get-latency', type=float, default=0.0)
+    parser.add_argument('--features', type=int, default=20)
+    parser.add_argument('--vulnerabilities', type=int, default=2)
+    parser.add_argument('--description-size', type=int, default=200)
+    parser.add_argument('--no-read-layers', dest='read_layers',
+                        action='store_false')
+    args = parser.parse_args()
+    stub = StubClair(args.host, args.port, args.post_latency,
+                     args.get_latency, args.features, args.vulnerabilities,
+                     args.description_size, args.read_layers)
+    print('Stub Clair on {}'.format(stub.url))
+    try:
+        stub.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
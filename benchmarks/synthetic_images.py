@@ -0,0 +1,152 @@
+import json
+import hashlib
+import tarfile
+
+# The content every synthetic layer.tar is cut from
+_BLOCK = bytes(range(256)) * 4096
+
+
+class SyntheticImage:
+    """
+    SyntheticImage
+
+    A stand in for a docker.Image whose save() streams a `docker save`
+    style tar (legacy v1 layer folders, a config and manifest.json) that is
+    made up on the fly, so the scanner can be run without a docker daemon.
+    The stream is never held in memory as a whole, like docker's.
+    """
+    def __init__(self, name, layer_names, layer_size):
+        """
+        __init__
+
+        :param name str: The tag of the image
+        :param layer_names list: A name for each layer, bottom layer first.
+            Layers with the same name (and the same layers under them) are
+            the same layer, so images can share them.
+        :param layer_size int: How many bytes each layer.tar is
+        """
+        self.tags = [name]
+        self.layer_size = layer_size
+        self.diff_ids = ['sha256:' + _sha256(layer_name)
+                         for layer_name in layer_names]
+        self.config = json.dumps({
+            'architecture': 'amd64',
+            'os': 'linux',
+            'config': {'Labels': {'benchmark': name}},
+            'rootfs': {'type': 'layers', 'diff_ids': self.diff_ids}
+        }, sort_keys=True).encode('utf-8')
+        self.id = 'sha256:' + hashlib.sha256(self.config).hexdigest()
+        self.attrs = {'Id': self.id,
+                      'RepoTags': self.tags,
+                      'RepoDigests': [],
+                      'Size': layer_size * len(layer_names),
+                      'RootFS': {'Type': 'layers', 'Layers': self.diff_ids}}
+        self.v1_ids = self._v1_ids()
+
+    def _v1_ids(self):
+        """
+        _v1_ids
+
+        docker save names each layer folder by a hash of the layer and its
+        parent, and the top layer's by the image config too, so only the
+        layers under the top one are shared between images.
+
+        :return: The v1 id of each layer, bottom layer first
+        """
+        v1_ids = []
+        parent = ''
+        for i, diff_id in enumerate(self.diff_ids):
+            key = parent + ' ' + diff_id
+            if i == len(self.diff_ids) - 1:
+                key += ' ' + self.id
+            v1_ids.append(_sha256(key))
+            parent = v1_ids[-1]
+        return v1_ids
+
+    def save(self, chunk_size=2097152):
+        """
+        save
+
+        :param chunk_size int: The most bytes to yield at once
+        :return: A generator of the bytes chunks of the save tar
+        """
+        parent = ''
+        for v1_id in self.v1_ids:
+            layer_json = {'id': v1_id}
+            if parent:
+                layer_json['parent'] = parent
+            yield from _member(v1_id + '/VERSION', b'1.0')
+            yield from _member(v1_id + '/json',
+                               json.dumps(layer_json).encode('utf-8'))
+            yield from _layer_member(v1_id + '/layer.tar', self.layer_size,
+                                     chunk_size)
+            parent = v1_id
+        config_name = self.id[len('sha256:'):] + '.json'
+        yield from _member(config_name, self.config)
+        manifest = [{'Config': config_name,
+                     'RepoTags': self.tags,
+                     'Layers': [v1_id + '/layer.tar'
+                                for v1_id in self.v1_ids]}]
+        yield from _member('manifest.json',
+                           json.dumps(manifest).encode('utf-8'))
+        yield from _member('repositories', b'{}')
+        # The end of archive marker
+        yield bytes(tarfile.BLOCKSIZE * 2)
+
+
+def make_fleet(count, bases=5, base_layers=3, groups=20, unique_layers=2,
+               layer_size=256 * 1024):
+    """
+    make_fleet
+
+    Make images that share layers the way a real fleet does: a few base
+    images, a layer shared by each group of images built the same way (a
+    runtime, say) and a few layers of their own
+
+    :param count int: How many images to make
+    :param bases int: How many base images there are
+    :param base_layers int: How many layers each base image has
+    :param groups int: How many shared middle layers there are
+    :param unique_layers int: How many layers only each image has
+    :param layer_size int: How many bytes each layer.tar is
+    :return: The list of SyntheticImages
+    """
+    images = []
+    for i in range(count):
+        base = i % bases
+        layer_names = ['base{}-{}'.format(base, j)
+                       for j in range(base_layers)]
+        layer_names.append('group{}-on-base{}'.format(i % groups, base))
+        layer_names.extend('app{}-{}'.format(i, j)
+                           for j in range(unique_layers))
+        images.append(SyntheticImage('bench/app{}:latest'.format(i),
+                                     layer_names, layer_size))
+    return images
+
+
+def _sha256(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _member(name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    yield info.tobuf(format=tarfile.USTAR_FORMAT)
+    yield data + _padding(len(data))
+
+
+def _layer_member(name, size, chunk_size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    yield info.tobuf(format=tarfile.USTAR_FORMAT)
+    block = memoryview(_BLOCK)
+    left = size
+    while left > 0:
+        chunk = min(left, chunk_size, len(_BLOCK))
+        yield block[:chunk]
+        left -= chunk
+    yield _padding(size)
+
+
+def _padding(size):
+    return bytes(-size % tarfile.BLOCKSIZE)
@@ -1,3 +1,4 @@
+import os
 import argparse
 
 
@@ -22,6 +23,188 @@ def parse_args():
                               ' use for storing temporary images. Will default'
                               ' to unix:///var/run/docker.sock'),
                         type=str)
+    parser.add_argument('-j', '--jobs',
+                        help=('How many images to scan at the same time.'
+                              ' Defaults to 1'),
+                        type=positive_int, default=1)
+    parser.add_argument('--pull-jobs',
+                        help=('How many images to look up or pull at the'
+                              ' same time. Scanning starts as soon as the'
+                              ' first one is ready. Defaults to 4'),
+                        type=positive_int, default=4)
+    parser.add_argument('--engine',
+                        help=('How to run the scans. "threads" gives each'
+                              ' image a worker thread, "asyncio" runs all of'
+                              ' the Clair calls on one event loop and only'
+                              ' uses threads for the docker exports. Defaults'
+                              ' to threads'),
+                        choices=['threads', 'asyncio'], default='threads')
+
+    parser.add_argument('-f', '--format',
+                        help=('A report format to write. Can be given more'
+                              ' than once. "text" writes the tables, "jsonl"'
+                              ' a json object per line, "csv" a csv row and'
+                              ' "sarif" a SARIF 2.1.0 log, for each'
+                              ' vulnerability. Defaults to text'),
+                        dest='formats', action='append',
+                        choices=['text', 'jsonl', 'csv', 'sarif'])
+    parser.add_argument('--fleet-report',
+                        help=('Write every image into one fleet.<format> file'
+                              ' per format instead of a file per image'),
+                        action='store_true')
+    parser.add_argument('--fleet-index',
+                        help=('Index every vulnerability, layer and image'
+                              ' into fleet-index.sqlite in the output folder'
+                              ' and write fleet-summary.txt, ranking them by'
+                              ' severity times how many images they are in'),
+                        action='store_true')
+    parser.add_argument('--incremental',
+                        help=('Only scan images that are new since the last'
+                              ' run into the output folder, or that were'
+                              ' scanned with a different --clair-db-version,'
+                              ' and write what changed to delta.txt. Can not'
+                              ' be used with --fleet-report'),
+                        action='store_true')
+
+    # Daemon args
+    parser.add_argument('--daemon',
+                        help=('Keep running, scanning new images from the'
+                              ' source as they show up and rescanning the'
+                              ' rest on a schedule, with an HTTP API to'
+                              ' submit images and read results'),
+                        action='store_true')
+    parser.add_argument('--api',
+                        help=('The [host:]port the daemon serves its API on.'
+                              ' Defaults to 127.0.0.1:8088'),
+                        type=str, default='127.0.0.1:8088',
+                        metavar='[HOST:]PORT')
+    parser.add_argument('--poll-interval',
+                        help=('Seconds between the daemon asking the source'
+                              ' for its images. Defaults to 300'),
+                        type=positive_int, default=300)
+    parser.add_argument('--rescan-interval',
+                        help=('Seconds before the daemon scans an image'
+                              ' again. Defaults to 86400 (a day)'),
+                        type=positive_int, default=86400)
+
+    # Policy args
+    parser.add_argument('--fail-on',
+                        help=('Fail the run (exit code 3) if any image has a'
+                              ' vulnerability of this severity or worse that'
+                              ' isn\'t allowed. One of Unknown, High, Medium,'
+                              ' Low or Negligible, from worst to least'),
+                        choices=['Unknown', 'High', 'Medium', 'Low',
+                                 'Negligible'],
+                        metavar='SEVERITY')
+    parser.add_argument('--allow',
+                        help=('A vulnerability (e.g. CVE-2018-1000001) that'
+                              ' never fails the run. Can be given more than'
+                              ' once'),
+                        dest='allowed', action='append', metavar='CVE')
+    parser.add_argument('--allowlist',
+                        help=('A file of vulnerabilities that never fail the'
+                              ' run, one per line. # starts a comment'),
+                        type=str, metavar='FILE')
+    parser.add_argument('--fail-fast',
+                        help=('Stop at the first image that fails --fail-on:'
+                              ' no more images or layers are scanned, and only'
+                              ' the reports of the failing images are'
+                              ' written'),
+                        action='store_true')
+
+    # Scratch space args
+    parser.add_argument('--scratch-dir',
+                        help=('The folder to export layers into. A tmpfs'
+                              ' (e.g. /dev/shm) keeps small images off the'
+                              ' disk. Clair reads the layers from the same'
+                              ' path, so it must be mounted into Clair\'s'
+                              ' container too (clair-runner only mounts'
+                              ' /tmp), unless --serve-layers is used.'
+                              ' Defaults to the system\'s tmp folder'),
+                        type=str)
+    parser.add_argument('--scratch-quota-mb',
+                        help=('How many MB of layers can be exported at'
+                              ' once. New exports wait for room. Defaults to'
+                              ' no limit'),
+                        type=positive_int)
+
+    # Metrics args
+    parser.add_argument('--metrics-json',
+                        help=('Write the stage timings, byte counts, cache'
+                              ' hits and Clair latencies to this json file'
+                              ' at the end of the run'),
+                        type=str, metavar='FILE')
+    parser.add_argument('--metrics-port',
+                        help=('Serve the metrics in the Prometheus text'
+                              ' format on /metrics from this [host:]port'
+                              ' while running (e.g. 0.0.0.0:9108)'),
+                        type=str, metavar='[HOST:]PORT')
+
+    # Clair connection args
+    parser.add_argument('--clair-host',
+                        help=('The Clair API to use.'
+                              ' Defaults to http://127.0.0.1:6060'),
+                        type=str, default='http://127.0.0.1:6060')
+    parser.add_argument('--serve-layers',
+                        help=('Serve the layers to Clair over HTTP from this'
+                              ' [host:]port instead of giving Clair a file'
+                              ' path, so Clair can run on another machine'
+                              ' (e.g. 0.0.0.0:8089)'),
+                        type=str, metavar='[HOST:]PORT')
+    parser.add_argument('--layer-url',
+                        help=('The url Clair reaches --serve-layers on.'
+                              ' Defaults to http://<hostname>:<port>'),
+                        type=str)
+    parser.add_argument('--clair-timeout',
+                        help=('Seconds to wait for a response from Clair.'
+                              ' A GET that times out is retried, but a layer'
+                              ' POST that times out fails the layer, as'
+                              ' Clair may still be analysing it. Defaults to'
+                              ' 900'),
+                        type=positive_int, default=900)
+    parser.add_argument('--clair-retries',
+                        help=('How many times to retry a Clair call that'
+                              ' failed with a 5xx or a connection error. A'
+                              ' layer POST is only retried if it couldn\'t'
+                              ' connect. Defaults to 3'),
+                        type=int, default=3)
+    parser.add_argument('--query-mode',
+                        help=('How to get vulnerabilities from Clair. "image"'
+                              ' fetches only the top layer of an image and'
+                              ' splits its features by layer, "layer"'
+                              ' fetches every layer. Defaults to image'),
+                        choices=['image', 'layer'], default='image')
+    parser.add_argument('--clair-concurrency',
+                        help=('How many Clair calls the asyncio engine keeps'
+                              ' in flight at once. Defaults to 100'),
+                        type=positive_int, default=100)
+
+    # Layer cache args
+    parser.add_argument('--cache-dir',
+                        help=('Keep layer results in this folder between runs,'
+                              ' so unchanged images are not exported or'
+                              ' sent to Clair again. Off by default'),
+                        type=str)
+    parser.add_argument('--cache-ttl',
+                        help=('How many seconds a cached layer result is good'
+                              ' for. Defaults to 172800 (2 days), so a nightly'
+                              ' run still finds the last run\'s results. A'
+                              ' result can miss vulnerabilities Clair has'
+                              ' learned of since, for up to this long, unless'
+                              ' --clair-db-version changes. Lower it (e.g. to'
+                              ' 7200, the Clair updater interval) for fresher'
+                              ' results at the cost of more exports'),
+                        type=positive_int, default=172800)
+    parser.add_argument('--cache-max-mb',
+                        help=('How big the layer cache can get before old'
+                              ' results are evicted. Defaults to 1024'),
+                        type=positive_int, default=1024)
+    parser.add_argument('--clair-db-version',
+                        help=('Anything that changes when the Clair DB is'
+                              ' updated (e.g. the time of the last update).'
+                              ' Cached results from a different version are'
+                              ' thrown away'),
+                        type=str)
 
     # Add subparsers (one of these must be specified)
     subparsers = parser.add_subparsers(dest='source', help='sub-command help')
@@ -29,9 +212,30 @@ def parse_args():
     file_parser(subparsers)
     docker_parser(subparsers)
     k8s_parser(subparsers)
+    registry_parser(subparsers)
+    multi_parser(subparsers)
     return parser.parse_args()
 
 
+def positive_int(value):
+    """
+    positive_int
+
+    Argparse type for options that need a number greater than 0
+
+    :param value str: The value given on the command line
+    :return: The value as an int
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+                    '{} is not a positive integer'.format(value))
+    return number
+
+
 def file_parser(subparsers):
     """
     file_parser
@@ -78,8 +282,110 @@ def k8s_parser(subparsers):
 
     :param subparsers: The subparsers list to add the parser to
     """
-    subparsers.add_parser(
+    parser = subparsers.add_parser(
                     'kubernetes', aliases=['k8s'],
                     description=('Security check images from the running'
                                  ' pods on a kubernetes cluster.')
     )
+    parser.add_argument('-n', '--namespace',
+                        help=('Only check pods in this namespace. Defaults'
+                              ' to every namespace'),
+                        type=str)
+    parser.add_argument('-l', '--selector',
+                        help=('Only check pods matching this label selector'
+                              ' (e.g. app=web,tier!=cache)'),
+                        type=str)
+    parser.add_argument('--page-size',
+                        help=('How many pods to list per call to the API.'
+                              ' Defaults to 500'),
+                        type=positive_int, default=500)
+    parser.add_argument('--watch',
+                        help=('After the running pods, keep watching the'
+                              ' cluster and check the images of new pods as'
+                              ' they appear, until stopped. Reports list'
+                              ' the pods using the image when it was'
+                              ' checked'),
+                        action='store_true')
+
+
+def registry_parser(subparsers):
+    """
+    registry_parser
+
+    Add the registry subparser to the subparsers
+
+    :param subparsers: The subparsers list to add the parser to
+    """
+    parser = subparsers.add_parser(
+                    'registry',
+                    description=('Security check images straight from their'
+                                 ' registry. Clair downloads the layers, so'
+                                 ' nothing is pulled into docker.')
+    )
+    parser.add_argument('references',
+                        help=('The images to check (e.g. alpine:3.7,'
+                              ' quay.io/org/app@sha256:...)'),
+                        type=str, nargs='*')
+    parser.add_argument('--file',
+                        help=('A newline separated list of more images to'
+                              ' check'),
+                        type=str)
+    parser.add_argument('--username',
+                        help=('The user to log in to the registries as.'
+                              ' Defaults to the logins in'
+                              ' ~/.docker/config.json'),
+                        type=str)
+    parser.add_argument('--password',
+                        help=('The password for --username. Defaults to'
+                              ' $REGISTRY_PASSWORD'),
+                        type=str, default=os.environ.get('REGISTRY_PASSWORD'))
+    parser.add_argument('--insecure',
+                        help='Talk to the registries over http',
+                        action='store_true')
+    parser.add_argument('--platform',
+                        help=('The os/architecture to check for images built'
+                              ' for several platforms. Defaults to'
+                              ' linux/amd64'),
+                        type=str, default='linux/amd64')
+
+
+def multi_parser(subparsers):
+    """
+    multi_parser
+
+    Add the multi subparser to the subparsers
+
+    :param subparsers: The subparsers list to add the parser to
+    """
+    parser = subparsers.add_parser(
+                    'multi',
+                    description=('Security check the images running on'
+                                 ' several docker servers and kubernetes'
+                                 ' clusters at once. Each image is only'
+                                 ' checked once, and its report lists where'
+                                 ' it was running.')
+    )
+    parser.add_argument('--docker-server',
+                        help=('A docker server to get the running containers'
+                              ' from. Can be given more than once'),
+                        dest='docker_servers', action='append', type=str)
+    parser.add_argument('--context',
+                        help=('A kube config context of a cluster to get the'
+                              ' running pods from. Can be given more than'
+                              ' once'),
+                        dest='contexts', action='append', type=str)
+    parser.add_argument('--all-contexts',
+                        help='Use every context in the kube config',
+                        action='store_true')
+    parser.add_argument('-n', '--namespace',
+                        help=('Only check pods in this namespace. Defaults'
+                              ' to every namespace'),
+                        type=str)
+    parser.add_argument('-l', '--selector',
+                        help='Only check pods matching this label selector',
+                        type=str)
+    parser.add_argument('--page-size',
+                        help=('How many pods to list per call to the API.'
+                              ' Defaults to 500'),
+                        type=positive_int, default=500)
+    parser.set_defaults(watch=False)
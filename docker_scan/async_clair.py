@@ -0,0 +1,313 @@
+import json
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import CancelledError
+
+import aiohttp
+
+from clair import Clair, _LayerOrder, _image_size
+from image_export import ImageExport
+from metrics import registry
+from registry_helper import RegistryImage
+
+
+class AsyncClair(Clair):
+    """
+    AsyncClair
+
+    An asyncio version of the Clair class. Layer POSTs and vulnerability
+    GETs for many images are kept in flight at once on one event loop, up to
+    a concurrency limit, instead of needing a thread per image. It shares
+    the already analysed layers, layer cache and latency counters with the
+    blocking Clair methods it inherits.
+    """
+    def __init__(self, cfg, docker_cli, layer_cache=None, layer_server=None,
+                 scratch_space=None):
+        '''
+        Takes the same cfg as Clair, plus:
+
+            cfg = {
+                # Optional, default shown
+                'clair.concurrency': 100,
+            }
+        '''
+        super().__init__(cfg, docker_cli, layer_cache, layer_server,
+                         scratch_space)
+        self.concurrency = cfg.get('clair.concurrency', 100)
+        self._http = None
+        self._requests = None
+        # Calls that are in flight, so images sharing a layer wait on the
+        # same call {(method, layer_id):asyncio.Future}
+        self._in_flight = {}
+
+    async def open(self):
+        """
+        open
+
+        Create the HTTP session. Must be called on the loop that will use it.
+        """
+        timeout = aiohttp.ClientTimeout(
+                        total=None, sock_connect=self.session.timeout[0],
+                        sock_read=self.session.timeout[1])
+        self._http = aiohttp.ClientSession(
+                        connector=aiohttp.TCPConnector(limit=self.concurrency),
+                        timeout=timeout)
+        self._requests = asyncio.Semaphore(self.concurrency)
+
+    async def close(self):
+        """
+        close
+
+        Close the HTTP session
+        """
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+
+    async def _request(self, method, path, endpoint, data=None):
+        """
+        _request
+
+        Make a call to Clair, retrying 5xx responses and connection errors
+            with backoff like ClairSession does
+
+        :param method str: The HTTP method
+        :param path str: The path on the Clair host
+        :param endpoint str: The name to count the latency under
+        :param data str: The body to send
+        :return: (status code, json body or None)
+        """
+        retries = self.cfg.get('clair.retries', 3)
+        async with self._requests:
+            start = time.monotonic()
+            try:
+                for attempt in range(retries + 1):
+                    if attempt > 0:
+                        await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+                    try:
+                        async with self._http.request(
+                                method, self.session.host + path,
+                                data=data) as r:
+                            if (r.status in self.session.retry_statuses and
+                                    attempt < retries):
+                                continue
+                            if r.status not in (200, 201):
+                                return r.status, None
+                            return r.status, await r.json(content_type=None)
+                    except (aiohttp.ClientConnectionError,
+                            asyncio.TimeoutError) as ex:
+                        # Like ClairSession, a POST is only retried when it
+                        # couldn't connect
+                        if attempt == retries or (
+                                method == 'POST' and not isinstance(
+                                    ex, aiohttp.ClientConnectorError)):
+                            raise
+            finally:
+                self.session.record_latency(endpoint,
+                                            time.monotonic() - start)
+
+    async def _once(self, key, coro_func):
+        """
+        _once
+
+        Run coro_func unless a call with the same key is already in flight,
+            in which case wait for that one instead
+
+        :param key tuple: What identifies the call
+        :param coro_func function: Returns the coroutine to run
+        :return: The result of the call
+        """
+        if key in self._in_flight:
+            return await asyncio.shield(self._in_flight[key])
+        future = asyncio.get_event_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            result = await coro_func()
+            future.set_result(result)
+            return result
+        except BaseException as ex:
+            # Including a CancelledError, which isn't an Exception from
+            # Python 3.8 on, or the images waiting on this call would hang
+            future.set_exception(ex)
+            # Nobody may be waiting on it, so don't warn about it
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[key]
+
+    async def analyse_layer_async(self, layer):
+        """
+        analyse_layer_async
+
+        Send a POST to the Clair API to analyse this layer, unless it has
+            already been analysed or another image is sending it right now
+
+        :param layer dict: The dict of info for the API call
+        """
+        if self.cancelled:
+            raise CancelledError()
+
+        async def post():
+            if self._is_known(layer['id']):
+                return
+            with registry.time('docker_scan_stage_seconds',
+                               stage='submit'), \
+                    self._clair_layer(layer) as clair_layer:
+                status, _ = await self._request('POST', '/v1/layers',
+                                                'POST /v1/layers',
+                                                data=json.dumps(clair_layer))
+            if status != 201:
+                logging.error(
+                    layer['image'] + ':Failed to analyse layer ' + layer['id'])
+                return
+            self._add_submitted(layer['id'])
+        await self._once(('POST', layer['id']), post)
+
+    async def analyse_async(self, docker_image, executor):
+        """
+        analyse_async
+
+        The same as Clair.analyse, but the layers are POSTed from the event
+            loop while the save stream is read on a thread from executor
+
+        :param docker_image docker.Image: The docker Image object to analyse
+        :param executor concurrent.futures.Executor: Where to run the export
+        :return: The layers in this image that were analysed
+        """
+        image = docker_image.id
+        if self.cancelled:
+            raise CancelledError()
+        # Skip the export entirely if every layer's result is still cached,
+        # or every layer is already in Clair
+        cached_layers = (self._get_cached_layers(image) or
+                         self._get_chain_layers(docker_image))
+        if cached_layers is not None:
+            registry.inc('docker_scan_exports_skipped_total')
+            return cached_layers
+        # Clair downloads the layers of a registry image itself
+        if isinstance(docker_image, RegistryImage):
+            layers = docker_image.get_layers()
+            for layer in layers:
+                await self.analyse_layer_async(layer)
+            if self.layer_cache is not None:
+                self.layer_cache.put_image_layers(
+                                image, [layer['id'] for layer in layers])
+            return layers
+
+        loop = asyncio.get_event_loop()
+        events = asyncio.Queue()
+        # Set when the layers read aren't wanted anymore (a POST failed)
+        stop_reading = threading.Event()
+        # Waiting for room in the scratch space mustn't block the loop
+        scratch_dir = await loop.run_in_executor(
+                executor, self.scratch_space.export, _image_size(docker_image))
+        export = ImageExport(docker_image, scratch_dir, self._is_known)
+
+        def read_stream():
+            # Runs on the executor, handing each layer back to the loop
+            layers = export.iter_layers()
+            try:
+                for event in layers:
+                    # Don't export the rest of the image for nothing
+                    if self.cancelled or stop_reading.is_set():
+                        break
+                    loop.call_soon_threadsafe(events.put_nowait, event)
+            finally:
+                # Closes the save stream
+                layers.close()
+                loop.call_soon_threadsafe(events.put_nowait, None)
+
+        reader = loop.run_in_executor(executor, read_stream)
+        try:
+            order = _LayerOrder(image, self._is_known)
+            while True:
+                event = await events.get()
+                if event is None:
+                    break
+                for layer in order.add(*event):
+                    await self.analyse_layer_async(layer)
+                    # Clair has read it
+                    scratch_dir.release(layer['path'])
+            # Raises any error from reading the stream
+            await reader
+            if self.cancelled:
+                raise CancelledError()
+            scratch_dir.done_writing()
+
+            layers = self._manifest_layers(export.manifest, scratch_dir.path,
+                                           image)
+            for layer in order.finish(layers):
+                await self.analyse_layer_async(layer)
+                scratch_dir.release(layer['path'])
+            self._put_chain_layers(docker_image, layers)
+            if self.layer_cache is not None:
+                self.layer_cache.put_image_layers(
+                                image, [layer['id'] for layer in layers])
+        finally:
+            stop_reading.set()
+            # Don't remove the layers while the stream is still writing them
+            await asyncio.wait([reader])
+            scratch_dir.close()
+        return layers
+
+    async def get_layer_vulnerabilities_async(self, layer_id):
+        """
+        get_layer_vulnerabilities_async
+
+        :param layer_id str: The layer_id of the layer
+        :return: The json response from the call, or None on an error
+        """
+        async def get():
+            with registry.time('docker_scan_stage_seconds', stage='fetch'):
+                status, body = await self._request(
+                    'GET', '/v1/layers/'+layer_id+'?features&vulnerabilities',
+                    'GET /v1/layers')
+            if status != 200:
+                logging.error('Could not get info on layer '+layer_id)
+            return body
+        return await self._once(('GET', layer_id), get)
+
+    async def get_layers_vulnerabilities_async(self, layer_ids):
+        """
+        get_layers_vulnerabilities_async
+
+        The same as Clair.get_layers_vulnerabilities, with the calls for
+            different layers made at the same time
+
+        :param layer_ids list: All of the layers to get vulns for, bottom
+            layer first
+        :return: All of the vulnerabilites for a list of layers
+        """
+        if self.cancelled:
+            raise CancelledError()
+        if self.cfg.get('clair.query_mode', 'image') == 'image':
+            top = await self._get_layer_result_async(layer_ids[-1])
+            if top is not None:
+                split = self._split_vulnerabilities(top, layer_ids)
+                return [split[layer_id] for layer_id in layer_ids]
+            # Fall back to getting the layers one at a time
+
+        results = await asyncio.gather(
+            *[self._get_layer_result_async(layer_id)
+              for layer_id in layer_ids])
+        # Don't add if there was an error
+        return [result for result in results if result is not None]
+
+    async def _get_layer_result_async(self, layer_id):
+        """
+        _get_layer_result_async
+
+        The same as Clair._get_layer_result
+
+        :param layer_id str: The layer to get the Clair response for
+        :return: The layer's response, or None if it couldn't be fetched
+        """
+        stored = self._get_stored_vulnerabilities(layer_id, count=True)
+        if stored is not None:
+            return stored
+        layer_vulnerabilities = await self.get_layer_vulnerabilities_async(
+                                        layer_id)
+        self._store_vulnerabilities(layer_id, layer_vulnerabilities)
+        return layer_vulnerabilities
@@ -23,12 +23,20 @@
 
 import os
 import logging
-import tempfile
-import shutil
-import tarfile
 import json
+import weakref
+import threading
+import contextlib
+from urllib.parse import quote
+from concurrent.futures import CancelledError, wait
 
-import requests
+from clair_session import ClairSession
+from image_export import ImageExport, get_chain_ids
+from layer_scheduler import LayerScheduler
+from registry_helper import RegistryImage
+from lru_cache import LRUCache
+from scratch_space import ScratchSpace
+from metrics import registry
 
 
 class Clair:
@@ -37,21 +45,105 @@ class Clair:
 
     A class to make all of the Clair API calls
     """
-    def __init__(self, cfg, docker_cli):
+    def __init__(self, cfg, docker_cli, layer_cache=None, layer_server=None,
+                 scratch_space=None):
         '''
         Cfg is a dict:
 
             cfg = {
                 'clair.host': 'http://localhost:6060',
                 'docker.connect': 'tcp://127.0.0.1:2375' or None for socks.
+                # Optional, defaults shown
+                'clair.timeout': 900,
+                'clair.retries': 3,
+                'clair.pool_size': 10,
+                'clair.query_mode': 'image' or 'layer',
+                'clair.results_in_memory': 512,
             }
+
+        layer_cache is an optional layer_cache.LayerCache to keep results in
+        between runs.
+
+        layer_server is an optional layer_server.LayerServer. With one, Clair
+        is given an url to download each layer from instead of a path, so it
+        doesn't have to run on this machine.
+
+        scratch_space is an optional scratch_space.ScratchSpace to export the
+        layers into. Defaults to one in the system's tmp folder with no
+        quota.
         '''
         self.cfg = cfg
         self.docker_cli = docker_cli
+        self.layer_cache = layer_cache
+        self.layer_server = layer_server
+        self.scratch_space = scratch_space or ScratchSpace()
+        self.session = ClairSession(cfg['clair.host'],
+                                    read_timeout=cfg.get('clair.timeout', 900),
+                                    retries=cfg.get('clair.retries', 3),
+                                    pool_size=cfg.get('clair.pool_size', 10))
         # Hold onto what layers have already been analysed to reduce API calls
-        # Could be useful for images that use a similar base
-        # {layer_id:vulnerabilties}
-        self.already_analysed = {}
+        # Could be useful for images that use a similar base. Only the most
+        # recently used results are kept, so memory doesn't grow with the
+        # size of the fleet. {layer_id:vulnerabilties}
+        self.already_analysed = LRUCache(
+                                    cfg.get('clair.results_in_memory', 512))
+        # The layer each chain id was analysed as, so an image whose layers
+        # were all analysed as part of other images isn't exported at all
+        # {chain_id:layer_id}
+        self.chain_layers = LRUCache(
+                            cfg.get('clair.results_in_memory', 512) * 16)
+        # Layers that Clair is known to have this run (accepted or fetched),
+        # so images scanned in parallel don't send the same layer twice
+        self.submitted = set()
+        # Whether the layer cache has a layer to check Clair still has
+        self._clair_layer_saved = False
+        # One lock per layer so only one worker ever talks to Clair about a
+        # given layer at a time. A layer's lock is dropped once nobody holds
+        # or waits on it. {layer_id:threading.Lock}
+        self._layer_locks = weakref.WeakValueDictionary()
+        self._layer_locks_lock = threading.Lock()
+        # Submits the layers of every image being scanned on one pool, each
+        # layer as soon as its parent is in Clair
+        self.scheduler = LayerScheduler(self._submit_layer,
+                                        cfg.get('clair.pool_size', 10))
+        # Set by cancel, once nothing more should be sent to Clair
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        cancel
+
+        Stop scanning (e.g. once a run has failed its policy, or is being
+            stopped by a signal). The calls to Clair in flight finish, but
+            no more layers are submitted and no more images are analysed or
+            fetched: they raise a concurrent.futures.CancelledError
+            instead.
+        """
+        self.cancelled = True
+        self.scheduler.cancel()
+
+    def shutdown(self):
+        """
+        shutdown
+
+        Stop the layer scheduler's workers, once the layers being submitted
+            are done
+        """
+        self.scheduler.shutdown()
+
+    def _layer_lock(self, layer_id):
+        """
+        _layer_lock
+
+        :param layer_id str: The layer to get the lock for
+        :return: The threading.Lock guarding this layer
+        """
+        with self._layer_locks_lock:
+            lock = self._layer_locks.get(layer_id)
+            if lock is None:
+                lock = threading.Lock()
+                self._layer_locks[layer_id] = lock
+            return lock
 
     def analyse_layer(self, layer):
         """
@@ -75,6 +167,59 @@ class Clair:
               }
             }
         '''
+        with registry.time('docker_scan_stage_seconds', stage='submit'), \
+                self._clair_layer(layer) as clair_layer:
+            r = self.session.post('/v1/layers', 'POST /v1/layers',
+                                  data=json.dumps(clair_layer))
+        if r.status_code != 201:
+            logging.error(
+                layer['image'] + ':Failed to analyse layer ' + layer['id'])
+            return
+        self._add_submitted(layer['id'])
+
+    def _add_submitted(self, layer_id):
+        """
+        _add_submitted
+
+        :param layer_id str: A layer Clair has (it took or gave it)
+        """
+        self.submitted.add(layer_id)
+        if self.layer_cache is not None and not self._clair_layer_saved:
+            self.layer_cache.set_clair_layer(layer_id)
+            self._clair_layer_saved = True
+
+    def check_layer_cache(self):
+        """
+        check_layer_cache
+
+        A cached layer is taken to be in Clair, so it is never sent again.
+            That is only true while Clair keeps its DB: a Clair whose DB was
+            reset (e.g. clair-runner's postgres has no volume) has lost the
+            layers, and their children would fail to be sent. So check that
+            Clair still has a layer it had when the cache was filled, and
+            empty the cache if it doesn't.
+        """
+        if self.layer_cache is None:
+            return
+        layer_id = self.layer_cache.get_clair_layer()
+        if layer_id is None:
+            return
+        r = self.session.get('/v1/layers/' + layer_id, 'GET /v1/layers')
+        if r.status_code == 404:
+            print('Clair no longer has the cached layers, emptying the'
+                  ' layer cache')
+            self.layer_cache.clear()
+
+    @contextlib.contextmanager
+    def _clair_layer(self, layer):
+        """
+        _clair_layer
+
+        :param layer dict: The layer being submitted
+        :return: A context manager giving the body of the POST for the
+            layer. With a layer server, a layer on disk is only served until
+            the context is left.
+        """
         clair_layer = {
             'Layer': {
                 'Name': layer['id'],
@@ -83,90 +228,421 @@ class Clair:
                 'Format': 'Docker'
             }
         }
-        r = requests.post(self.cfg['clair.host']+'/v1/layers',
-                          data=json.dumps(clair_layer))
-        if r.status_code != 201:
-            logging.error(
-                layer['image'] + ':Failed to analyse layer ' + layer['id'])
+        # Layers in a registry need auth headers for Clair to download them
+        if layer.get('headers') is not None:
+            clair_layer['Layer']['Headers'] = layer['headers']()
+        if self.layer_server is None or '://' in layer['path']:
+            yield clair_layer
+            return
+        url = self.layer_server.url_for(layer['path'])
+        clair_layer['Layer']['Path'] = url
+        try:
+            yield clair_layer
+        finally:
+            self.layer_server.forget(url)
 
     def analyse(self, docker_image):
         """
         analyse
 
-        Analyse a docker image by saving it locally and telling clair to check
-            it. Currently this only works if Clair is running on the same
-            machine as the script is run on.
+        Analyse a docker image by streaming it out of docker and telling clair
+            to check it. Each layer is sent to Clair as soon as it and its
+            parent are on disk, and layers Clair already knows about are never
+            written out. The scheduler submits them alongside the layers of
+            the other images being scanned. Unless there is a layer server,
+            Clair must be running on the same machine as the script.
 
         :param docker_image docker.Image: The docker Image object to analyse
         :return: The layers in this image that were analysed
         """
         image = docker_image.id
-        (image_tar, tmp_path) = tempfile.mkstemp(suffix="-bioshadock-image")
-
-        # Make tar of docker image
-        file_tar = open(tmp_path, 'wb')
-        for data in docker_image.save():
-            file_tar.write(data)
-        file_tar.close()
-
-        # Untar the image
-        tmp_dir = tempfile.mkdtemp(suffix='-bioshadock-image-archive')
-        image_archive = tarfile.TarFile(name=tmp_path)
-        image_archive.extractall(path=tmp_dir)
-        image_archive.close()
-
-        # Read the layer manifest to create all of the layer dicts for API
-        # calls
+        if self.cancelled:
+            raise CancelledError()
+        # Skip the export entirely if every layer's result is still cached,
+        # or every layer is already in Clair
+        cached_layers = (self._get_cached_layers(image) or
+                         self._get_chain_layers(docker_image))
+        if cached_layers is not None:
+            registry.inc('docker_scan_exports_skipped_total')
+            return cached_layers
+        # Clair downloads the layers of a registry image itself
+        if isinstance(docker_image, RegistryImage):
+            return self._analyse_registry_image(docker_image)
+
+        scratch_dir = self.scratch_space.export(_image_size(docker_image))
+        # The submissions of this image's layers
+        futures = []
+        try:
+            # Cancelled while waiting for room
+            if self.cancelled:
+                raise CancelledError()
+            export = ImageExport(docker_image, scratch_dir, self._is_known)
+            order = _LayerOrder(image, self._is_known)
+            for layer_id, parent, path in export.iter_layers():
+                # Don't read the rest of the stream for nothing
+                if self.cancelled:
+                    raise CancelledError()
+                for layer in order.add(layer_id, parent, path):
+                    futures.append(self._schedule(layer, scratch_dir))
+            scratch_dir.done_writing()
+
+            layers = self._manifest_layers(export.manifest, scratch_dir.path,
+                                           image)
+            for layer in order.finish(layers):
+                futures.append(self._schedule(layer, scratch_dir))
+            # Raises the first error from submitting a layer
+            for future in futures:
+                future.result()
+            self._put_chain_layers(docker_image, layers)
+            if self.layer_cache is not None:
+                self.layer_cache.put_image_layers(
+                                image, [layer['id'] for layer in layers])
+        finally:
+            # Don't remove the layers while Clair may still be reading them
+            wait(futures)
+            # Get rid of the tmp stuff
+            scratch_dir.close()
+        return layers
+
+    def _schedule(self, layer, scratch_dir):
+        """
+        _schedule
+
+        :param layer dict: The layer to submit
+        :param scratch_dir ScratchDir: Where the layer was written
+        :return: The Future of the layer's submission. The layer's file is
+            deleted once it is done, as Clair has read it by then.
+        """
+        future = self.scheduler.schedule(layer)
+        future.add_done_callback(
+                    lambda _: scratch_dir.release(layer['path']))
+        return future
+
+    def _analyse_registry_image(self, registry_image):
+        """
+        _analyse_registry_image
+
+        Tell Clair to download and analyse each layer of an image from its
+            registry, parent first
+
+        :param registry_image RegistryImage: The image to analyse
+        :return: The layers in this image that were analysed
+        """
+        layers = registry_image.get_layers()
+        futures = [self.scheduler.schedule(layer) for layer in layers
+                   if not self._is_known(layer['id'])]
+        for future in futures:
+            future.result()
+        if self.layer_cache is not None:
+            self.layer_cache.put_image_layers(
+                    registry_image.id, [layer['id'] for layer in layers])
+        return layers
+
+    def _manifest_layers(self, manifest, tmp_dir, image):
+        """
+        _manifest_layers
+
+        Read the layer manifest to create all of the layer dicts for API
+            calls
+
+        :param manifest list: The manifest.json from the docker save
+        :param tmp_dir str: The folder the layers were written to
+        :param image str: The id of the docker image
+        :return: The layer dicts, bottom layer first
+        """
+        logging.debug(str(manifest))
         layers = []
-        with open(os.path.join(tmp_dir, 'manifest.json'), 'r') as content_file:
-            content = content_file.read()
-            manifest = json.loads(content)
-            logging.debug(str(manifest))
-            parent_layer = ""
-            for layer in manifest[0]['Layers']:
-                layers.append({'id': layer.replace('/layer.tar', ''),
-                               'path': os.path.join(tmp_dir, layer),
-                               'parent': parent_layer,
-                               'image': image
-                               })
-                parent_layer = layer.replace('/layer.tar', '')
-
-        # Tell clair to analyse the layers
-        for layer in layers:
-            # Don't do the analyse if it already has been analysed
-            # (minimize API calls)
-            if layer['id'] not in self.already_analysed:
-                self.analyse_layer(layer)
+        parent_layer = ""
+        for layer in manifest[0]['Layers']:
+            layers.append({'id': layer.replace('/layer.tar', ''),
+                           'path': os.path.join(tmp_dir, layer),
+                           'parent': parent_layer,
+                           'image': image
+                           })
+            parent_layer = layer.replace('/layer.tar', '')
+        return layers
 
-        # Get rid of the tmp stuff
-        os.remove(tmp_path)
-        shutil.rmtree(tmp_dir)
+    def _get_cached_layers(self, image):
+        """
+        _get_cached_layers
+
+        :param image str: The id of the docker image
+        :return: The layer dicts for the image if the layer cache has a
+            result for every one of its layers, otherwise None
+        """
+        if self.layer_cache is None:
+            return None
+        layer_ids = self.layer_cache.get_image_layers(image)
+        if layer_ids is None:
+            return None
+        return self._known_layers(layer_ids, image)
+
+    def _get_chain_layers(self, docker_image):
+        """
+        _get_chain_layers
+
+        Look up the layers of an image by the chain ids in its RootFS, which
+            docker has without exporting anything. A chain id that was
+            analysed as part of another image is the same content, so it is
+            used under the name it was analysed as. That may be another
+            image's top layer, when two images only differ in their config.
+
+        :param docker_image docker.Image: The docker Image object
+        :return: The layer dicts for the image if Clair already has every
+            one of its layers, otherwise None
+        """
+        chain_ids = get_chain_ids(docker_image)
+        if chain_ids is None:
+            return None
+        layer_ids = []
+        for chain_id in chain_ids:
+            layer_id = self.chain_layers.get(chain_id)
+            if layer_id is None and self.layer_cache is not None:
+                layer_id = self.layer_cache.get_chain_layer(chain_id)
+                if layer_id is not None:
+                    self.chain_layers[chain_id] = layer_id
+            if layer_id is None:
+                return None
+            layer_ids.append(layer_id)
+        layers = self._known_layers(layer_ids, docker_image.id)
+        if layers is not None and self.layer_cache is not None:
+            self.layer_cache.put_image_layers(docker_image.id, layer_ids)
+        return layers
+
+    def _put_chain_layers(self, docker_image, layers):
+        """
+        _put_chain_layers
+
+        Remember what each of an image's chain ids was analysed as. The
+            layers in the save manifest are the layers in the RootFS, in the
+            same order.
+
+        :param docker_image docker.Image: The docker Image object
+        :param layers list: The layer dicts from the manifest
+        """
+        chain_ids = get_chain_ids(docker_image)
+        if chain_ids is None or len(chain_ids) != len(layers):
+            return
+        chain_layers = []
+        for chain_id, layer in zip(chain_ids, layers):
+            # The first name stays, so every image uses the same one
+            if self.chain_layers.get(chain_id) is None:
+                self.chain_layers[chain_id] = layer['id']
+                chain_layers.append((chain_id, layer['id']))
+        if chain_layers and self.layer_cache is not None:
+            self.layer_cache.put_chain_layers(chain_layers)
+
+    def _known_layers(self, layer_ids, image):
+        """
+        _known_layers
+
+        :param layer_ids list: The layer ids of an image, bottom layer first
+        :param image str: The id of the docker image
+        :return: The layer dicts for the layers if Clair has every one of
+            them, otherwise None
+        """
+        # Clair only takes a layer once it has its parent, so having the top
+        # layer means it has all of them. In image query mode only the top
+        # layer's result is kept.
+        if not self._is_known(layer_ids[-1]):
+            return None
+        layers = []
+        parent_layer = ""
+        for layer_id in layer_ids:
+            layers.append({'id': layer_id,
+                           'path': None,
+                           'parent': parent_layer,
+                           'image': image
+                           })
+            parent_layer = layer_id
         return layers
 
+    def _is_known(self, layer_id):
+        """
+        _is_known
+
+        :param layer_id str: The layer to check
+        :return: True if Clair already has this layer
+        """
+        if layer_id in self.already_analysed or layer_id in self.submitted:
+            return True
+        return (self.layer_cache is not None and
+                self.layer_cache.has_layer(layer_id))
+
+    def _submit_layer(self, layer):
+        """
+        _submit_layer
+
+        Send a layer to Clair unless it has already been analysed (minimize
+            API calls). The lock makes another image sharing this layer wait
+            for the POST instead of sending it again.
+
+        :param layer dict: The dict of info for the API call
+        """
+        with self._layer_lock(layer['id']):
+            if not self._is_known(layer['id']):
+                self.analyse_layer(layer)
+
     def get_layers_vulnerabilities(self, layer_ids):
         """
         get_layers_vulnerabilities
 
-        :param layer_ids list: All of the layers to get vulns for
+        In the default image query mode, only the top layer is fetched from
+            Clair. Its response already has the features of every layer under
+            it, so it is split up by the layer that added each feature. The
+            split only holds for this image, as a layer above can upgrade or
+            remove a package a lower layer added, so only the top layer's
+            response is kept and it is split again for every image. Layer
+            query mode fetches every layer on its own.
+
+        :param layer_ids list: All of the layers to get vulns for, bottom
+            layer first
         :return: All of the vulnerabilites for a list of layers
         """
+        if self.cancelled:
+            raise CancelledError()
+        if self.cfg.get('clair.query_mode', 'image') == 'image':
+            top = self._get_layer_result(layer_ids[-1])
+            if top is not None:
+                split = self._split_vulnerabilities(top, layer_ids)
+                return [split[layer_id] for layer_id in layer_ids]
+            # Fall back to getting the layers one at a time
+
         vulnerabilities = []
         for layer_id in layer_ids:
-            # Check if this layer has been analysed already
-            if layer_id in self.already_analysed:
-                # Only add it to the list if it has a response
-                if self.already_analysed[layer_id] is not None:
-                    vulnerabilities.append(self.already_analysed[layer_id])
-                    continue
-            # If not, go grab it from clair
-            layer_vulnerabilities = self.get_layer_vulnerabilities(layer_id)
+            layer_vulnerabilities = self._get_layer_result(layer_id)
             # Don't add if there was an error
             if layer_vulnerabilities is not None:
                 vulnerabilities.append(layer_vulnerabilities)
-            # Add it to the already_analysed dict
-            self.already_analysed[layer_id] = layer_vulnerabilities
         return vulnerabilities
 
+    def _get_layer_result(self, layer_id):
+        """
+        _get_layer_result
+
+        :param layer_id str: The layer to get the Clair response for
+        :return: The layer's response, from this run or an earlier one if
+            it was already fetched, or None if it couldn't be fetched
+        """
+        stored = self._get_stored_vulnerabilities(layer_id, count=True)
+        if stored is not None:
+            return stored
+        # The lock makes images scanned at the same time only fetch it once
+        with self._layer_lock(layer_id):
+            # Check if another image got this layer in the meantime
+            stored = self._get_stored_vulnerabilities(layer_id)
+            if stored is not None:
+                return stored
+            # If not, go grab it from clair
+            layer_vulnerabilities = self.get_layer_vulnerabilities(layer_id)
+            self._store_vulnerabilities(layer_id, layer_vulnerabilities)
+        return layer_vulnerabilities
+
+    def _get_stored_vulnerabilities(self, layer_id, count=False):
+        """
+        _get_stored_vulnerabilities
+
+        :param layer_id str: The layer to look up
+        :param count bool: Count the lookup in the cache metrics. Only the
+            first lookup for each layer of an image is, not the checks made
+            again under a lock.
+        :return: The vulnerabilities for the layer if this run or an earlier
+            one already got them, otherwise None
+        """
+        # Check if this layer has been analysed already
+        stored = self.already_analysed.get(layer_id)
+        if count:
+            registry.inc('docker_scan_cache_requests_total', cache='memory',
+                         result='miss' if stored is None else 'hit')
+        if stored is not None:
+            return stored
+        # Then check if an earlier run got it
+        if self.layer_cache is not None:
+            stored = self.layer_cache.get_layer(layer_id)
+            if count:
+                registry.inc('docker_scan_cache_requests_total', cache='disk',
+                             result='miss' if stored is None else 'hit')
+            if stored is not None:
+                self.already_analysed[layer_id] = stored
+        return stored
+
+    def _store_vulnerabilities(self, layer_id, vulnerabilities):
+        """
+        _store_vulnerabilities
+
+        :param layer_id str: The layer the vulnerabilities are for
+        :param vulnerabilities dict: The vulnerabilities, or None if they
+            couldn't be fetched
+        """
+        # Add it to the already_analysed dict
+        self.already_analysed[layer_id] = vulnerabilities
+        if vulnerabilities is None:
+            return
+        self._add_submitted(layer_id)
+        if self.layer_cache is not None:
+            self.layer_cache.put_layer(layer_id, vulnerabilities)
+
+    def forget_layers(self, layer_ids):
+        """
+        forget_layers
+
+        Throw away the vulnerability results kept for some layers, in
+            memory and in the layer cache, e.g. once Clair says they have a
+            new vulnerability. Clair still has the layers, so they aren't
+            sent again.
+
+        :param layer_ids set: The layers to forget the results of
+        """
+        for layer_id in layer_ids:
+            if self._is_known(layer_id):
+                self.submitted.add(layer_id)
+            self.already_analysed.pop(layer_id)
+        if self.layer_cache is not None:
+            self.layer_cache.delete_layers(layer_ids)
+
+    def forget_results(self, clair_db_version):
+        """
+        forget_results
+
+        Throw away every vulnerability result that is kept, in memory and in
+            the layer cache, after the Clair DB has been updated. Clair still
+            has the layers, so they aren't sent again.
+
+        :param clair_db_version str: The new Clair DB version
+        """
+        self.already_analysed.clear()
+        if self.layer_cache is not None:
+            self.layer_cache.set_clair_db_version(clair_db_version)
+
+    def _split_vulnerabilities(self, top, layer_ids):
+        """
+        _split_vulnerabilities
+
+        :param top dict: The vulnerabilities of the top layer, or None
+        :param layer_ids list: All of the layers in the image, bottom layer
+            first
+        :return: {layer_id:vulnerabilities} with each layer only holding the
+            features it added that are still in the image. Only good for
+            this image, so never stored under the layer ids.
+        """
+        if top is None:
+            return {}
+        top_layer = top['Layer']
+        split = {}
+        parent_layer = ""
+        for layer_id in layer_ids:
+            layer = dict(top_layer, Name=layer_id, ParentName=parent_layer)
+            if 'Features' in top_layer:
+                layer['Features'] = []
+            split[layer_id] = {'Layer': layer}
+            parent_layer = layer_id
+        for feature in top_layer.get('Features', []):
+            # Features without AddedBy are kept with the top layer
+            added_by = feature.get('AddedBy', layer_ids[-1])
+            if added_by in split:
+                split[added_by]['Layer']['Features'].append(feature)
+        return split
+
     def get_layer_vulnerabilities(self, layer_id):
         """
         get_layer_vulnerabilities
@@ -180,12 +656,50 @@ class Clair:
         '''
         GET http://localhost:6060/v1/layers/17675ec01494d651e1ccf81dc9cf63959ebfeed4f978fddb1666b6ead008ed52?features&vulnerabilities
         '''
-        r = requests.get(self.cfg['clair.host']+'/v1/layers/'+layer_id+'?features&vulnerabilities')
+        with registry.time('docker_scan_stage_seconds', stage='fetch'):
+            r = self.session.get(
+                    '/v1/layers/'+layer_id+'?features&vulnerabilities',
+                    'GET /v1/layers')
         if r.status_code != 200:
             logging.error('Could not get info on layer '+layer_id)
             return None
         return r.json()
 
+    def get_notification_layers(self, notification):
+        """
+        get_notification_layers
+
+        Read a notification from Clair's notifier, every page of it, and
+            mark it as read
+
+        :param notification str: The name of the notification
+        :return: The set of layers that introduce the vulnerability the
+            notification is about, before or after the update, or None if it
+            couldn't be read
+        """
+
+        '''
+        GET http://localhost:6060/v1/notifications/ec45ec87-bfc8-4129-a1c3-d2b82622175a?limit=100&page=<NextPage>
+        '''
+        path = '/v1/notifications/' + quote(notification, safe='')
+        layers = set()
+        params = {'limit': 100}
+        while True:
+            r = self.session.get(path, 'GET /v1/notifications',
+                                 params=params)
+            if r.status_code != 200:
+                logging.error('Could not get notification ' + notification)
+                return None
+            body = r.json()['Notification']
+            for change in ('Old', 'New'):
+                layers.update((body.get(change) or {}).get(
+                                'LayersIntroducingVulnerability') or [])
+            if not body.get('NextPage'):
+                break
+            params['page'] = body['NextPage']
+        self.session.request('DELETE', path, 'DELETE /v1/notifications')
+        return layers
+
     def ping(self):
         """
         ping
@@ -194,6 +708,79 @@ class Clair:
 
         :raises: Exception if ping fails
         """
-        r = requests.get(self.cfg['clair.host']+'/v1/namespaces')
+        r = self.session.get('/v1/namespaces', 'GET /v1/namespaces')
         if r.status_code != 200:
             raise Exception()
+
+
+def _image_size(docker_image):
+    """
+    _image_size
+
+    :param docker_image docker.Image: The docker Image object
+    :return: The size docker gives for the image, 0 if it doesn't
+    """
+    return getattr(docker_image, 'attrs', {}).get('Size') or 0
+
+
+class _LayerOrder:
+    """
+    _LayerOrder
+
+    A class to put an image's layers in an order Clair can take them in,
+    as they come out of the save stream. Clair needs the parent before the
+    child, so a layer is held back until its parent has been released.
+    """
+    def __init__(self, image, is_known):
+        """
+        __init__
+
+        :param image str: The id of the docker image
+        :param is_known function: Called with a layer id, returns True if
+            Clair already has that layer
+        """
+        self.image = image
+        self.is_known = is_known
+        self.ready = set()  # Layers that are known or released
+        self._waiting = {}  # {parent_id:[(layer_id, parent_id, path)]}
+
+    def add(self, layer_id, parent, path):
+        """
+        add
+
+        :param layer_id str: The layer that came out of the stream
+        :param parent str: The layer's parent, '' for the bottom layer
+        :param path str: Where the layer was written, None if it was skipped
+        :return: The layer dicts that can be submitted now, in order
+        """
+        if (path is None or parent == '' or parent in self.ready or
+                self.is_known(parent)):
+            released = []
+            self._release(layer_id, parent, path, released)
+            return released
+        self._waiting.setdefault(parent, []).append((layer_id, parent, path))
+        return []
+
+    def _release(self, layer_id, parent, path, released):
+        if path is not None:
+            released.append({'id': layer_id, 'path': path, 'parent': parent,
+                             'image': self.image})
+        self.ready.add(layer_id)
+        for child in self._waiting.pop(layer_id, []):
+            self._release(*child, released)
+
+    def finish(self, layers):
+        """
+        finish
+
+        :param layers list: Every layer dict from the manifest, in order
+        :return: The layers the stream couldn't place that are on disk, in
+            manifest order
+        """
+        released = []
+        for layer in layers:
+            if layer['id'] not in self.ready and os.path.exists(layer['path']):
+                released.append(layer)
+                self.ready.add(layer['id'])
+        return released
+
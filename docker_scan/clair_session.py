@@ -0,0 +1,170 @@
+import time
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import registry
+
+
+class ClairSession:
+    """
+    ClairSession
+
+    A class to make HTTP calls to the Clair API over pooled keep-alive
+    connections. Calls time out, 5xx responses and connection errors are
+    retried with backoff, and the latency of every call is counted per
+    endpoint. One ClairSession can be shared by any number of threads. A
+    POST that times out or is cut off while waiting for the response isn't
+    retried, see _ClairRetry.
+    """
+    # Statuses worth retrying, Clair or its DB being briefly unavailable
+    retry_statuses = (500, 502, 503, 504)
+
+    def __init__(self, host, connect_timeout=10, read_timeout=900,
+                 retries=3, backoff=0.5, pool_size=10):
+        """
+        __init__
+
+        :param host str: The Clair API base url (e.g. http://localhost:6060)
+        :param connect_timeout float: Seconds to wait for a connection
+        :param read_timeout float: Seconds to wait for a response. Clair
+            reads the whole layer before answering a POST, so this is long.
+        :param retries int: How many times to retry a failed call
+        :param backoff float: The backoff factor between retries (0.5 waits
+            0.5s, 1s, 2s, ...)
+        :param pool_size int: How many connections to keep open to Clair
+        """
+        self.host = host
+        self.timeout = (connect_timeout, read_timeout)
+        # The adapter holds the connection pool and is thread safe, so every
+        # thread's session shares it
+        self._adapter = HTTPAdapter(pool_connections=1,
+                                    pool_maxsize=pool_size,
+                                    max_retries=_make_retry(
+                                        retries, backoff,
+                                        self.retry_statuses),
+                                    pool_block=True)
+        self._local = threading.local()
+        self._latencies = {}  # {endpoint:{'count','total','max'}}
+        self._latencies_lock = threading.Lock()
+
+    def _get_session(self):
+        """
+        _get_session
+
+        :return: This thread's requests.Session
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self._adapter)
+            session.mount('https://', self._adapter)
+            self._local.session = session
+        return session
+
+    def get(self, path, endpoint, **kwargs):
+        """
+        get
+
+        :param path str: The path on the Clair host (e.g. /v1/namespaces)
+        :param endpoint str: The name to count the latency under
+        :return: The requests.Response
+        """
+        return self.request('GET', path, endpoint, **kwargs)
+
+    def post(self, path, endpoint, **kwargs):
+        """
+        post
+
+        :param path str: The path on the Clair host (e.g. /v1/layers)
+        :param endpoint str: The name to count the latency under
+        :return: The requests.Response
+        """
+        return self.request('POST', path, endpoint, **kwargs)
+
+    def request(self, method, path, endpoint, **kwargs):
+        """
+        request
+
+        :param method str: The HTTP method
+        :param path str: The path on the Clair host
+        :param endpoint str: The name to count the latency under
+        :return: The requests.Response
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.monotonic()
+        try:
+            return self._get_session().request(method, self.host + path,
+                                               **kwargs)
+        finally:
+            self.record_latency(endpoint, time.monotonic() - start)
+
+    def record_latency(self, endpoint, seconds):
+        """
+        record_latency
+
+        :param endpoint str: The endpoint that was called
+        :param seconds float: How long the call took, retries included
+        """
+        registry.observe('docker_scan_clair_request_seconds', seconds,
+                         endpoint=endpoint)
+        with self._latencies_lock:
+            latency = self._latencies.setdefault(
+                            endpoint, {'count': 0, 'total': 0.0, 'max': 0.0})
+            latency['count'] += 1
+            latency['total'] += seconds
+            latency['max'] = max(latency['max'], seconds)
+
+    def get_latencies(self):
+        """
+        get_latencies
+
+        :return: {endpoint:{'count', 'total', 'max', 'mean'}} with the times
+            in seconds
+        """
+        with self._latencies_lock:
+            latencies = {}
+            for endpoint, latency in self._latencies.items():
+                latencies[endpoint] = dict(latency)
+                latencies[endpoint]['mean'] = (latency['total'] /
+                                               latency['count'])
+            return latencies
+
+
+class _ClairRetry(Retry):
+    """
+    _ClairRetry
+
+    A Retry that retries every method on connection errors and 5xx
+    responses, but only retries read errors for the methods that aren't
+    POST. A layer POST can wait on Clair for the whole read timeout, so
+    retrying one that timed out would hold its thread for that long again,
+    for a call that is likely still running in Clair.
+    """
+    def increment(self, method=None, url=None, response=None, error=None,
+                  _pool=None, _stacktrace=None):
+        if method == 'POST' and error is not None and \
+                self._is_read_error(error):
+            raise error.with_traceback(_stacktrace)
+        return super().increment(method, url, response, error, _pool,
+                                 _stacktrace)
+
+
+def _make_retry(retries, backoff, statuses):
+    """
+    _make_retry
+
+    :return: A urllib3 Retry that retries every method, including the layer
+        POSTs (Clair skips a layer it has already indexed), except for POST
+        read errors
+    """
+    kwargs = {'total': retries, 'connect': retries, 'read': retries,
+              'status': retries, 'backoff_factor': backoff,
+              'status_forcelist': statuses, 'raise_on_status': False}
+    try:
+        return _ClairRetry(allowed_methods=None, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26 calls it method_whitelist
+        return _ClairRetry(method_whitelist=False, **kwargs)
@@ -1,5 +1,10 @@
+import time
+import threading
+
 import docker
 
+from image_set import ImageSet
+
 
 class DockerHelper:
     """
@@ -20,16 +25,31 @@ class DockerHelper:
         """
         self.docker_cli = docker.DockerClient(base_url=docker_connect,
                                               timeout=1800)
+        # What get_image_obj_from_id had to pull {'count', 'bytes',
+        # 'seconds'}, seconds being the time spent in each pull added up
+        self.pull_stats = {'count': 0, 'bytes': 0, 'seconds': 0.0}
+        self._pull_stats_lock = threading.Lock()
 
     def get_container_images(self):
         """
         get_container_images
 
-        :return: A list of image objects from the Docker library
+        Get the image of every running container. Containers running the
+        same image only add that image once.
+
+        :return: An ImageSet of image objects from the Docker library, with
+            the containers using each image as its consumers
         """
-        images = []
-        for container in self.docker_cli.containers.list():
-            images.append(container.image)
+        images = ImageSet()
+        image_objs = {}  # {image_id:docker.Image}
+        # sparse skips inspecting every container, the list has all we need
+        for container in self.docker_cli.containers.list(sparse=True):
+            image_id = container.attrs.get('ImageID',
+                                           container.attrs.get('Image'))
+            if image_id not in image_objs:
+                image_objs[image_id] = self.docker_cli.images.get(image_id)
+            names = container.attrs.get('Names') or [container.id[:12]]
+            images.add(image_objs[image_id], names[0].lstrip('/'))
         return images
 
     def get_image_obj_from_id(self, image_id):
@@ -42,7 +62,15 @@ class DockerHelper:
         try:
             return self.docker_cli.images.get(image_id)
         except Exception:
-            return self.docker_cli.images.pull(image_id)
+            pass
+        start = time.monotonic()
+        image = self.docker_cli.images.pull(image_id)
+        with self._pull_stats_lock:
+            self.pull_stats['count'] += 1
+            self.pull_stats['bytes'] += getattr(image, 'attrs', {}).get(
+                                                                'Size', 0)
+            self.pull_stats['seconds'] += time.monotonic() - start
+        return image
 
     def ping(self):
         """
@@ -0,0 +1,332 @@
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from prettytable import PrettyTable
+
+from image_scan import _Vulnerability
+
+# Bumped when SCHEMA changes, so an index made by an older version is
+# rebuilt instead of used
+SCHEMA_VERSION = 3
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    consumers TEXT NOT NULL,
+    scanned REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS image_layers (
+    image_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    layer TEXT NOT NULL,
+    piece TEXT NOT NULL,
+    PRIMARY KEY (image_id, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS image_layers_layer ON image_layers (layer);
+CREATE INDEX IF NOT EXISTS image_layers_piece ON image_layers (piece);
+CREATE TABLE IF NOT EXISTS findings (
+    piece TEXT NOT NULL,
+    layer TEXT NOT NULL,
+    feature TEXT NOT NULL,
+    version TEXT NOT NULL,
+    vulnerability TEXT NOT NULL,
+    severity TEXT NOT NULL,
+    weight INTEGER NOT NULL,
+    PRIMARY KEY (piece, feature, version, vulnerability)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS findings_vulnerability
+    ON findings (vulnerability);
+CREATE TABLE IF NOT EXISTS vulnerabilities (
+    name TEXT PRIMARY KEY,
+    link TEXT,
+    description TEXT
+);
+'''
+DROP_SCHEMA = '''
+DROP TABLE IF EXISTS images;
+DROP TABLE IF EXISTS image_layers;
+DROP TABLE IF EXISTS findings;
+DROP TABLE IF EXISTS vulnerabilities;
+'''
+
+
+class FleetIndex:
+    """
+    FleetIndex
+
+    A class to index every scan into one SQLite database while scanning, so
+    questions about the whole fleet (which images have CVE-X, which layer
+    brings in the most High vulnerabilities) are a query instead of a grep
+    through every report. The index is:
+
+        vulnerability -> findings (feature, version, layer) -> layers ->
+            images
+
+    A layer's findings are only stored once, however many images share it
+    with the same findings. In image query mode a layer can have different
+    findings in different images (a package it added can be upgraded by a
+    layer above), so the findings are kept by piece: the layer plus a hash
+    of its findings. The same CVE can have a different severity in each
+    namespace, so the severity is kept on each finding rather than on the
+    vulnerability.
+    It is called like a report writer, and at close writes a summary
+    ranking vulnerabilities and layers by severity times blast radius (how
+    many images have them).
+    """
+    # Severity is ranked by _Vulnerability.sev_vals, plus one so that
+    # Negligible vulnerabilities still count for something
+    weights = {severity: value + 1
+               for severity, value in _Vulnerability.sev_vals.items()}
+
+    def __init__(self, path, summary_path, keep_unscanned=False):
+        """
+        __init__
+
+        Open the index, making it if it doesn't exist
+
+        :param path str: Where the database is kept
+        :param summary_path str: Where to write the fleet summary
+        :param keep_unscanned bool: Keep the images from earlier runs that
+            weren't scanned this run (e.g. in incremental mode, where they
+            haven't changed). Otherwise they are dropped at close.
+        """
+        self.path = path
+        self.summary_path = summary_path
+        self.keep_unscanned = keep_unscanned
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            # Made by an older version, the scans fill it in again
+            self._db.executescript(DROP_SCHEMA)
+            self._db.execute('PRAGMA user_version = {}'.format(
+                                SCHEMA_VERSION))
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._scanned = set()  # Image ids written this run
+        self._pieces = set()  # Pieces whose findings were written this run
+
+    def write(self, image_scan, name, consumers):
+        """
+        write
+
+        Index the results of scanning an image. Called like a report
+        writer's write.
+
+        :param image_scan ImageScan: The scanned image
+        :param name str: The image's print tag
+        :param consumers list: Everything that was found using the image
+        """
+        image_id = image_scan.image.id
+        layers = []  # [(layer, piece, findings)]
+        for layer_name, feature_objs in image_scan.get_vulnerabilites():
+            findings = self._get_findings(layer_name, feature_objs)
+            layers.append((layer_name, _piece(layer_name, findings),
+                           findings))
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO images VALUES'
+                             ' (?, ?, ?, ?)',
+                             (image_id, name, json.dumps(consumers),
+                              time.time()))
+            self._db.execute('DELETE FROM image_layers WHERE image_id = ?',
+                             (image_id,))
+            self._db.executemany(
+                    'INSERT INTO image_layers VALUES (?, ?, ?, ?)',
+                    [(image_id, position, layer_name, piece)
+                     for position, (layer_name, piece, _)
+                     in enumerate(layers)])
+            for layer_name, piece, findings in layers:
+                # Images sharing a layer mostly have the same findings in it
+                if piece in self._pieces:
+                    continue
+                self._pieces.add(piece)
+                self._write_piece(piece, findings)
+            self._scanned.add(image_id)
+
+    def reset(self):
+        """
+        reset
+
+        Forget which pieces' findings were written, so the next scan of each
+        writes them again (e.g. after the Clair DB was updated)
+        """
+        with self._lock:
+            self._pieces.clear()
+
+    def _get_findings(self, layer_name, feature_objs):
+        """
+        _get_findings
+
+        :param layer_name str: The layer
+        :param feature_objs list: The layer's _Feature objects
+        :return: A sorted list of (layer, feature, version, vulnerability,
+            severity, weight, link, description) for each of the layer's
+            vulnerabilities
+        """
+        return sorted(set(
+            (layer_name, feature_obj.name, feature_obj.version, vuln.name,
+             vuln.severity, self.weights.get(vuln.severity, 1), vuln.link,
+             vuln.description)
+            for feature_obj in feature_objs for vuln in feature_obj.vulns),
+            key=repr)
+
+    def _write_piece(self, piece, findings):
+        """
+        _write_piece
+
+        Replace the findings of a piece, in case the Clair DB has changed
+        since it was last indexed
+
+        :param piece str: The layer and the hash of its findings
+        :param findings list: The tuples from _get_findings
+        """
+        self._db.execute('DELETE FROM findings WHERE piece = ?', (piece,))
+        self._db.executemany('INSERT OR IGNORE INTO findings VALUES'
+                             ' (?, ?, ?, ?, ?, ?, ?)',
+                             [(piece,) + finding[:6] for finding in findings])
+        self._db.executemany('INSERT OR REPLACE INTO vulnerabilities VALUES'
+                             ' (?, ?, ?)',
+                             {finding[3]: (finding[3],) + finding[6:]
+                              for finding in findings}.values())
+
+    def get_affected_images(self, vulnerability):
+        """
+        get_affected_images
+
+        :param vulnerability str: The vulnerability (e.g. CVE-2018-1000001)
+        :return: A list of (image name, layer, feature, version) for every
+            image that has it
+        """
+        with self._lock:
+            return self._db.execute(
+                'SELECT i.name, f.layer, f.feature, f.version'
+                ' FROM findings f'
+                ' JOIN image_layers il ON il.piece = f.piece'
+                ' JOIN images i ON i.id = il.image_id'
+                ' WHERE f.vulnerability = ?'
+                ' ORDER BY i.name, il.position', (vulnerability,)).fetchall()
+
+    def get_layer_images(self, layer):
+        """
+        get_layer_images
+
+        :param layer str: The layer
+        :return: The names of every image with the layer
+        """
+        with self._lock:
+            return [row[0] for row in self._db.execute(
+                'SELECT i.name FROM image_layers il'
+                ' JOIN images i ON i.id = il.image_id'
+                ' WHERE il.layer = ? ORDER BY i.name', (layer,))]
+
+    def rank_vulnerabilities(self, limit=50):
+        """
+        rank_vulnerabilities
+
+        :param limit int: How many to give back
+        :return: A list of (vulnerability, severity, images, layers, score)
+            with the highest severity times images first. A vulnerability
+            with a different severity in different namespaces has a row for
+            each.
+        """
+        with self._lock:
+            return self._db.execute(
+                'SELECT f.vulnerability, f.severity,'
+                ' COUNT(DISTINCT il.image_id), COUNT(DISTINCT f.layer),'
+                ' MAX(f.weight) * COUNT(DISTINCT il.image_id) AS score'
+                ' FROM findings f'
+                ' JOIN image_layers il ON il.piece = f.piece'
+                ' GROUP BY f.vulnerability, f.severity'
+                ' ORDER BY score DESC, f.vulnerability, f.severity'
+                ' LIMIT ?', (limit,)).fetchall()
+
+    def rank_layers(self, limit=20):
+        """
+        rank_layers
+
+        :param limit int: How many to give back
+        :return: A list of (layer, an image with it, images, vulnerabilities,
+            High or Unknown vulnerabilities, score) with the highest sum of
+            the severities times images first. A layer with different
+            findings in different images has a row for each.
+        """
+        with self._lock:
+            return self._db.execute(
+                'SELECT f.layer, MIN(i.name), l.images, COUNT(*),'
+                " SUM(f.severity IN ('High', 'Unknown')),"
+                ' SUM(f.weight) * l.images AS score'
+                ' FROM findings f'
+                ' JOIN (SELECT piece, COUNT(DISTINCT image_id) AS images,'
+                '       MIN(image_id) AS image_id'
+                '       FROM image_layers GROUP BY piece) l'
+                '   ON l.piece = f.piece'
+                ' JOIN images i ON i.id = l.image_id'
+                ' GROUP BY f.piece'
+                ' ORDER BY score DESC, f.layer LIMIT ?', (limit,)).fetchall()
+
+    def close(self):
+        """
+        close
+
+        Drop the images that are gone, write the fleet summary and close
+        the index
+        """
+        with self._lock, self._db:
+            if not self.keep_unscanned:
+                stale = [(row[0],) for row in self._db.execute(
+                            'SELECT id FROM images')
+                         if row[0] not in self._scanned]
+                self._db.executemany('DELETE FROM images WHERE id = ?',
+                                     stale)
+                self._db.executemany(
+                    'DELETE FROM image_layers WHERE image_id = ?', stale)
+            # Nothing uses these anymore
+            self._db.execute('DELETE FROM findings WHERE piece NOT IN'
+                             ' (SELECT piece FROM image_layers)')
+            self._db.execute('DELETE FROM vulnerabilities WHERE name NOT IN'
+                             ' (SELECT vulnerability FROM findings)')
+        self.write_summary()
+        self._db.close()
+
+    def write_summary(self):
+        """
+        write_summary
+
+        Write the most widespread and severe vulnerabilities and layers of
+        the fleet to summary_path
+        """
+        with self._lock:
+            images, layers = self._db.execute(
+                'SELECT COUNT(DISTINCT image_id), COUNT(DISTINCT layer)'
+                ' FROM image_layers').fetchone()
+        vulnerabilities = PrettyTable(['Vulnerability', 'Severity', 'Images',
+                                       'Layers', 'Score'])
+        for row in self.rank_vulnerabilities():
+            vulnerabilities.add_row(row)
+        layer_table = PrettyTable(['Layer', 'Example image', 'Images',
+                                   'Vulnerabilities', 'High/Unknown',
+                                   'Score'])
+        for row in self.rank_layers():
+            layer_table.add_row(row)
+        with open(self.summary_path, 'w') as f:
+            f.write('{} images, {} layers\n\n'.format(images, layers))
+            f.write('Vulnerabilities by severity x images affected:\n')
+            f.write(str(vulnerabilities) + '\n\n')
+            f.write('Layers by severity x images using them:\n')
+            f.write(str(layer_table) + '\n')
+
+
+def _piece(layer_name, findings):
+    """
+    _piece
+
+    :param layer_name str: The layer
+    :param findings list: The layer's findings from FleetIndex._get_findings
+    :return: The layer plus a hash of its findings, the same for every
+        image that has the layer with the same findings
+    """
+    digest = hashlib.sha1(json.dumps(findings).encode('utf-8')).hexdigest()
+    return layer_name + ':' + digest[:16]
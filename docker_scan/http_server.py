@@ -0,0 +1,13 @@
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    ThreadingHTTPServer
+
+    An HTTPServer that handles each request on its own thread, so a slow
+    client doesn't hold up the others. The threads don't keep the process
+    running when it exits.
+    """
+    daemon_threads = True
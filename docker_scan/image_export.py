@@ -0,0 +1,191 @@
+import io
+import os
+import json
+import hashlib
+import shutil
+import time
+import tarfile
+
+from metrics import registry
+
+
+class ImageExport:
+    """
+    ImageExport
+
+    A class to stream a `docker save` of an image and pull out only the
+    layers that are still needed. The save stream is read exactly once, so
+    the image is never written to disk as a whole.
+    """
+    # How much of the save stream to buffer between tar reads
+    read_buffer_size = 1024 * 1024
+
+    def __init__(self, docker_image, scratch_dir, skip_layer):
+        """
+        __init__
+
+        :param docker_image docker.Image: The docker Image object to export
+        :param scratch_dir scratch_space.ScratchDir: The folder to write the
+            layer tars into
+        :param skip_layer function: Called with a layer id, returns True if
+            that layer doesn't need to be written to disk
+        """
+        self.docker_image = docker_image
+        self.scratch_dir = scratch_dir
+        self.skip_layer = skip_layer
+        self.manifest = None
+        self._reader = None
+
+    def iter_layers(self):
+        """
+        iter_layers
+
+        Read through the save stream, yielding each layer as soon as both its
+        layer.tar and its json (which holds the parent id) have gone by.
+        self.manifest is set once the generator is exhausted.
+
+        :return: A generator of (layer_id, parent_id, path) tuples. path is
+            None if the layer was skipped.
+        """
+        parents = {}  # {layer_id:parent_id}
+        paths = {}  # {layer_id:path or None}
+        self._reader = _ChunkReader(self.docker_image.save())
+        stream = io.BufferedReader(self._reader,
+                                   buffer_size=self.read_buffer_size)
+        try:
+            yield from self._iter_members(stream, parents, paths)
+        finally:
+            # Stops docker's stream if the generator was closed early
+            self._reader.close()
+            # Only the time spent waiting on docker, not on the submits
+            # between the layers
+            registry.observe('docker_scan_stage_seconds', self._reader.seconds,
+                             stage='export')
+            registry.inc('docker_scan_exported_bytes_total',
+                         self._reader.bytes_read)
+        if self.manifest is None:
+            raise ValueError('No manifest.json in the save of image ' +
+                             self.docker_image.id)
+
+    def _iter_members(self, stream, parents, paths):
+        with tarfile.open(fileobj=stream, mode='r|') as archive:
+            for member in archive:
+                if member.name == 'manifest.json':
+                    self.manifest = json.loads(
+                        archive.extractfile(member).read().decode('utf-8'))
+                    continue
+                layer_id, _, filename = member.name.partition('/')
+                if filename == 'json':
+                    layer_json = json.loads(
+                        archive.extractfile(member).read().decode('utf-8'))
+                    parents[layer_id] = layer_json.get('parent', '')
+                elif filename == 'layer.tar':
+                    paths[layer_id] = self._write_layer(archive, member,
+                                                        layer_id)
+                else:
+                    continue
+                if layer_id in parents and layer_id in paths:
+                    yield (layer_id, parents[layer_id], paths[layer_id])
+
+    def _write_layer(self, archive, member, layer_id):
+        """
+        _write_layer
+
+        :param archive tarfile.TarFile: The save stream being read
+        :param member tarfile.TarInfo: The layer.tar member
+        :param layer_id str: The id of the layer
+        :return: Where the layer was written to, or None if it was skipped
+        """
+        if self.skip_layer(layer_id):
+            return None
+        layer_dir = os.path.join(self.scratch_dir.path, layer_id)
+        os.makedirs(layer_dir, exist_ok=True)
+        path = os.path.join(layer_dir, 'layer.tar')
+        self.scratch_dir.add(path, member.size)
+        start = time.monotonic()
+        waited = self._reader.seconds
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(archive.extractfile(member), f)
+        # Less the time spent waiting on docker, which is the export's
+        registry.observe('docker_scan_stage_seconds',
+                         time.monotonic() - start -
+                         (self._reader.seconds - waited), stage='extract')
+        registry.inc('docker_scan_extracted_bytes_total', member.size)
+        return path
+
+
+class _ChunkReader(io.RawIOBase):
+    """
+    _ChunkReader
+
+    A read-only file object over the chunks from a generator, so tarfile can
+    read `docker save` output without it being written to disk first
+    """
+    def __init__(self, chunks):
+        """
+        __init__
+
+        :param chunks iterable: The bytes chunks to read from
+        """
+        self._chunks = iter(chunks)
+        self._chunk = memoryview(b'')
+        self.bytes_read = 0
+        self.seconds = 0.0  # Spent waiting for the chunks
+
+    def readable(self):
+        return True
+
+    def close(self):
+        """
+        close
+
+        Close the chunks too, which stops the stream they come from
+        """
+        close = getattr(self._chunks, 'close', None)
+        if close is not None:
+            close()
+        super().close()
+
+    def readinto(self, buffer):
+        """
+        readinto
+
+        :param buffer bytearray: The buffer to fill
+        :return: How many bytes were read, 0 at the end of the stream
+        """
+        while not self._chunk:
+            start = time.monotonic()
+            try:
+                self._chunk = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+            finally:
+                self.seconds += time.monotonic() - start
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        self.bytes_read += size
+        return size
+
+
+def get_chain_ids(docker_image):
+    """
+    get_chain_ids
+
+    A layer's chain id is a hash of its content and the content of every
+    layer under it, so the same stack of layers has the same chain ids in
+    every image, whatever the image's config is.
+
+    :param docker_image docker.Image: The docker Image object
+    :return: The chain id of each layer, bottom layer first, from the
+        image's RootFS.Layers. None if docker didn't give them.
+    """
+    rootfs = getattr(docker_image, 'attrs', {}).get('RootFS', {})
+    diff_ids = rootfs.get('Layers')
+    if rootfs.get('Type') != 'layers' or not diff_ids:
+        return None
+    chain_ids = [diff_ids[0]]
+    for diff_id in diff_ids[1:]:
+        chain_ids.append('sha256:' + hashlib.sha256(
+            (chain_ids[-1] + ' ' + diff_id).encode('utf-8')).hexdigest())
+    return chain_ids
@@ -0,0 +1,222 @@
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from image_set import ImageSet
+
+
+class ImageResolver:
+    """
+    ImageResolver
+
+    A class to turn image references into image objects on a pool of
+    workers, so a long list of images isn't looked up (and maybe pulled) one
+    at a time before scanning can start. A reference is only resolved once,
+    however many consumers name it, even while it is still being resolved.
+
+    Iterating over the resolver gives each image as soon as it is resolved,
+    so it can be scanned while the rest are still being pulled. Like an
+    ImageSet, it gives the consumers of each image, but they are only
+    complete once the resolver is.
+    """
+    def __init__(self, resolve, workers=4, endless=False):
+        """
+        __init__
+
+        :param resolve function: Called with a reference, returns the image
+            object (e.g. DockerHelper.get_image_obj_from_id)
+        :param workers int: How many references to resolve at the same time
+        :param endless bool: References keep being added until the process
+            is stopped (e.g. by a watch), so images shouldn't wait for the
+            resolver to finish before being reported on
+        """
+        self.resolve = resolve
+        self.endless = endless
+        self.images = ImageSet()
+        self.failed = []  # References that couldn't be resolved
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._queue = queue.Queue()  # Newly resolved images, then None
+        self._lock = threading.Lock()
+        self._pending = {}  # {reference:[consumer]} being resolved
+        self._resolved = {}  # {reference:image or None if it failed}
+        self._outstanding = 0
+        self._closed = False
+        self._stopped = False
+        self._done = threading.Event()
+        self._started = None
+        self._finished = None
+
+    def start(self, produce):
+        """
+        start
+
+        Call produce on a background thread to add the references, and close
+        the resolver once it returns
+
+        :param produce function: Called with this resolver, calls add for
+            every reference
+        """
+        def run():
+            try:
+                produce(self)
+            except Exception as ex:
+                logging.error('Failed to list the images: ' + str(ex))
+            finally:
+                self.close()
+        threading.Thread(target=run, daemon=True).start()
+
+    def add(self, reference, consumer=None):
+        """
+        add
+
+        :param reference str: The image reference (tag, id or digest)
+        :param consumer str: What was using the image (e.g. a pod name)
+        """
+        with self._lock:
+            if self._stopped:
+                return
+            if self._started is None:
+                self._started = time.monotonic()
+            if reference in self._resolved:
+                image = self._resolved[reference]
+                if image is not None:
+                    self.images.add(image, consumer)
+                return
+            if reference in self._pending:
+                self._pending[reference].append(consumer)
+                return
+            self._pending[reference] = [consumer]
+            self._outstanding += 1
+        self._executor.submit(self._resolve, reference)
+
+    def add_image(self, image, consumer=None):
+        """
+        add_image
+
+        Add an image that doesn't need resolving (e.g. listed straight from
+        a docker server)
+
+        :param image docker.Image: The image
+        :param consumer str: What was using the image
+        """
+        with self._lock:
+            if self._stopped:
+                return
+            if self._started is None:
+                self._started = time.monotonic()
+            is_new = self.images.add(image, consumer)
+        if is_new:
+            self._queue.put(image)
+
+    def _resolve(self, reference):
+        image = None
+        # Don't pull what won't be scanned
+        if not self._stopped:
+            try:
+                image = self.resolve(reference)
+            except Exception as ex:
+                logging.error('Could not get image {}: {}'.format(reference,
+                                                                  ex))
+        is_new = False
+        with self._lock:
+            self._resolved[reference] = image
+            consumers = self._pending.pop(reference)
+            if image is None:
+                # A reference dropped by stop didn't fail
+                if not self._stopped:
+                    self.failed.append(reference)
+            elif not self._stopped:
+                for consumer in consumers:
+                    is_new = self.images.add(image, consumer) or is_new
+            self._outstanding -= 1
+            finished = self._closed and self._outstanding == 0
+        if is_new:
+            self._queue.put(image)
+        if finished:
+            self._finish()
+
+    def close(self):
+        """
+        close
+
+        Say that every reference has been added
+        """
+        with self._lock:
+            self._closed = True
+            finished = self._outstanding == 0
+        if finished:
+            self._finish()
+
+    def stop(self):
+        """
+        stop
+
+        Stop giving images (e.g. once a run has failed its policy). The
+        references that haven't been resolved yet are dropped, and
+        iterating ends straight away.
+        """
+        with self._lock:
+            self._stopped = True
+        self._queue.put(None)
+
+    def _finish(self):
+        self._finished = time.monotonic()
+        self._executor.shutdown(wait=False)
+        self._done.set()
+        self._queue.put(None)
+
+    @property
+    def complete(self):
+        """
+        :return: True once every reference has been resolved, so the
+            consumers of every image are known. Always True for an endless
+            resolver, which never is.
+        """
+        return self.endless or self._done.is_set()
+
+    def wait(self):
+        """
+        wait
+
+        Block until every reference has been resolved
+        """
+        self._done.wait()
+
+    def get_consumers(self, image):
+        """
+        get_consumers
+
+        :param image docker.Image: A resolved image
+        :return: The list of everything found using the image so far
+        """
+        return self.images.get_consumers(image)
+
+    def get_stats(self):
+        """
+        get_stats
+
+        :return: {'resolved', 'failed', 'seconds'}, seconds being how long
+            it took from the first reference to the last image
+        """
+        with self._lock:
+            seconds = 0.0
+            if self._started is not None:
+                seconds = (self._finished or time.monotonic()) - self._started
+            return {'resolved': len(self.images),
+                    'failed': len(self.failed),
+                    'seconds': seconds}
+
+    def __contains__(self, image_id):
+        return image_id in self.images
+
+    def __iter__(self):
+        """
+        :return: A generator of each image as it is resolved. Only one
+            iteration can be running at a time.
+        """
+        return iter(self._queue.get, None)
+
+    def __len__(self):
+        return len(self.images)
@@ -1,14 +1,26 @@
 import os
 from prettytable import PrettyTable
 
+from lru_cache import LRUCache
+from metrics import registry
+
 
 class ImageScan:
     """
     ImageScan
 
-    A class to hold an image and its vulnerabilites
+    A class to hold an image and its vulnerabilites. Only the features with
+    vulnerabilites are kept from Clair's response, so a scan can be held on
+    to (or queued to be written) without the raw json for every layer.
     """
-    def __init__(self, image, clair_obj):
+    # Rendered layer sections, shared by every image with that layer and the
+    # same features in it, so each is sorted and formatted once. The
+    # features are part of the key since in image query mode a lower layer's
+    # features depend on the layers above it (e.g. a package upgraded
+    # higher up). {(layer name, features, format):str}
+    layer_sections = LRUCache(256)
+
+    def __init__(self, image, clair_obj, vulnerabilites=None):
         """
         __init__
 
@@ -17,9 +29,15 @@ class ImageScan:
         :param image docker.Image: A docker Image object
         :param clair_obj clair.Clair: A Clair object to get the vulnerability
             objects from
+        :param vulnerabilites list: The vulnerabilites if they were already
+            fetched (e.g. by the async scan), in which case clair_obj isn't
+            used
         """
         self.image = image
-        self.vulnerabilites = self.__get_vulnerabilites(clair_obj)
+        if vulnerabilites is None:
+            vulnerabilites = self.__get_vulnerabilites(clair_obj)
+        self.vulnerabilites = self.__compact(vulnerabilites)
+        registry.inc('docker_scan_images_scanned_total')
 
     def get_vulnerabilites(self):
         """
@@ -27,7 +45,8 @@ class ImageScan:
 
         Method to return the vulnerabilites
 
-        :return: The vulnerabilites data structure
+        :return: A list of (layer name, [_Feature]) tuples, bottom layer
+            first, with each layer's features sorted from most to least severe
         """
         return self.vulnerabilites
 
@@ -46,7 +65,34 @@ class ImageScan:
             layer_ids.append(layer['id'])
         return clair_obj.get_layers_vulnerabilities(layer_ids)
 
-    def write_to_file(self, folder, filename):
+    def __compact(self, vulnerabilites):
+        """
+        __compact
+
+        :param vulnerabilites list: The huge fun data structure that clair
+            returns
+        :return: The (layer name, [_Feature]) list for get_vulnerabilites
+        """
+        layers = []
+        for layer in vulnerabilites:
+            layer = layer['Layer']  # The dict is setup weird
+            layer_name = layer['Name']
+            # Make feature objects for this layer
+            feature_objs = []
+            for feature in layer.get('Features', []):
+                # Ignore the feature if it doesn't have vulnerabilites
+                if 'Vulnerabilities' not in feature:
+                    continue
+                # Also ignore if it wasn't added by this layer
+                if 'AddedBy' in feature and feature['AddedBy'] != layer_name:
+                    continue
+                feature_objs.append(_Feature.get(feature))
+            # Sort the feature_objs based on severity of the feature
+            feature_objs.sort(reverse=True)
+            layers.append((layer_name, feature_objs))
+        return layers
+
+    def write_to_file(self, folder, filename, consumers=None):
         """
         write_to_file
 
@@ -55,12 +101,64 @@ class ImageScan:
 
         :param folder str: The folder location to write to
         :param filename str: What to name this file
+        :param consumers list: Everything that was found using this image
+            (tags, containers, pods), listed at the top of the file
+        :return: The path of the file that was written
         """
         filename = filename.replace('/', '-')
         filename = filename.replace(':', '.') + '.txt'
         full_path = os.path.join(folder, filename)
 
-        layers_to_write = {}  # {layer-name:table}
+        with registry.time('docker_scan_stage_seconds', stage='render'), \
+                open(full_path, 'w') as f:
+            for chunk in self.iter_report(consumers):
+                f.write(chunk)
+        return full_path
+
+    def iter_report(self, consumers=None):
+        """
+        iter_report
+
+        :param consumers list: Everything that was found using this image,
+            listed first
+        :return: A generator of the text report, a section for each layer
+        """
+        if consumers:
+            yield ('Used by:\n' +
+                   ''.join('  ' + consumer + '\n' for consumer in consumers) +
+                   '\n')
+        for layer_name, feature_objs in self.vulnerabilites:
+            yield self._render_layer(layer_name, feature_objs)
+
+    def iter_rows(self):
+        """
+        iter_rows
+
+        :return: A generator of a (layer, feature, version, version format,
+            vulnerability, severity, link, description) tuple for every
+            vulnerability, in the same order as the text report
+        """
+        for layer_name, feature_objs in self.vulnerabilites:
+            for feature_obj in feature_objs:
+                for vuln in feature_obj.vulns:
+                    yield (layer_name, feature_obj.name, feature_obj.version,
+                           feature_obj.version_format, vuln.name,
+                           vuln.severity, vuln.link, vuln.description)
+
+    def _render_layer(self, layer_name, feature_objs):
+        """
+        _render_layer
+
+        :param layer_name str: The name of the layer
+        :param feature_objs list: The layer's sorted _Feature objects
+        :return: The layer's text section, from the render cache if another
+            image already rendered it
+        """
+        # The features are interned, so the same ones are the same objects
+        key = (layer_name, tuple(feature_objs), 'text')
+        section = self.layer_sections.get(key)
+        if section is not None:
+            return section
 
         headers = ['Name', 'Version', 'Format', 'Vulnerability', 'Severity',
                    'Link', 'Description']
@@ -69,67 +167,87 @@ class ImageScan:
         # A row to add to the table if a layer has no known vulns
         no_vulns_row = no_vulns + [blank_row[0]] + no_vulns
 
-        # Go through all of the layers to create tables for each layer
-        for layer in self.vulnerabilites:
-            layer = layer['Layer']  # The dict is setup weird
-            layer_name = layer['Name']
-            t = PrettyTable(headers)  # The table for this layer
-
-            # Make sure the layer has features
-            if 'Features' not in layer:
-                layers_to_write[layer_name] = t
-                continue
-            # Make feature objects for this layer
-            feature_objs = []
-            for feature in layer['Features']:
-                # Ignore the feature if it doesn't have vulnerabilites
-                if 'Vulnerabilities' not in feature:
-                    continue
-                # Also ignore if it wasn't added by this layer
-                if 'AddedBy' in feature and feature['AddedBy'] != layer_name:
-                    continue
-                feature_objs.append(_Feature(feature))
-            # Sort the feature_objs based on severity of the feature
-            feature_objs.sort(reverse=True)
+        t = PrettyTable(headers)  # The table for this layer
+        # Add all of the features to the table
+        for feature_obj in feature_objs:
+            for row in feature_obj.rows:
+                t.add_row(row)
+            t.add_row(blank_row)
+        if len(feature_objs) == 0:
+            t.add_row(no_vulns_row)
+        section = 'Layer: ' + layer_name + '\n' + str(t) + '\n\n'
+        self.layer_sections[key] = section
+        return section
+
+    def get_findings(self):
+        """
+        get_findings
 
-            # Add all of the features to the table
+        :return: A set of (layer, feature, version, vulnerability, severity)
+            tuples for every vulnerability in this image, counting features
+            only in the layer that added them
+        """
+        findings = set()
+        for layer_name, feature_objs in self.vulnerabilites:
             for feature_obj in feature_objs:
-                for row in feature_obj.rows:
-                    t.add_row(row)
-                t.add_row(blank_row)
-            # Add table to layers to write
-            layers_to_write[layer_name] = t
-
-        # Write the tables to the file
-        with open(full_path, 'w') as f:
-            for name, layer_table in layers_to_write.items():
-                f.write('Layer: ' + name + '\n')
-                if len(layer_table._rows) == 0:
-                    layer_table.add_row(no_vulns_row)
-                f.write(str(layer_table) + '\n\n')
+                for vuln in feature_obj.vulns:
+                    findings.add((layer_name, feature_obj.name,
+                                  feature_obj.version, vuln.name,
+                                  vuln.severity))
+        return findings
 
 
 class _Feature:
     """
     _Feature
 
-    A class to hold features that have Vulnerabilites
+    A class to hold features that have Vulnerabilites. Features are
+    interned: the same package version with the same vulnerabilites is only
+    made once per run, no matter how many images and layers it is found in.
+    Use _Feature.get to make them.
     """
-    def __init__(self, feature_dict):
+    __slots__ = ('name', 'version', 'version_format', 'vulns', 'rows',
+                 'sev_val')
+    # The most recently used distinct features, so a long running daemon
+    # doesn't keep every feature it has ever seen {key:_Feature}
+    _interned = LRUCache(65536)
+
+    @classmethod
+    def get(cls, feature_dict):
+        """
+        get
+
+        :param feature_dict dict: A feature dict from the vulnerabilites info
+            from clair. Assumes that this dict has Vulnerabilites.
+        :return: The shared _Feature for this feature
+        """
+        vulns = tuple(_Vulnerability.get(vuln)
+                      for vuln in feature_dict['Vulnerabilities'])
+        key = (feature_dict['Name'], feature_dict['Version'],
+               feature_dict['VersionFormat'], vulns)
+        feature = cls._interned.get(key)
+        if feature is None:
+            feature = cls(feature_dict, vulns)
+            cls._interned[key] = feature
+        return feature
+
+    def __init__(self, feature_dict, vulns=None):
         """
         __init__
 
         :param feature_dict dict: A feature dict from the vulnerabilites info
             from clair. Assumes that this dict has Vulnerabilites.
+        :param vulns tuple: The feature's _Vulnerability objects, if they
+            were already made
         """
         self.name = feature_dict['Name']
         self.version = feature_dict['Version']
         self.version_format = feature_dict['VersionFormat']
-        self.vulns = []  # List of _Vulnerability objects
-        for vuln in feature_dict['Vulnerabilities']:
-            self.vulns.append(_Vulnerability(vuln))
+        if vulns is None:
+            vulns = [_Vulnerability.get(vuln)
+                     for vuln in feature_dict['Vulnerabilities']]
         # Sort the vulnerabilites in order from highest severity to lowest
-        self.vulns.sort(reverse=True)
+        self.vulns = tuple(sorted(vulns, reverse=True))
         # Make the rows and give this feature a severity value
         self.rows = self._make_rows()
         self.sev_val = self._get_total_sev_val()
@@ -144,14 +262,13 @@ class _Feature:
         """
         rows = []
         for index, vuln in enumerate(self.vulns):
-            row = []
             if index == 0:
-                row.extend([self.name, self.version, self.version_format])
+                row = (self.name, self.version, self.version_format)
             else:
-                row.extend(['', '', ''])
-            row.extend([vuln.name, vuln.severity, vuln.link, vuln.description])
-            rows.append(row)
-        return rows
+                row = ('', '', '')
+            rows.append(row + (vuln.name, vuln.severity, vuln.link,
+                               vuln.description))
+        return tuple(rows)
 
     def _get_total_sev_val(self):
         """
@@ -177,14 +294,37 @@ class _Vulnerability:
     """
     _Vulnerability
 
-    A class to hold info about a vulnerability
+    A class to hold info about a vulnerability. Vulnerabilites are interned
+    by name (and namespace), so every feature with the same CVE shares one
+    object. Use _Vulnerability.get to make them.
     """
+    __slots__ = ('name', 'severity', 'sev_val', 'link', 'description')
     # Severity with highest value is most important
     sev_vals = {'Unknown': 4,
                 'High': 3,
                 'Medium': 2,
                 'Low': 1,
                 'Negligible': 0}
+    # The most recently used distinct vulnerabilities {key:_Vulnerability}
+    _interned = LRUCache(65536)
+
+    @classmethod
+    def get(cls, vuln_dict):
+        """
+        get
+
+        :param vuln_dict dict: A vulnerability dict from clair
+        :return: The shared _Vulnerability for this vulnerability
+        """
+        # The same CVE can have a different severity or link per namespace
+        key = (vuln_dict['Name'], vuln_dict.get('NamespaceName'),
+               vuln_dict['Severity'], vuln_dict['Link'],
+               vuln_dict.get('Description', '')[:40])
+        vuln = cls._interned.get(key)
+        if vuln is None:
+            vuln = cls(vuln_dict)
+            cls._interned[key] = vuln
+        return vuln
 
     def __init__(self, vuln_dict):
         """
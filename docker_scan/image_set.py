@@ -0,0 +1,59 @@
+import threading
+from collections import OrderedDict
+
+
+class ImageSet:
+    """
+    ImageSet
+
+    A class to hold each docker image only once, along with everything
+    (tags, containers, pods) that was found using it. Adding an image that
+    is already in the set only records the new consumer.
+    """
+    # Every image is added before the set is used, so the consumers are
+    # always complete (unlike an ImageResolver that is still resolving)
+    complete = True
+
+    def __init__(self):
+        self._images = OrderedDict()  # {image_id:docker.Image}
+        self._consumers = {}  # {image_id:[consumer]}
+        self._lock = threading.Lock()
+
+    def add(self, image, consumer=None):
+        """
+        add
+
+        :param image docker.Image: The image to add
+        :param consumer str: What was using the image (e.g. a pod name)
+        :return: True if the image wasn't in the set yet
+        """
+        with self._lock:
+            is_new = image.id not in self._images
+            if is_new:
+                self._images[image.id] = image
+                self._consumers[image.id] = []
+            if (consumer is not None and
+                    consumer not in self._consumers[image.id]):
+                self._consumers[image.id].append(consumer)
+            return is_new
+
+    def get_consumers(self, image):
+        """
+        get_consumers
+
+        :param image docker.Image: An image in the set
+        :return: The list of everything that was using the image
+        """
+        with self._lock:
+            return list(self._consumers.get(image.id, []))
+
+    def __contains__(self, image_id):
+        return image_id in self._images
+
+    def __iter__(self):
+        with self._lock:
+            images = list(self._images.values())
+        return iter(images)
+
+    def __len__(self):
+        return len(self._images)
@@ -1,4 +1,5 @@
-from kubernetes import client, config
+from kubernetes import client, config, watch
+from kubernetes.client.rest import ApiException
 
 
 class KubernetesHelper:
@@ -7,38 +8,126 @@ class KubernetesHelper:
 
     A class to hold a kubernetes connection object
     """
-    def __init__(self):
+    def __init__(self, context=None):
         """
         Creates a KubernetesHelper object. Will raise an exception if reading
         the kubernters config file fails.
+
+        :param context str: The kube config context of the cluster. Defaults
+            to the current context. When given, the pods are named with the
+            context in front (context/namespace/pod/container).
         """
         try:
-            config.load_kube_config()
+            if context is None:
+                config.load_kube_config()
+                self.v1 = client.CoreV1Api()
+            else:
+                # Its own api client, so helpers for several contexts can be
+                # used at the same time
+                self.v1 = client.CoreV1Api(
+                    api_client=config.new_client_from_config(context=context))
         except Exception as ex:
             print(ex)
             print(('Error loading kubernetes config. Please verify'
                    ' that it is setup correctly.'))
             raise ex
-        self.v1 = client.CoreV1Api()
+        self.context = context
         self.host = self.v1.api_client.configuration.host
 
-    def get_pod_images(self, docker_helper):
+    def get_pod_images(self, resolver, namespace=None, label_selector=None,
+                       page_size=500):
         """
         get_pod_images
 
-        Get all pod images
+        Add the image of every running pod container to the resolver. Each
+        image is only looked up once, no matter how many pods are running it.
+        The pods are listed a page at a time, so a big cluster is never held
+        in memory all at once.
+
+        :param resolver image_resolver.ImageResolver: What to add the image
+            references to, with the pods using each one as its consumers
+        :param namespace str: Only list pods in this namespace, None for all
+        :param label_selector str: Only list pods matching this selector
+            (e.g. app=web,tier!=cache)
+        :param page_size int: How many pods to get per call
+        :return: The resourceVersion of the list, to watch from
+        """
+        kwargs = {'limit': page_size}
+        if label_selector is not None:
+            kwargs['label_selector'] = label_selector
+        while True:
+            ret = self._list_pods(namespace, **kwargs)
+            for pod in ret.items:
+                self._add_pod(resolver, pod)
+            if not ret.metadata._continue:
+                return ret.metadata.resource_version
+            kwargs['_continue'] = ret.metadata._continue
+
+    def watch_pod_images(self, resolver, resource_version, namespace=None,
+                         label_selector=None):
+        """
+        watch_pod_images
+
+        Add the images of pods as they are created or change, until the
+        process is stopped
+
+        :param resolver image_resolver.ImageResolver: What to add the image
+            references to
+        :param resource_version str: Where to start watching from, usually
+            what get_pod_images returned
+        :param namespace str: Only watch pods in this namespace, None for all
+        :param label_selector str: Only watch pods matching this selector
+        """
+        kwargs = {}
+        if namespace is not None:
+            kwargs['namespace'] = namespace
+        if label_selector is not None:
+            kwargs['label_selector'] = label_selector
+        func = (self.v1.list_pod_for_all_namespaces if namespace is None
+                else self.v1.list_namespaced_pod)
+        while True:
+            try:
+                # The server ends a watch every so often, pick it back up
+                for event in watch.Watch().stream(
+                        func, resource_version=resource_version,
+                        timeout_seconds=300, **kwargs):
+                    if event['type'] == 'ERROR':
+                        # The watch sends errors as an event with a Status
+                        # (e.g. 410 for a resourceVersion that's too old),
+                        # not as an ApiException
+                        status = event['raw_object']
+                        raise ApiException(status=status.get('code'),
+                                           reason=status.get('message'))
+                    pod = event['object']
+                    resource_version = pod.metadata.resource_version
+                    if event['type'] in ('ADDED', 'MODIFIED'):
+                        self._add_pod(resolver, pod)
+            except ApiException as ex:
+                if ex.status != 410:
+                    raise
+                # Too old to pick back up, list everything again
+                resource_version = self.get_pod_images(resolver, namespace,
+                                                       label_selector)
+
+    def _list_pods(self, namespace, **kwargs):
+        if namespace is None:
+            return self.v1.list_pod_for_all_namespaces(watch=False, **kwargs)
+        return self.v1.list_namespaced_pod(namespace, watch=False, **kwargs)
+
+    def _add_pod(self, resolver, pod):
+        """
+        _add_pod
 
-        :param docker_helper docker_helper.DockerHelper: The docker_helper obj
-            to use for getting Docker Image objects from.
-        :return: The list of docker.Image objects
+        :param resolver image_resolver.ImageResolver: What to add the
+            pod's images to
+        :param pod V1Pod: The pod
         """
-        images = []
-        ret = self.v1.list_pod_for_all_namespaces(watch=False)
-        for i in ret.items:
-            for container in i.status.container_statuses:
-                image_id = container.image
-                images.append(docker_helper.get_image_obj_from_id(image_id))
-        return images
+        names = [pod.metadata.namespace, pod.metadata.name]
+        if self.context is not None:
+            names.insert(0, self.context)
+        for container in pod.status.container_statuses or []:
+            resolver.add(get_image_reference(container),
+                         '/'.join(names + [container.name]))
 
     def ping(self):
         """
@@ -47,3 +136,32 @@ class KubernetesHelper:
         ping the k8s cluster to make sure it is alive
         """
         self.v1.list_namespace()
+
+
+def list_contexts():
+    """
+    list_contexts
+
+    :return: The names of every context in the kube config
+    """
+    contexts, _ = config.list_kube_config_contexts()
+    return [context['name'] for context in contexts]
+
+
+def get_image_reference(container_status):
+    """
+    get_image_reference
+
+    A tag can be moved to another image after the pod started, so the digest
+    the container is actually running is used when there is one
+
+    :param container_status V1ContainerStatus: The container's status
+    :return: repo@sha256:digest if the status has it, otherwise the image
+        from the pod spec
+    """
+    # e.g. docker-pullable://nginx@sha256:..., or docker://sha256:... for an
+    # image that was never pushed, which can't be pulled by
+    _, _, image_id = (container_status.image_id or '').rpartition('://')
+    if '@' in image_id:
+        return image_id
+    return container_status.image
@@ -0,0 +1,333 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import threading
+
+# Bumped when the tables or what is kept in them change, so what an older
+# version kept is dropped instead of used. Before 3, image query mode kept
+# the piece of the top layer's response that each lower layer added, which
+# depends on the layers above it, as that layer's own result.
+SCHEMA_VERSION = 3
+
+
+class LayerCache:
+    """
+    LayerCache
+
+    A class to keep the Clair results for layers on disk between runs, along
+    with which layers make up each image. Results older than the ttl, or
+    from a different Clair DB version, are thrown away. The least recently
+    used results are evicted once the cache grows past its size limit. The
+    images and chain ids are kept the same way: they expire when they
+    haven't been used for the ttl, and the least recently used are evicted
+    past max_entries.
+    """
+    filename = 'layers.sqlite'
+
+    def __init__(self, cache_dir, ttl=172800, max_bytes=1024*1024*1024,
+                 clair_db_version=None, max_entries=100000):
+        """
+        __init__
+
+        Open (or create) the cache in cache_dir
+
+        :param cache_dir str: The folder to keep the cache in
+        :param ttl int: How many seconds a layer result is good for. Defaults
+            to 2 days, so a nightly run still finds the last run's results.
+        :param max_bytes int: How big the stored results can get before the
+            least recently used ones are evicted
+        :param clair_db_version str: Anything that changes when the Clair DB
+            is updated. If it is different from the last run, the layer
+            results are thrown away.
+        :param max_entries int: How many images, and how many chain ids, to
+            keep before the least recently used ones are evicted
+        """
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(cache_dir, self.filename),
+                                   check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            version = self._db.execute('PRAGMA user_version').fetchone()[0]
+            if version != SCHEMA_VERSION:
+                # Made by an older version, the scans fill them in again
+                self._db.execute('DROP TABLE IF EXISTS layers')
+                self._db.execute('DROP TABLE IF EXISTS images')
+                self._db.execute('DROP TABLE IF EXISTS chains')
+                self._db.execute('PRAGMA user_version = {}'.format(
+                                    SCHEMA_VERSION))
+            self._db.execute('CREATE TABLE IF NOT EXISTS layers ('
+                             'layer_id TEXT PRIMARY KEY, payload BLOB,'
+                             ' size INTEGER, created REAL, accessed REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS layers_accessed'
+                             ' ON layers (accessed)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS images ('
+                             'image_id TEXT PRIMARY KEY, layers TEXT,'
+                             ' accessed REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS images_accessed'
+                             ' ON images (accessed)')
+            # The layer each chain id was analysed as {chain_id:layer_id}
+            self._db.execute('CREATE TABLE IF NOT EXISTS chains ('
+                             'chain_id TEXT PRIMARY KEY, layer_id TEXT,'
+                             ' accessed REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS chains_accessed'
+                             ' ON chains (accessed)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS meta ('
+                             'key TEXT PRIMARY KEY, value TEXT)')
+            self._invalidate(clair_db_version)
+            expired = time.time() - self.ttl
+            self._db.execute('DELETE FROM layers WHERE created < ?',
+                             (expired,))
+            self._db.execute('DELETE FROM images WHERE accessed < ?',
+                             (expired,))
+            self._db.execute('DELETE FROM chains WHERE accessed < ?',
+                             (expired,))
+
+    def set_clair_db_version(self, clair_db_version):
+        """
+        set_clair_db_version
+
+        Tell a cache that stays open that the Clair DB has been updated
+
+        :param clair_db_version str: The new Clair DB version
+        """
+        with self._lock, self._db:
+            self._invalidate(clair_db_version)
+
+    def _invalidate(self, clair_db_version):
+        """
+        _invalidate
+
+        Drop all layer results if the Clair DB version has changed
+
+        :param clair_db_version str: The current Clair DB version, or None
+        """
+        if clair_db_version is None:
+            return
+        row = self._db.execute('SELECT value FROM meta WHERE key = ?',
+                               ('clair_db_version',)).fetchone()
+        if row is not None and row[0] == clair_db_version:
+            return
+        self._db.execute('DELETE FROM layers')
+        self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                         ('clair_db_version', clair_db_version))
+
+    def get_clair_layer(self):
+        """
+        get_clair_layer
+
+        :return: A layer the Clair these results came from had, to check
+            that it still has them, or None if there isn't one yet
+        """
+        with self._lock:
+            row = self._db.execute('SELECT value FROM meta WHERE key = ?',
+                                   ('clair_layer',)).fetchone()
+        return None if row is None else row[0]
+
+    def set_clair_layer(self, layer_id):
+        """
+        set_clair_layer
+
+        :param layer_id str: A layer Clair has. Kept until the cache is
+            cleared.
+        """
+        with self._lock, self._db:
+            self._db.execute('INSERT OR IGNORE INTO meta VALUES (?, ?)',
+                             ('clair_layer', layer_id))
+
+    def clear(self):
+        """
+        clear
+
+        Throw away every layer result, image and chain id, e.g. once Clair
+        has lost the layers they are for
+        """
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM layers')
+            self._db.execute('DELETE FROM images')
+            self._db.execute('DELETE FROM chains')
+            self._db.execute('DELETE FROM meta WHERE key = ?',
+                             ('clair_layer',))
+
+    def delete_layers(self, layer_ids):
+        """
+        delete_layers
+
+        :param layer_ids iterable: The layers whose results are out of date
+        """
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM layers WHERE layer_id = ?',
+                                 [(layer_id,) for layer_id in layer_ids])
+
+    def has_layer(self, layer_id):
+        """
+        has_layer
+
+        :param layer_id str: The layer to look for
+        :return: True if there is a fresh result for the layer
+        """
+        with self._lock:
+            row = self._db.execute(
+                    'SELECT 1 FROM layers WHERE layer_id = ? AND created >= ?',
+                    (layer_id, time.time() - self.ttl)).fetchone()
+        return row is not None
+
+    def get_layer(self, layer_id):
+        """
+        get_layer
+
+        :param layer_id str: The layer to get the result of
+        :return: The Clair json response for the layer, or None if there
+            isn't a fresh one
+        """
+        now = time.time()
+        with self._lock, self._db:
+            row = self._db.execute(
+                    'SELECT payload FROM layers'
+                    ' WHERE layer_id = ? AND created >= ?',
+                    (layer_id, now - self.ttl)).fetchone()
+            if row is None:
+                return None
+            self._db.execute('UPDATE layers SET accessed = ?'
+                             ' WHERE layer_id = ?', (now, layer_id))
+        return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+
+    def put_layer(self, layer_id, vulnerabilities):
+        """
+        put_layer
+
+        Store the result for a layer, evicting old results if the cache is
+        over its size limit
+
+        :param layer_id str: The layer the result is for
+        :param vulnerabilities dict: The Clair json response for the layer
+        """
+        payload = zlib.compress(json.dumps(vulnerabilities).encode('utf-8'),
+                                1)
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO layers'
+                             ' VALUES (?, ?, ?, ?, ?)',
+                             (layer_id, payload, len(payload), now, now))
+            self._evict()
+
+    def _evict(self):
+        """
+        _evict
+
+        Remove the least recently used results until the cache is back under
+        90% of its size limit
+        """
+        total = self._db.execute(
+                    'SELECT COALESCE(SUM(size), 0) FROM layers').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = self.max_bytes * 0.9
+        rows = self._db.execute(
+                    'SELECT layer_id, size FROM layers ORDER BY accessed')
+        evict = []
+        for layer_id, size in rows:
+            if total <= target:
+                break
+            evict.append((layer_id,))
+            total -= size
+        self._db.executemany('DELETE FROM layers WHERE layer_id = ?', evict)
+
+    def _evict_entries(self, table, key):
+        """
+        _evict_entries
+
+        Remove the least recently used rows of the images or chains table
+        until it is back under 90% of max_entries
+
+        :param table str: images or chains
+        :param key str: The table's primary key
+        """
+        count = self._db.execute(
+                    'SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0]
+        if count <= self.max_entries:
+            return
+        self._db.execute(
+                'DELETE FROM {0} WHERE {1} IN (SELECT {1} FROM {0}'
+                ' ORDER BY accessed LIMIT ?)'.format(table, key),
+                (count - int(self.max_entries * 0.9),))
+
+    def get_image_layers(self, image_id):
+        """
+        get_image_layers
+
+        :param image_id str: The id of the docker image
+        :return: The list of layer ids in the image, or None if the image
+            hasn't been seen before
+        """
+        with self._lock, self._db:
+            row = self._db.execute('SELECT layers FROM images'
+                                   ' WHERE image_id = ?',
+                                   (image_id,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute('UPDATE images SET accessed = ?'
+                             ' WHERE image_id = ?', (time.time(), image_id))
+        return json.loads(row[0])
+
+    def put_image_layers(self, image_id, layer_ids):
+        """
+        put_image_layers
+
+        :param image_id str: The id of the docker image
+        :param layer_ids list: The layer ids in the image, bottom layer first
+        """
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?)',
+                             (image_id, json.dumps(layer_ids), time.time()))
+            self._evict_entries('images', 'image_id')
+
+    def get_chain_layer(self, chain_id):
+        """
+        get_chain_layer
+
+        :param chain_id str: The chain id of a layer (from the image's
+            RootFS.Layers)
+        :return: The layer id it was analysed as, or None if it hasn't been
+        """
+        with self._lock, self._db:
+            row = self._db.execute('SELECT layer_id FROM chains'
+                                   ' WHERE chain_id = ?',
+                                   (chain_id,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute('UPDATE chains SET accessed = ?'
+                             ' WHERE chain_id = ?', (time.time(), chain_id))
+        return row[0]
+
+    def put_chain_layers(self, chain_layers):
+        """
+        put_chain_layers
+
+        :param chain_layers list: (chain_id, layer_id) tuples. A chain id
+            that is already stored keeps its layer id.
+        """
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany(
+                    'INSERT OR IGNORE INTO chains VALUES (?, ?, ?)',
+                    [(chain_id, layer_id, now)
+                     for chain_id, layer_id in chain_layers])
+            self._db.executemany(
+                    'UPDATE chains SET accessed = ? WHERE chain_id = ?',
+                    [(now, chain_id) for chain_id, _ in chain_layers])
+            self._evict_entries('chains', 'chain_id')
+
+    def close(self):
+        """
+        close
+
+        Close the connection to the cache DB
+        """
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,102 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class LayerScheduler:
+    """
+    LayerScheduler
+
+    A class to submit the layers of every image in a batch to Clair at the
+    same time, on one pool of workers. The layers make a parent->child DAG
+    across all of the images: a layer is submitted as soon as its parent is
+    done, layers that don't depend on each other (different images, or
+    images that branch off the same base) are submitted side by side, and a
+    layer shared by several images is only scheduled once.
+
+    Layers must be scheduled parent first, which _LayerOrder does for each
+    image as its save stream is read.
+    """
+    def __init__(self, submit, workers=10):
+        """
+        __init__
+
+        :param submit function: Called with a layer dict to send it to Clair
+        :param workers int: How many layers can be submitted at the same time
+        """
+        self.submit = submit
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        # Layers that are waiting or being submitted {layer_id:Future}
+        self._pending = {}
+        # Layers waiting for their parent {parent_id:[(layer, Future)]}
+        self._waiting = {}
+        self._cancelled = False
+
+    def schedule(self, layer):
+        """
+        schedule
+
+        :param layer dict: The dict of info for the API call
+        :return: A concurrent.futures.Future that is done when the layer has
+            been submitted. If the layer was already scheduled by another
+            image, that image's Future.
+        """
+        with self._lock:
+            future = self._pending.get(layer['id'])
+            if future is not None:
+                return future
+            future = Future()
+            if self._cancelled:
+                future.cancel()
+                return future
+            self._pending[layer['id']] = future
+            if layer['parent'] in self._pending:
+                self._waiting.setdefault(layer['parent'], []).append(
+                                                            (layer, future))
+                return future
+        self._executor.submit(self._run, layer, future)
+        return future
+
+    def _run(self, layer, future):
+        error = None
+        # A cancelled layer isn't submitted, but its children still need to
+        # be let go of
+        running = future.set_running_or_notify_cancel()
+        if running:
+            try:
+                self.submit(layer)
+            except Exception as ex:
+                error = ex
+        with self._lock:
+            del self._pending[layer['id']]
+            children = self._waiting.pop(layer['id'], [])
+        if running and error is None:
+            future.set_result(None)
+        elif running:
+            future.set_exception(error)
+        # Submit the children even if this layer failed, like Clair.analyse
+        # always has
+        for child in children:
+            self._executor.submit(self._run, *child)
+
+    def cancel(self):
+        """
+        cancel
+
+        Stop submitting layers. The layers being submitted right now finish,
+        while the Futures of the ones that are waiting, and of any scheduled
+        from now on, are cancelled.
+        """
+        with self._lock:
+            self._cancelled = True
+            futures = list(self._pending.values())
+        for future in futures:
+            future.cancel()
+
+    def shutdown(self):
+        """
+        shutdown
+
+        Stop the workers once everything scheduled has been submitted
+        """
+        self._executor.shutdown()
@@ -0,0 +1,208 @@
+import os
+import re
+import socket
+import shutil
+import secrets
+import threading
+from http.server import BaseHTTPRequestHandler
+
+from http_server import ThreadingHTTPServer
+
+
+class LayerServer:
+    """
+    LayerServer
+
+    A small HTTP server that hands the exported layer tars to Clair, so Clair
+    doesn't have to run on the same machine as the scanner. Each layer is
+    only served while it is being submitted, under a random url, so nothing
+    else in the tmp folders can be read through it. Range requests are
+    supported and files are sent with sendfile where the OS has it.
+    """
+    def __init__(self, host='0.0.0.0', port=0, url=None):
+        """
+        __init__
+
+        :param host str: The address to listen on
+        :param port int: The port to listen on, 0 picks a free one
+        :param url str: The base url Clair reaches this server on. Defaults
+            to http://<this machine's hostname>:<port>
+        """
+        self._server = ThreadingHTTPServer((host, port), _LayerHandler)
+        self._server.layers = {}  # {token:path}
+        self._server.layers_lock = threading.Lock()
+        if url is None:
+            url = 'http://{}:{}'.format(socket.getfqdn(),
+                                        self._server.server_port)
+        self.url = url.rstrip('/')
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_port
+
+    def start(self):
+        """
+        start
+
+        Start serving on a background thread
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """
+        close
+
+        Stop the server
+        """
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def url_for(self, path):
+        """
+        url_for
+
+        :param path str: The layer tar to serve
+        :return: The url Clair can download the layer from, until forget is
+            called with it
+        """
+        token = secrets.token_urlsafe(24)
+        with self._server.layers_lock:
+            self._server.layers[token] = path
+        return '{}/layers/{}/layer.tar'.format(self.url, token)
+
+    def forget(self, url):
+        """
+        forget
+
+        Stop serving a layer
+
+        :param url str: The url from url_for
+        """
+        token = url.rsplit('/', 2)[-2]
+        with self._server.layers_lock:
+            self._server.layers.pop(token, None)
+
+
+class _LayerHandler(BaseHTTPRequestHandler):
+    """
+    _LayerHandler
+
+    Serves GET and HEAD /layers/<token>/layer.tar
+    """
+    protocol_version = 'HTTP/1.1'
+    # Bytes per sendfile/copy call
+    chunk_size = 1024 * 1024
+    _path_re = re.compile(r'^/layers/([A-Za-z0-9_-]+)/layer\.tar$')
+    _range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def _serve(self, send_body):
+        match = self._path_re.match(self.path)
+        path = None
+        if match is not None:
+            with self.server.layers_lock:
+                path = self.server.layers.get(match.group(1))
+        try:
+            f = open(path, 'rb') if path is not None else None
+        except OSError:
+            f = None
+        if f is None:
+            self._send_empty(404)
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            byte_range = self._get_range(size)
+            if byte_range is False:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if byte_range is None:
+                start, end = 0, size - 1
+                self.send_response(200)
+            else:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                                                        start, end, size))
+            self.send_header('Content-Type', 'application/x-tar')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+            if send_body:
+                self._send_file(f, start, end - start + 1)
+
+    def _get_range(self, size):
+        """
+        _get_range
+
+        :param size int: The size of the file
+        :return: (start, end) for a single satisfiable byte range, None to
+            send the whole file, or False if the range can't be satisfied
+        """
+        header = self.headers.get('Range')
+        if header is None:
+            return None
+        match = self._range_re.match(header.strip())
+        # Only single ranges are supported, send the whole file for others
+        if match is None or match.group(1) == match.group(2) == '':
+            return None
+        if match.group(1) == '':
+            # The last n bytes
+            start = max(0, size - int(match.group(2)))
+            end = size - 1
+        else:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else size - 1
+            end = min(end, size - 1)
+        if start >= size or start > end:
+            return False
+        return start, end
+
+    def _send_file(self, f, offset, count):
+        """
+        _send_file
+
+        :param f file: The open layer tar
+        :param offset int: Where to start in the file
+        :param count int: How many bytes to send
+        """
+        try:
+            while count > 0:
+                sent = os.sendfile(self.connection.fileno(), f.fileno(),
+                                   offset, min(count, self.chunk_size))
+                if sent == 0:
+                    break
+                offset += sent
+                count -= sent
+        except (AttributeError, OSError) as ex:
+            if isinstance(ex, (BrokenPipeError, ConnectionResetError)):
+                return
+            # No sendfile here, copy it through userspace instead
+            f.seek(offset)
+            while count > 0:
+                chunk = f.read(min(count, self.chunk_size))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                count -= len(chunk)
+
+    def _send_empty(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
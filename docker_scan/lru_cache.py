@@ -0,0 +1,67 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    LRUCache
+
+    A thread safe dict that only keeps the max_size most recently used
+    entries
+    """
+    def __init__(self, max_size):
+        """
+        __init__
+
+        :param max_size int: How many entries to keep
+        """
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        get
+
+        :param key: The key to look up
+        :param default: What to return if the key isn't in the cache
+        :return: The value for key, which becomes the most recently used
+        """
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """
+        pop
+
+        :param key: The key to remove
+        :param default: What to return if the key isn't in the cache
+        :return: The value that was kept for key
+        """
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def clear(self):
+        """
+        clear
+
+        Remove every entry
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
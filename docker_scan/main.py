@@ -1,16 +1,35 @@
 import os
 import sys
+import json
+import asyncio
+import functools
+from concurrent.futures import (ThreadPoolExecutor, CancelledError,
+                                as_completed)
 
 from docker_helper import DockerHelper
-from kubernetes_helper import KubernetesHelper
+from kubernetes_helper import KubernetesHelper, list_contexts
+from registry_helper import RegistryHelper
 from clair import Clair
+from layer_cache import LayerCache
+from layer_server import LayerServer
 from image_scan import ImageScan
+from image_set import ImageSet
+from image_resolver import ImageResolver
+from scan_manifest import ScanManifest
+from scan_daemon import ScanDaemon
+from fleet_index import FleetIndex
+from scan_policy import ScanPolicy, read_allowlist
+from scratch_space import ScratchSpace, exit_on_signals
+from report_writers import WRITERS, LateConsumersWriter
+from metrics import registry
 from argparse_helper import parse_args
 
 
 def main():
     # Get cmdline args
     args = parse_args()
+    # Clean up (e.g. the exported layers) when stopped like on a Ctrl-C
+    exit_on_signals()
 
     cfg = {}
     # docker connect
@@ -19,7 +38,13 @@ def main():
     else:
         cfg['docker.connect'] = args.docker_connect
     # Clair host
-    cfg['clair.host'] = 'http://127.0.0.1:6060'
+    cfg['clair.host'] = args.clair_host
+    cfg['clair.timeout'] = args.clair_timeout
+    cfg['clair.retries'] = args.clair_retries
+    cfg['clair.query_mode'] = args.query_mode
+    cfg['clair.concurrency'] = args.clair_concurrency
+    # Enough connections for every worker to have a call in flight
+    cfg['clair.pool_size'] = max(10, args.jobs * 2)
     # Output dir
     if args.output_dir is None:
         output_dir = 'reports'
@@ -28,70 +53,559 @@ def main():
 
     # Make objs to help with retrieving info
     docker_helper = DockerHelper(cfg['docker.connect'])
-    try:
-        docker_helper.ping()
-    except Exception:
-        print('Failed to connect to the docker'
-              ' server specified ({}).'.format(cfg['docker.connect']))
-        return 1
-    clair_obj = Clair(cfg, docker_helper.docker_cli)
+    # Registry images are never pulled, so docker isn't needed for them
+    if args.source != 'registry':
+        try:
+            docker_helper.ping()
+        except Exception:
+            print('Failed to connect to the docker'
+                  ' server specified ({}).'.format(cfg['docker.connect']))
+            return 1
+    layer_cache = None
+    if args.cache_dir is not None:
+        layer_cache = LayerCache(os.path.expanduser(args.cache_dir),
+                                 ttl=args.cache_ttl,
+                                 max_bytes=args.cache_max_mb*1024*1024,
+                                 clair_db_version=args.clair_db_version)
+    # Serve the layers over HTTP if Clair can't read them from this machine
+    layer_server = None
+    if args.serve_layers is not None:
+        host, _, port = args.serve_layers.rpartition(':')
+        layer_server = LayerServer(host or '0.0.0.0', int(port),
+                                   args.layer_url)
+        layer_server.start()
+        print('Serving layers to Clair from {}'.format(layer_server.url))
+    # Where the layers are exported to
+    scratch_space = ScratchSpace(
+            args.scratch_dir and os.path.expanduser(args.scratch_dir),
+            args.scratch_quota_mb and args.scratch_quota_mb*1024*1024)
+    if args.engine == 'asyncio':
+        # Only the asyncio engine needs aiohttp
+        from async_clair import AsyncClair
+        clair_obj = AsyncClair(cfg, docker_helper.docker_cli, layer_cache,
+                               layer_server, scratch_space)
+    else:
+        clair_obj = Clair(cfg, docker_helper.docker_cli, layer_cache,
+                          layer_server, scratch_space)
     try:
         clair_obj.ping()
     except Exception:
         print('Failed to connect to the clair'
               ' server specified ({}).'.format(cfg['clair.host']))
         return 1
+    clair_obj.check_layer_cache()
+
+    if args.daemon and (args.incremental or args.fleet_report):
+        print('--daemon keeps its own state and writes a report per image,'
+              ' so it can not be used with --incremental or --fleet-report')
+        return 1
+    if args.incremental and args.fleet_report:
+        # The fleet files are written again each run, and would only have
+        # the images that changed
+        print('--incremental only scans the images that changed, so it can'
+              ' not be used with --fleet-report')
+        return 1
+
+    # The policy to gate the run on
+    policy = None
+    if args.fail_on is not None:
+        if args.daemon:
+            print('--daemon never finishes a run, so it can not be used with'
+                  ' --fail-on')
+            return 1
+        allowed = list(args.allowed or [])
+        if args.allowlist is not None:
+            fullpath = os.path.expanduser(args.allowlist)
+            if not os.path.exists(fullpath):
+                print('{} does not exist!!!'.format(args.allowlist))
+                return 1
+            allowed.extend(read_allowlist(fullpath))
+        policy = ScanPolicy(args.fail_on, allowed, args.fail_fast)
+    elif args.fail_fast or args.allowed or args.allowlist:
+        print('--fail-fast, --allow and --allowlist need --fail-on')
+        return 1
+
+    metrics_server = None
+    if args.metrics_port is not None:
+        host, _, port = args.metrics_port.rpartition(':')
+        metrics_server = registry.serve((host or '0.0.0.0', int(port)))
+        print('Serving metrics on http://{}:{}/metrics'.format(
+                    *metrics_server.server_address[:2]))
 
     # Source of images
-    if args.source == 'docker':
-        if args.docker_server is None:
-            images = docker_helper.get_container_images()
+    source = get_image_source(args, docker_helper)
+    if source is None:
+        return 1
+    list_images, resolve = source
+
+    # Make sure output dir is made
+    if not os.path.isdir(output_dir):
+        os.mkdir(output_dir)
+
+    # Everything each scanned image is written to
+    writers = [WRITERS[report_format](output_dir, args.fleet_report)
+               for report_format in args.formats or ['text']]
+    fleet_index = None
+    if args.fleet_index:
+        # Images an incremental run or the daemon didn't scan are still there
+        fleet_index = FleetIndex(
+                        os.path.join(output_dir, 'fleet-index.sqlite'),
+                        os.path.join(output_dir, 'fleet-summary.txt'),
+                        keep_unscanned=args.incremental or args.daemon)
+        writers.append(fleet_index)
+
+    if args.daemon:
+        host, _, port = args.api.rpartition(':')
+        scan_daemon = ScanDaemon(clair_obj, writers, list_images, resolve,
+                                 args.jobs, args.poll_interval,
+                                 args.rescan_interval)
+        try:
+            scan_daemon.run((host or '127.0.0.1', int(port)))
+        except KeyboardInterrupt:
+            print('Stopping...')
+        finally:
+            for writer in writers:
+                writer.close()
+            clair_obj.shutdown()
+            if layer_cache is not None:
+                layer_cache.close()
+            if layer_server is not None:
+                layer_server.close()
+            scratch_space.close()
+            close_metrics(args.metrics_json, metrics_server)
+        return 0
+
+    images = list_images()
+    resolver = images if isinstance(images, ImageResolver) else None
+    if resolver is not None:
+        # Reports are written before every image's consumers are known
+        writers.append(LateConsumersWriter(output_dir, resolver))
+
+    # In incremental mode, only scan what may have changed since last run
+    if args.incremental:
+        scan_manifest = ScanManifest(
+                            os.path.join(output_dir, 'scan-manifest.json'),
+                            os.path.join(output_dir, 'delta.txt'),
+                            args.clair_db_version)
+        images = filter_images(images, scan_manifest.needs_scan)
+        print('{} images changed since the last run'.format(len(images)))
+        writers.append(scan_manifest)
+        # The images that haven't changed are checked with their last
+        # findings
+        if policy is not None:
+            for entry in list(scan_manifest.current.values()):
+                if policy.stopped.is_set():
+                    break
+                policy.check(entry['name'], entry['findings'])
+
+    # Scan all images, writing each report as soon as its scan is done
+    finished = False
+    try:
+        if args.engine == 'asyncio':
+            failed = scan_images_async(images, clair_obj, writers, args.jobs,
+                                       policy)
         else:
+            failed = scan_images(images, clair_obj, writers, args.jobs,
+                                 policy)
+        finished = policy is None or not policy.stopped.is_set()
+    finally:
+        # The images a run that stopped early didn't get to are still there
+        if fleet_index is not None and not finished:
+            fleet_index.keep_unscanned = True
+        for writer in writers:
+            writer.close()
+        clair_obj.shutdown()
+        if layer_cache is not None:
+            layer_cache.close()
+        if layer_server is not None:
+            layer_server.close()
+        scratch_space.close()
+        close_metrics(args.metrics_json, metrics_server)
+    if resolver is not None:
+        print_resolve_stats(resolver, docker_helper)
+    if failed:
+        print('{} images failed to scan, see the errors above'.format(
+                    failed))
+    if policy is not None:
+        policy.print_summary()
+        if policy.failed:
+            return ScanPolicy.exit_code
+    return 1 if failed else 0
+
+
+def get_image_source(args, docker_helper):
+    """
+    get_image_source
+
+    Connect to the source of images picked on the command line
+
+    :param args: The args from the command line
+    :param docker_helper DockerHelper: The docker to pull images into
+    :return: (list_images, resolve), or None if the source couldn't be
+        connected to. list_images returns the images the source has, as an
+        ImageSet or an ImageResolver giving them as they are found, each
+        time it is called. resolve turns an image reference into an image.
+    """
+    if args.source == 'docker':
+        if args.docker_server is not None:
             docker_server = DockerHelper(args.docker_server)
             try:
                 docker_server.ping()
             except Exception:
                 print('Failed to connect to the docker'
                       ' server specified ({}).'.format(args.docker_server))
-                return 1
-            images = docker_server.get_container_images()
+                return None
+            docker_helper = docker_server
+        return (docker_helper.get_container_images,
+                docker_helper.get_image_obj_from_id)
     elif args.source == 'k8s' or args.source == 'kubernetes':
+        if args.watch and args.incremental:
+            print('--incremental needs every image up front, so it can not'
+                  ' be used with --watch')
+            return None
         try:
             k8s_helper = KubernetesHelper()
         except Exception as ex:
-            return 1
+            return None
         try:
             k8s_helper.ping()
         except Exception:
             print('\nFailed to connect to kubernetes cluster: "{}".'.format(
                         k8s_helper.host))
-            return 1
-        images = k8s_helper.get_pod_images(docker_helper)
+            return None
+        # Images are pulled as the pods are listed, and scanned as they come
+        return (functools.partial(start_resolver,
+                                  docker_helper.get_image_obj_from_id,
+                                  functools.partial(pod_images, k8s_helper,
+                                                    args),
+                                  args.pull_jobs, args.watch),
+                docker_helper.get_image_obj_from_id)
+    elif args.source == 'multi':
+        contexts = list(args.contexts or [])
+        if args.all_contexts:
+            try:
+                contexts = list_contexts()
+            except Exception as ex:
+                print('Failed to read the kube config: {}'.format(ex))
+                return None
+        if not contexts and not args.docker_servers:
+            print('Give at least one --docker-server or --context')
+            return None
+        return (functools.partial(start_resolver,
+                                  docker_helper.get_image_obj_from_id,
+                                  functools.partial(multi_images,
+                                                    args.docker_servers or [],
+                                                    contexts, args),
+                                  args.pull_jobs),
+                docker_helper.get_image_obj_from_id)
     elif args.source == 'file':
         # If specifying file, make sure it exists
         fullpath = os.path.expanduser(args.filepath)
         if not os.path.exists(fullpath):
             print('{} does not exist!!!'.format(args.filepath))
             sys.exit(1)
-        images = images_from_file(fullpath, docker_helper)
-
-    # Scan all images  {name:ImageScan}
-    scanned_images = {}
-    for image in images:
-        name = get_print_tag(image)
-        print('Starting scan on {}...'.format(name))
-        scanned_images[name] = ImageScan(image, clair_obj)
-        print('{} done'.format(name))
-        if image != images[-1]:
-            print('\n')
+        return (functools.partial(start_resolver,
+                                  docker_helper.get_image_obj_from_id,
+                                  functools.partial(images_from_file,
+                                                    fullpath),
+                                  args.pull_jobs),
+                docker_helper.get_image_obj_from_id)
+    elif args.source == 'registry':
+        registry_helper = RegistryHelper(args.username, args.password,
+                                         args.insecure, args.platform)
+        references = list(args.references)
+        if args.file is not None:
+            fullpath = os.path.expanduser(args.file)
+            if not os.path.exists(fullpath):
+                print('{} does not exist!!!'.format(args.file))
+                sys.exit(1)
+            with open(fullpath, 'r') as f:
+                references.extend(line.strip() for line in f if line.strip())
+        return (functools.partial(start_resolver, registry_helper.get_image,
+                                  functools.partial(add_references,
+                                                    references),
+                                  args.pull_jobs),
+                registry_helper.get_image)
 
-    # Make sure output dir is made
-    if not os.path.isdir(output_dir):
-        os.mkdir(output_dir)
 
-    # Write all of the vulnerabilites to disk
-    for name, imagescan in scanned_images.items():
-        imagescan.write_to_file(output_dir, name)
+def start_resolver(resolve, produce, jobs, endless=False):
+    """
+    start_resolver
+
+    :param resolve function: Turns a reference into an image
+    :param produce function: Adds the references to the resolver
+    :param jobs int: How many references to resolve at the same time
+    :param endless bool: Whether produce keeps going until stopped
+    :return: An ImageResolver that has been started with produce
+    """
+    resolver = ImageResolver(resolve, jobs, endless)
+    resolver.start(produce)
+    return resolver
+
+
+def filter_images(images, keep):
+    """
+    filter_images
+
+    :param images ImageSet: The images to filter
+    :param keep function: Called with each image, returns True to keep it
+    :return: An ImageSet of the kept images, with their consumers
+    """
+    # Find every image first, so their consumers are complete
+    kept_images = [image for image in images if keep(image)]
+    kept = ImageSet()
+    for image in kept_images:
+        kept.add(image)
+        for consumer in images.get_consumers(image):
+            kept.add(image, consumer)
+    return kept
+
+
+def scan_images(images, clair_obj, writers, jobs, policy=None):
+    """
+    scan_images
+
+    Scan the images using a pool of workers. Each worker exports, analyses
+    and writes the report for one image, so the different stages of
+    different images overlap. Images are scanned as they are resolved, and
+    each report is written as soon as its scan is done, with the consumers
+    found so far (see LateConsumersWriter for the ones found after).
+
+    :param images ImageSet: The docker.Image objects to scan, or an
+        ImageResolver giving them as they are resolved
+    :param clair_obj Clair: The clair object to use for the analysis
+    :param writers list: The ReportWriters to write each image to
+    :param jobs int: How many images to scan at the same time
+    :param policy ScanPolicy: The policy to check each image against, or
+        None
+    :return: How many images failed to scan
+    """
+    failed = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {}  # {future:image}
+        try:
+            for image in images:
+                futures[executor.submit(scan_image, image, clair_obj,
+                                        writers, images, policy)] = image
+            for future in as_completed(futures):
+                # One image failing doesn't stop the others
+                try:
+                    future.result()
+                except Exception as ex:
+                    scan_failed(get_print_tag(futures[future]), ex)
+                    failed += 1
+        except (SystemExit, KeyboardInterrupt):
+            # Leaving the executor waits for its work, so drop what is
+            # queued and have the scans in flight stop early
+            stop_scanning(clair_obj, images, futures)
+            raise
+    return failed
+
+
+def scan_failed(name, ex):
+    """
+    scan_failed
+
+    :param name str: The print tag of the image that failed to scan
+    :param ex Exception: What it failed with
+    """
+    print('Failed to scan {}: {}'.format(name, ex))
+    registry.inc('docker_scan_images_failed_total')
+
+
+def scan_image(image, clair_obj, writers, images, policy=None):
+    """
+    scan_image
+
+    Scan a single image and write its report
+
+    :param image docker.Image: The image to scan
+    :param clair_obj Clair: The clair object to use for the analysis
+    :param writers list: The ReportWriters to write the image to
+    :param images ImageSet: Where the image came from, to get its consumers
+    :param policy ScanPolicy: The policy to check the image against, or
+        None
+    :return: The name the report was written under
+    """
+    name = get_print_tag(image)
+    if policy is not None and policy.stopped.is_set():
+        return name
+    print('Starting scan on {}...'.format(name))
+    try:
+        image_scan = ImageScan(image, clair_obj)
+    except CancelledError:
+        print('{} stopped'.format(name))
+        return name
+    if not check_policy(policy, image_scan, name, clair_obj, images):
+        return name
+    write_reports(image_scan, name, writers, images.get_consumers(image))
+    print('{} done'.format(name))
+    return name
+
+
+def check_policy(policy, image_scan, name, clair_obj, images):
+    """
+    check_policy
+
+    Check a scanned image against the policy, and stop the scan if the
+    policy fails fast and the image fails it
+
+    :param policy ScanPolicy: The policy, or None
+    :param image_scan ImageScan: The scanned image
+    :param name str: The image's print tag
+    :param clair_obj Clair: The clair object scanning the images
+    :param images ImageSet: Where the images come from
+    :return: True if the image's reports should be written. Once the
+        policy has stopped the scan, only the images failing it are.
+    """
+    if policy is None:
+        return True
+    passed = policy.check(name, image_scan.get_findings())
+    if not policy.stopped.is_set():
+        return True
+    stop_scanning(clair_obj, images)
+    return not passed
+
+
+def stop_scanning(clair_obj, images, futures=()):
+    """
+    stop_scanning
+
+    Stop scheduling any more work: images that haven't been found or
+    started yet are dropped, and the ones being scanned stop sending layers
+    to Clair
+
+    :param clair_obj Clair: The clair object scanning the images
+    :param images ImageSet: Where the images come from
+    :param futures list: The Futures of the scans that were queued
+    """
+    for future in futures:
+        future.cancel()
+    clair_obj.cancel()
+    if isinstance(images, ImageResolver):
+        images.stop()
+
+
+def write_reports(image_scan, name, writers, consumers):
+    """
+    write_reports
+
+    Hand a scanned image to every writer
+
+    :param image_scan ImageScan: The scanned image
+    :param name str: The name to write the report under
+    :param writers list: The ReportWriters (and ScanManifest) to write to
+    :param consumers list: Everything that was found using the image
+    """
+    for writer in writers:
+        writer.write(image_scan, name, consumers)
+
+
+def scan_images_async(images, clair_obj, writers, jobs, policy=None):
+    """
+    scan_images_async
+
+    Scan the images on an asyncio event loop. Every image is started at
+    once: up to jobs images are exported at a time on worker threads, while
+    their layer POSTs and vulnerability GETs share the loop, up to the
+    AsyncClair's concurrency limit.
+
+    :param images ImageSet: The docker.Image objects to scan
+    :param clair_obj AsyncClair: The clair object to use for the analysis
+    :param writers list: The ReportWriters to write each image to
+    :param jobs int: How many images to export at the same time
+    :param policy ScanPolicy: The policy to check each image against, or
+        None
+    :return: How many images failed to scan
+    """
+    loop = asyncio.new_event_loop()
+    scan = loop.create_task(
+                _scan_images_async(images, clair_obj, writers, jobs, policy))
+    try:
+        return loop.run_until_complete(scan)
+    except (SystemExit, KeyboardInterrupt):
+        # Unwind the scan, which closes the Clair session and waits for the
+        # exports, once they have been told to stop
+        stop_scanning(clair_obj, images)
+        scan.cancel()
+        try:
+            loop.run_until_complete(scan)
+        except asyncio.CancelledError:
+            pass
+        raise
+    finally:
+        loop.close()
+
+
+async def _scan_images_async(images, clair_obj, writers, jobs, policy):
+    loop = asyncio.get_event_loop()
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    exports = asyncio.Semaphore(jobs)
+    # Bound how many analysed images can be fetching or waiting to be
+    # written, so memory doesn't grow with the number of images
+    reports = asyncio.Semaphore(jobs * 2)
+    await clair_obj.open()
+    try:
+        # Start each image as it is resolved. Waiting for the next one
+        # blocks, so it is done off the loop.
+        tasks = []
+        remaining = iter(images)
+        while True:
+            image = await loop.run_in_executor(None, next, remaining, None)
+            if image is None:
+                break
+            tasks.append(asyncio.ensure_future(_scan_image_async(
+                            image, clair_obj, writers, images, executor,
+                            exports, reports, policy)))
+        names = await asyncio.gather(*tasks)
+        return names.count(None)
+    finally:
+        await clair_obj.close()
+        executor.shutdown()
+
+
+async def _scan_image_async(image, clair_obj, writers, images, executor,
+                            exports, reports, policy):
+    """
+    _scan_image_async
+
+    The asyncio version of scan_image
+
+    :param exports asyncio.Semaphore: Limits how many images are exported
+        at the same time
+    :param reports asyncio.Semaphore: Limits how many images are past the
+        export but not written yet
+    :return: The name the report was written under, None if the image
+        failed to scan
+    """
+    name = get_print_tag(image)
+    try:
+        async with exports:
+            if policy is not None and policy.stopped.is_set():
+                return name
+            print('Starting scan on {}...'.format(name))
+            layers = await clair_obj.analyse_async(image, executor)
+        async with reports:
+            vulnerabilites = await clair_obj.get_layers_vulnerabilities_async(
+                                        [layer['id'] for layer in layers])
+            image_scan = ImageScan(image, clair_obj, vulnerabilites)
+            # Only the compact scan is needed from here on
+            del vulnerabilites
+            if not check_policy(policy, image_scan, name, clair_obj, images):
+                return name
+            # Rendering the reports is blocking work, keep it off the loop
+            await asyncio.get_event_loop().run_in_executor(
+                        executor, write_reports, image_scan, name, writers,
+                        images.get_consumers(image))
+    except CancelledError:
+        print('{} stopped'.format(name))
+        return name
+    except Exception as ex:
+        # One image failing doesn't stop the others
+        scan_failed(name, ex)
+        return None
+    print('{} done'.format(name))
+    return name
 
 
 def get_print_tag(docker_image):
@@ -106,22 +620,125 @@ def get_print_tag(docker_image):
         return docker_image.tags[0]
 
 
-def images_from_file(filename, docker_helper):
+def images_from_file(filename, resolver):
     """
     images_from_file
 
     :param filename str: The path to the file
-    :param docker_helper DockerHelper: The docker_helper obj to get the images
-    :return: A list of docker image objects
+    :param resolver ImageResolver: What to add the images to, with the lines
+        that named each image as its consumers
     """
-    images = []
     with open(filename, 'r') as f:
         for line in f:
             image_id = line.strip()
-            i = docker_helper.get_image_obj_from_id(image_id)
-            images.append(i)
-    return images
+            if image_id != '':
+                resolver.add(image_id, image_id)
+
+
+def pod_images(k8s_helper, args, resolver):
+    """
+    pod_images
+
+    Add the images of the pods to the resolver, then keep adding the
+    images of new pods if watching
+
+    :param k8s_helper KubernetesHelper: The cluster to get the pods from
+    :param args: The args from the command line
+    :param resolver ImageResolver: What to add the images to
+    """
+    resource_version = k8s_helper.get_pod_images(
+                            resolver, args.namespace, args.selector,
+                            args.page_size)
+    if args.watch:
+        print('Watching for new pods...')
+        k8s_helper.watch_pod_images(resolver, resource_version,
+                                    args.namespace, args.selector)
+
+
+def multi_images(docker_servers, contexts, args, resolver):
+    """
+    multi_images
+
+    List every docker server and kubernetes cluster at the same time, into
+    one resolver, so each image is only scanned once however many of them
+    are running it. The consumers say where each image was running. A
+    server or cluster that can't be reached is skipped.
+
+    :param docker_servers list: The docker endpoints to get the running
+        containers from
+    :param contexts list: The kube config contexts of the clusters
+    :param args: The args from the command line, for the pod filters
+    :param resolver ImageResolver: What to add the images to
+    """
+    def list_docker(docker_server):
+        docker_helper = DockerHelper(docker_server)
+        images = docker_helper.get_container_images()
+        for image in images:
+            for container in images.get_consumers(image):
+                resolver.add_image(image, docker_server + '/' + container)
+
+    def list_k8s(context):
+        pod_images(KubernetesHelper(context), args, resolver)
+
+    jobs = ([(list_docker, server) for server in docker_servers] +
+            [(list_k8s, context) for context in contexts])
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        futures = {executor.submit(*job): job[1] for job in jobs}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as ex:
+                print('Failed to list the images on {}: {}'.format(
+                            futures[future], ex))
+
+
+def add_references(references, resolver):
+    """
+    add_references
+
+    :param references list: The image references to add
+    :param resolver ImageResolver: What to add them to, with each reference
+        as its own consumer
+    """
+    for reference in references:
+        resolver.add(reference, reference)
+
+
+def close_metrics(metrics_json, metrics_server):
+    """
+    close_metrics
+
+    :param metrics_json str: The file to write the metrics summary to, or
+        None
+    :param metrics_server HTTPServer: The server from --metrics-port, or None
+    """
+    if metrics_json is not None:
+        with open(metrics_json, 'w') as f:
+            json.dump(registry.to_json(), f, indent=2, sort_keys=True)
+    if metrics_server is not None:
+        metrics_server.shutdown()
+        metrics_server.server_close()
+
+
+def print_resolve_stats(resolver, docker_helper):
+    """
+    print_resolve_stats
+
+    Print how long finding the images took, and how fast they were pulled
+
+    :param resolver ImageResolver: The resolver the images came from
+    :param docker_helper DockerHelper: The helper that pulled them
+    """
+    stats = resolver.get_stats()
+    print('Resolved {} images in {:.1f}s ({} failed)'.format(
+                stats['resolved'], stats['seconds'], stats['failed']))
+    pulls = docker_helper.pull_stats
+    if pulls['count'] > 0:
+        megabytes = pulls['bytes'] / (1024 * 1024)
+        print('Pulled {} images, {:.1f} MB at {:.1f} MB/s'.format(
+                    pulls['count'], megabytes,
+                    megabytes / max(stats['seconds'], 0.001)))
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,219 @@
+import time
+import bisect
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler
+
+from http_server import ThreadingHTTPServer
+
+# Upper bounds of the histogram buckets, in seconds. Layer POSTs can take
+# minutes, so they go well past Prometheus' defaults.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+           120, 300, 600, float('inf'))
+
+# What each metric is, for the Prometheus HELP lines
+DESCRIPTIONS = {
+    'docker_scan_stage_seconds': ('Time spent in each stage of a scan'
+                                  ' (export, extract, submit, fetch,'
+                                  ' render)'),
+    'docker_scan_clair_request_seconds': ('Latency of the Clair API calls,'
+                                          ' retries included'),
+    'docker_scan_scratch_wait_seconds': ('Time exports waited for room'
+                                         ' under the scratch quota'),
+    'docker_scan_exported_bytes_total': 'Bytes read from docker save streams',
+    'docker_scan_extracted_bytes_total': 'Bytes of layer tars written to disk',
+    'docker_scan_cache_requests_total': ('Lookups of layer results, by cache'
+                                         ' (memory, disk) and result (hit,'
+                                         ' miss)'),
+    'docker_scan_images_scanned_total': 'Images that have been scanned',
+    'docker_scan_images_failed_total': 'Images that failed to scan',
+    'docker_scan_exports_skipped_total': ('Images that were not exported'
+                                          ' because Clair had every layer'),
+    'docker_scan_policy_failures_total': 'Images that failed --fail-on',
+}
+
+
+class Metrics:
+    """
+    Metrics
+
+    A thread safe registry of counters and histograms, to see where the time
+    in a scan goes. Everything can be written out as Prometheus text or as a
+    json summary.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # {(name, labels):value}
+        self._histograms = {}  # {(name, labels):_Histogram}
+
+    def inc(self, name, amount=1, **labels):
+        """
+        inc
+
+        :param name str: The counter to add to
+        :param amount float: How much to add
+        :param labels: The labels of the counter (e.g. stage='export')
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """
+        observe
+
+        :param name str: The histogram to add to
+        :param value float: The value to add, usually seconds
+        :param labels: The labels of the histogram
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = _Histogram()
+            self._histograms[key].observe(value)
+
+    @contextlib.contextmanager
+    def time(self, name, **labels):
+        """
+        time
+
+        :param name str: The histogram to add the time to
+        :param labels: The labels of the histogram
+        :return: A context manager that observes how long it was in
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def to_prometheus(self):
+        """
+        to_prometheus
+
+        :return: Everything in the Prometheus text format
+        """
+        lines = []
+        described = set()
+
+        def describe(name, metric_type):
+            if name not in described:
+                described.add(name)
+                if name in DESCRIPTIONS:
+                    lines.append('# HELP {} {}'.format(name,
+                                                       DESCRIPTIONS[name]))
+                lines.append('# TYPE {} {}'.format(name, metric_type))
+
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                describe(name, 'counter')
+                lines.append('{}{} {}'.format(name, _labels(labels), value))
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                describe(name, 'histogram')
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{}_bucket{} {}'.format(
+                            name, _labels(labels + (('le', le),)),
+                            cumulative))
+                lines.append('{}_sum{} {}'.format(name, _labels(labels),
+                                                  histogram.sum))
+                lines.append('{}_count{} {}'.format(name, _labels(labels),
+                                                    histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self):
+        """
+        to_json
+
+        :return: {'counters': {metric:value}, 'histograms': {metric:{'count',
+            'sum', 'mean', 'max', 'p50', 'p95'}}}, with each metric written
+            like name{label="value"}. The percentiles are the upper bound of
+            the bucket they fall in, or the max if that is lower.
+        """
+        with self._lock:
+            return {
+                'counters': {name + _labels(labels): value
+                             for (name, labels), value
+                             in sorted(self._counters.items())},
+                'histograms': {name + _labels(labels): histogram.summary()
+                               for (name, labels), histogram
+                               in sorted(self._histograms.items())}
+            }
+
+    def serve(self, address):
+        """
+        serve
+
+        Serve the Prometheus text on /metrics from a background thread
+
+        :param address tuple: (host, port) to listen on
+        :return: The HTTPServer, to shutdown when done
+        """
+        server = ThreadingHTTPServer(address, _MetricsHandler)
+        server.metrics = self
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class _Histogram:
+    __slots__ = ('counts', 'sum', 'count', 'max')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def summary(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'mean': self.sum / self.count if self.count else 0.0,
+                'max': self.max,
+                'p50': self._percentile(0.5),
+                'p95': self._percentile(0.95)}
+
+    def _percentile(self, fraction):
+        cumulative = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            cumulative += count
+            if cumulative >= fraction * self.count:
+                # Nothing went past the max, even if the bucket goes further
+                return min(bound, self.max)
+        return 0.0
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('"', '\\"'))
+                          for key, value in labels) + '}'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data = self.server.metrics.to_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+# The registry the scan code records to
+registry = Metrics()
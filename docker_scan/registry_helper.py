@@ -0,0 +1,296 @@
+import os
+import re
+import json
+import time
+import base64
+import hashlib
+import threading
+import functools
+
+import requests
+
+# The manifests we can read, most preferred first
+MANIFEST_TYPES = ('application/vnd.docker.distribution.manifest.v2+json',
+                  'application/vnd.oci.image.manifest.v1+json')
+INDEX_TYPES = ('application/vnd.docker.distribution.manifest.list.v2+json',
+               'application/vnd.oci.image.index.v1+json')
+
+DOCKER_HUB = 'docker.io'
+DOCKER_HUB_API = 'registry-1.docker.io'
+
+
+class RegistryHelper:
+    """
+    RegistryHelper
+
+    A class to read images straight from a registry (the v2 API), so Clair
+    can download their layers itself. Nothing is pulled into docker or
+    saved. Registries that want a bearer token or basic auth are handled,
+    with the credentials given or the ones in ~/.docker/config.json.
+    """
+    def __init__(self, username=None, password=None, insecure=False,
+                 platform='linux/amd64', timeout=60):
+        """
+        __init__
+
+        :param username str: The user to log in to the registries as
+        :param password str: The password for username
+        :param insecure bool: Use http instead of https
+        :param platform str: The os/architecture to pick from multi-platform
+            images
+        :param timeout float: Seconds to wait for a registry to answer
+        """
+        self.username = username
+        self.password = password
+        self.scheme = 'http' if insecure else 'https'
+        self.platform = platform
+        self.timeout = timeout
+        self._session = requests.Session()
+        # How each registry wants to be logged in to {registry:(scheme,
+        # {param:value})}, from the WWW-Authenticate of its first 401
+        self._challenges = {}
+        # Bearer tokens {(registry, repository):(headers, expires)}
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get_image(self, reference):
+        """
+        get_image
+
+        :param reference str: The image reference
+        :return: A RegistryImage of the image's manifest
+        """
+        registry, repository, ref = parse_reference(reference)
+        manifest = self._get_manifest(registry, repository, ref)
+        if manifest.get('mediaType') in INDEX_TYPES or 'manifests' in manifest:
+            ref = self._pick_platform(manifest, reference)
+            manifest = self._get_manifest(registry, repository, ref)
+        if manifest.get('schemaVersion') != 2 or 'config' not in manifest:
+            raise ValueError('{} has an unsupported manifest (only v2 schema 2'
+                             ' and OCI are supported)'.format(reference))
+        return RegistryImage(reference, self, registry, repository,
+                             manifest['config']['digest'],
+                             [layer['digest'] for layer in manifest['layers']])
+
+    def _pick_platform(self, index, reference):
+        """
+        _pick_platform
+
+        :param index dict: A manifest list or OCI index
+        :param reference str: The image reference, for the error message
+        :return: The digest of the manifest for self.platform
+        """
+        os_name, _, architecture = self.platform.partition('/')
+        for manifest in index['manifests']:
+            platform = manifest.get('platform', {})
+            if (platform.get('os') == os_name and
+                    platform.get('architecture') == architecture):
+                return manifest['digest']
+        raise ValueError('{} has no {} image'.format(reference, self.platform))
+
+    def _get_manifest(self, registry, repository, ref):
+        r = self.get(registry, repository,
+                     '/v2/{}/manifests/{}'.format(repository, ref),
+                     headers={'Accept': ', '.join(MANIFEST_TYPES +
+                                                  INDEX_TYPES)})
+        r.raise_for_status()
+        return json.loads(r.content.decode('utf-8'))
+
+    def blob_url(self, registry, repository, digest):
+        """
+        blob_url
+
+        :return: The url to download a blob of the repository from
+        """
+        return '{}://{}/v2/{}/blobs/{}'.format(
+                    self.scheme, _api_host(registry), repository, digest)
+
+    def get(self, registry, repository, path, headers=None):
+        """
+        get
+
+        Make a GET to a registry, logging in and trying again if it says to
+
+        :param registry str: The registry (e.g. docker.io)
+        :param repository str: The repository the call is for
+        :param path str: The path on the registry (e.g. /v2/)
+        :param headers dict: Any other headers to send
+        :return: The requests.Response
+        """
+        url = '{}://{}{}'.format(self.scheme, _api_host(registry), path)
+        headers = dict(headers or {})
+        headers.update(self.get_auth_headers(registry, repository))
+        r = self._session.get(url, headers=headers, timeout=self.timeout)
+        if r.status_code == 401 and 'WWW-Authenticate' in r.headers:
+            with self._lock:
+                self._challenges[registry] = _parse_challenge(
+                                            r.headers['WWW-Authenticate'])
+                self._tokens.pop((registry, repository), None)
+            headers.update(self.get_auth_headers(registry, repository))
+            r = self._session.get(url, headers=headers, timeout=self.timeout)
+        return r
+
+    def get_auth_headers(self, registry, repository):
+        """
+        get_auth_headers
+
+        :param registry str: The registry (e.g. docker.io)
+        :param repository str: The repository to read
+        :return: The headers that let a client pull from the repository.
+            Bearer tokens are reused until they are close to expiring.
+        """
+        with self._lock:
+            challenge = self._challenges.get(registry)
+            token = self._tokens.get((registry, repository))
+        if challenge is None:
+            return {}
+        scheme, params = challenge
+        credentials = self._get_credentials(registry)
+        if scheme == 'basic':
+            if credentials is None:
+                return {}
+            return {'Authorization': 'Basic ' + base64.b64encode(
+                        ':'.join(credentials).encode('utf-8')).decode('ascii')}
+        if token is not None and token[1] > time.time():
+            return token[0]
+        query = {'scope': 'repository:{}:pull'.format(repository)}
+        if 'service' in params:
+            query['service'] = params['service']
+        r = self._session.get(params['realm'], params=query, auth=credentials,
+                              timeout=self.timeout)
+        r.raise_for_status()
+        body = r.json()
+        headers = {'Authorization': 'Bearer ' + body.get(
+                                    'token', body.get('access_token', ''))}
+        # The spec says a token with no expires_in is good for 60 seconds.
+        # Stop using it half way, so Clair isn't handed one about to expire.
+        expires = time.time() + body.get('expires_in', 60) / 2
+        with self._lock:
+            self._tokens[(registry, repository)] = (headers, expires)
+        return headers
+
+    def _get_credentials(self, registry):
+        """
+        _get_credentials
+
+        :param registry str: The registry to log in to
+        :return: (username, password) from the args or the docker config,
+            or None to be anonymous
+        """
+        if self.username is not None:
+            return (self.username, self.password or '')
+        config_path = os.path.join(os.path.expanduser('~'), '.docker',
+                                   'config.json')
+        try:
+            with open(config_path, 'r') as f:
+                auths = json.load(f).get('auths', {})
+        except (OSError, ValueError):
+            return None
+        keys = [registry, 'https://' + registry]
+        if registry == DOCKER_HUB:
+            keys.append('https://index.docker.io/v1/')
+        for key in keys:
+            auth = auths.get(key, {}).get('auth')
+            if auth:
+                username, _, password = base64.b64decode(
+                                        auth).decode('utf-8').partition(':')
+                return (username, password)
+        return None
+
+
+class RegistryImage:
+    """
+    RegistryImage
+
+    An image that is read from a registry instead of docker. It has the id
+    and tags of a docker.Image, so it can be scanned and reported on like
+    one, and it knows where Clair can download each of its layers from.
+    """
+    def __init__(self, reference, registry_helper, registry, repository,
+                 config_digest, layer_digests):
+        """
+        __init__
+
+        :param reference str: The reference the image was found by
+        :param registry_helper RegistryHelper: To get the auth headers with
+        :param registry str: The registry the image is in
+        :param repository str: The repository the image is in
+        :param config_digest str: The digest of the image config, which is
+            the id docker would give the image
+        :param layer_digests list: The digests of the layer blobs, bottom
+            layer first
+        """
+        self.id = config_digest
+        self.tags = [reference]
+        self.registry_helper = registry_helper
+        self.registry = registry
+        self.repository = repository
+        self.layer_digests = layer_digests
+
+    def get_layers(self):
+        """
+        get_layers
+
+        Clair builds each layer on top of its parent, so the same blob under
+        a different parent is a different layer to it. Each layer is named
+        by a hash of its blob digest and its parent's name.
+
+        :return: The layer dicts for the API calls, bottom layer first. The
+            path is the blob url, and headers is a function returning the
+            headers Clair needs to download it.
+        """
+        headers = functools.partial(self.registry_helper.get_auth_headers,
+                                    self.registry, self.repository)
+        layers = []
+        parent_layer = ''
+        for digest in self.layer_digests:
+            layer_id = hashlib.sha256(
+                (parent_layer + ' ' + digest).encode('utf-8')).hexdigest()
+            layers.append({'id': layer_id,
+                           'path': self.registry_helper.blob_url(
+                                    self.registry, self.repository, digest),
+                           'parent': parent_layer,
+                           'image': self.id,
+                           'headers': headers
+                           })
+            parent_layer = layer_id
+        return layers
+
+
+def parse_reference(reference):
+    """
+    parse_reference
+
+    :param reference str: An image reference, the same as docker pull takes
+    :return: (registry, repository, tag or digest)
+    """
+    name, _, digest = reference.partition('@')
+    first, _, rest = name.partition('/')
+    if rest and ('.' in first or ':' in first or first == 'localhost'):
+        registry, name = first, rest
+    else:
+        registry = DOCKER_HUB
+    repository, _, tag = name.rpartition(':')
+    if not repository or '/' in tag:
+        # The : was a port, or there is no tag
+        repository, tag = name, ''
+    if registry == DOCKER_HUB and '/' not in repository:
+        repository = 'library/' + repository
+    return registry, repository, digest or tag or 'latest'
+
+
+def _api_host(registry):
+    return DOCKER_HUB_API if registry == DOCKER_HUB else registry
+
+
+def _parse_challenge(header):
+    """
+    _parse_challenge
+
+    :param header str: A WWW-Authenticate header
+    :return: (scheme, {param:value}), e.g. ('bearer', {'realm': ...,
+        'service': ...})
+    """
+    scheme, _, params = header.strip().partition(' ')
+    return (scheme.lower(),
+            dict(re.findall(r'(\w+)="([^"]*)"', params)))
@@ -0,0 +1,310 @@
+import os
+import csv
+import json
+import threading
+
+from metrics import registry
+
+# The fields in each row from ImageScan.iter_rows
+ROW_FIELDS = ('layer', 'feature', 'version', 'version_format',
+              'vulnerability', 'severity', 'link', 'description')
+
+
+def report_filename(name, extension):
+    """
+    report_filename
+
+    :param name str: The image's print tag
+    :param extension str: The file extension, with the dot
+    :return: A filename for the image's report without / or :
+    """
+    return name.replace('/', '-').replace(':', '.') + extension
+
+
+class ReportWriter:
+    """
+    ReportWriter
+
+    The base class for the report writers. A writer gets every scanned image
+    as soon as its scan is done, and either writes a file per image or
+    streams every image into one fleet-wide file. Rows are written as they
+    are made, so a whole report is never built in memory.
+
+    Subclasses set extension and implement _write_image, plus _start and
+    _finish for anything a file needs around the images.
+    """
+    extension = None
+
+    def __init__(self, output_dir, fleet=False):
+        """
+        __init__
+
+        :param output_dir str: The folder to write the reports to
+        :param fleet bool: Write every image into one file instead of a file
+            per image
+        """
+        self.output_dir = output_dir
+        self.fleet = fleet
+        self._lock = threading.Lock()
+        self._file = None
+        self._rows = 0  # How many rows are in the fleet file
+        if fleet:
+            self._file = self._open(os.path.join(
+                            output_dir, 'fleet' + self.extension))
+            self._start(self._file)
+
+    def _open(self, path):
+        return open(path, 'w', newline='')
+
+    def write(self, image_scan, name, consumers):
+        """
+        write
+
+        :param image_scan ImageScan: The scanned image
+        :param name str: The image's print tag
+        :param consumers list: Everything that was found using the image
+        :return: The path of the file that was written to
+        """
+        with registry.time('docker_scan_stage_seconds', stage='render'):
+            if self.fleet:
+                # One image at a time, so images don't interleave in the file
+                with self._lock:
+                    self._rows += self._write_image(self._file, image_scan,
+                                                    name, consumers,
+                                                    self._rows == 0)
+                return self._file.name
+            path = os.path.join(self.output_dir,
+                                report_filename(name, self.extension))
+            with self._open(path) as f:
+                self._start(f)
+                self._write_image(f, image_scan, name, consumers, True)
+                self._finish(f)
+            return path
+
+    def close(self):
+        """
+        close
+
+        Finish and close the fleet-wide file, if there is one
+        """
+        if self._file is not None:
+            self._finish(self._file)
+            self._file.close()
+            self._file = None
+
+    def _start(self, f):
+        pass
+
+    def _finish(self, f):
+        pass
+
+    def _write_image(self, f, image_scan, name, consumers, first):
+        """
+        _write_image
+
+        :param f file: The file to write to
+        :param image_scan ImageScan: The scanned image
+        :param name str: The image's print tag
+        :param consumers list: Everything that was found using the image
+        :param first bool: Whether nothing has been written to the file yet
+        :return: How many rows were written
+        """
+        raise NotImplementedError()
+
+
+class TextWriter(ReportWriter):
+    """
+    TextWriter
+
+    Writes the PrettyTable text reports, a table per layer
+    """
+    extension = '.txt'
+
+    def _write_image(self, f, image_scan, name, consumers, first):
+        if self.fleet:
+            f.write('Image: ' + name + '\n\n')
+        rows = 0
+        for chunk in image_scan.iter_report(consumers):
+            f.write(chunk)
+            rows += 1
+        return rows
+
+
+class JSONLinesWriter(ReportWriter):
+    """
+    JSONLinesWriter
+
+    Writes a json object per line, one for each (image, layer, feature,
+    vulnerability)
+    """
+    extension = '.jsonl'
+    # Compact separators make the lines smaller and faster to write
+    encoder = json.JSONEncoder(separators=(',', ':'))
+
+    def _write_image(self, f, image_scan, name, consumers, first):
+        rows = 0
+        for row in image_scan.iter_rows():
+            record = dict(zip(ROW_FIELDS, row))
+            record['image'] = name
+            record['image_id'] = image_scan.image.id
+            record['consumers'] = consumers or []
+            f.write(self.encoder.encode(record) + '\n')
+            rows += 1
+        return rows
+
+
+class CSVWriter(ReportWriter):
+    """
+    CSVWriter
+
+    Writes a csv row for each (image, layer, feature, vulnerability).
+    Consumers are joined with a ';'.
+    """
+    extension = '.csv'
+    headers = ('image', 'image_id', 'consumers') + ROW_FIELDS
+
+    def _start(self, f):
+        csv.writer(f).writerow(self.headers)
+
+    def _write_image(self, f, image_scan, name, consumers, first):
+        prefix = (name, image_scan.image.id, ';'.join(consumers or []))
+        writer = csv.writer(f)
+        rows = 0
+        for row in image_scan.iter_rows():
+            writer.writerow(prefix + row)
+            rows += 1
+        return rows
+
+
+class SARIFWriter(ReportWriter):
+    """
+    SARIFWriter
+
+    Writes a SARIF 2.1.0 log with a result for each (image, layer, feature,
+    vulnerability). The document is written as a stream: the header, then
+    each result as it comes, then the closing brackets.
+    """
+    extension = '.sarif'
+    encoder = json.JSONEncoder(separators=(',', ':'))
+    # SARIF only has three levels
+    levels = {'Unknown': 'error',
+              'High': 'error',
+              'Medium': 'warning',
+              'Low': 'note',
+              'Negligible': 'note'}
+
+    def _start(self, f):
+        header = self.encoder.encode({
+            '$schema': 'https://json.schemastore.org/sarif-2.1.0.json',
+            'version': '2.1.0',
+            'runs': [{'tool': {'driver': {'name': 'clair-multi-image-scanner',
+                                          'informationUri':
+                                              'https://github.com/coreos/clair'
+                                          }},
+                      'results': []}]
+        })
+        # Leave the results array open to stream into
+        f.write(header[:-len(']}]}')])
+
+    def _finish(self, f):
+        f.write(']}]}\n')
+
+    def _write_image(self, f, image_scan, name, consumers, first):
+        rows = 0
+        for row in image_scan.iter_rows():
+            row = dict(zip(ROW_FIELDS, row))
+            result = {
+                'ruleId': row['vulnerability'],
+                'level': self.levels.get(row['severity'], 'warning'),
+                'message': {'text': '{} {} in {} has {} ({})'.format(
+                                row['feature'], row['version'], name,
+                                row['vulnerability'], row['severity'])},
+                'locations': [{'logicalLocations': [{
+                    'name': row['layer'],
+                    'fullyQualifiedName': name + '/' + row['layer'],
+                    'kind': 'module'}]}],
+                'properties': {'image': name,
+                               'imageId': image_scan.image.id,
+                               'consumers': consumers or [],
+                               'feature': row['feature'],
+                               'version': row['version'],
+                               'severity': row['severity'],
+                               'link': row['link'],
+                               'description': row['description']}
+            }
+            if not first or rows > 0:
+                f.write(',')
+            f.write(self.encoder.encode(result))
+            rows += 1
+        return rows
+
+
+class LateConsumersWriter:
+    """
+    LateConsumersWriter
+
+    Reports are written as soon as each image is scanned, while other
+    images are still being resolved, so an image can be found being used by
+    something else after its report was written. This only remembers how
+    many consumers each report listed, not the scans, and at close writes
+    the consumers found after to late-consumers.txt. Called like a report
+    writer.
+    """
+    filename = 'late-consumers.txt'
+
+    def __init__(self, output_dir, images):
+        """
+        __init__
+
+        :param output_dir str: The folder the reports are written to
+        :param images ImageResolver: Where the images come from
+        """
+        self.path = os.path.join(output_dir, self.filename)
+        self.images = images
+        self._lock = threading.Lock()
+        # The reports written {image_id:(image, name, consumers listed)}
+        self._written = {}
+
+    def write(self, image_scan, name, consumers):
+        """
+        write
+
+        :param image_scan ImageScan: The scanned image
+        :param name str: The image's print tag
+        :param consumers list: The consumers its reports listed
+        """
+        with self._lock:
+            self._written[image_scan.image.id] = (image_scan.image, name,
+                                                  len(consumers))
+
+    def close(self):
+        """
+        close
+
+        Write the consumers each report is missing, if any are
+        """
+        late = []
+        with self._lock:
+            for image, name, listed in self._written.values():
+                # Consumers are only ever added to the end
+                consumers = self.images.get_consumers(image)[listed:]
+                if consumers:
+                    late.append((name, consumers))
+        if not late:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        with open(self.path, 'w') as f:
+            f.write('Found using these images after their reports were'
+                    ' written:\n\n')
+            for name, consumers in sorted(late):
+                f.write(name + '\n' +
+                        ''.join('  ' + consumer + '\n'
+                                for consumer in consumers) + '\n')
+
+
+# Writers by the name used for them on the command line
+WRITERS = {'text': TextWriter,
+           'jsonl': JSONLinesWriter,
+           'csv': CSVWriter,
+           'sarif': SARIFWriter}
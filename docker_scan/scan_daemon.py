@@ -0,0 +1,452 @@
+import json
+import time
+import queue
+import logging
+import itertools
+import threading
+from collections import Counter
+from urllib.parse import unquote
+from http.server import BaseHTTPRequestHandler
+
+from fleet_index import FleetIndex
+from http_server import ThreadingHTTPServer
+from image_scan import ImageScan, _Feature, _Vulnerability
+from lru_cache import LRUCache
+from report_writers import ROW_FIELDS
+
+# Lower goes first
+PRIORITY_SUBMITTED = 0  # Asked for through the API
+PRIORITY_NEW = 1  # Found by the source, never scanned
+PRIORITY_RESCAN = 2  # Scanned before, due again
+
+
+class ScanDaemon:
+    """
+    ScanDaemon
+
+    A class to keep scanning in a long running process instead of a run
+    from cron. Images from the source are polled into a priority work queue
+    and scanned by a pool of workers, with the Clair connections and the
+    layer results kept warm between polls. Images are scanned again on a
+    schedule, and the ones with a layer Clair has new vulnerabilities for
+    are when its notifier says so. A small HTTP API takes images to scan
+    and gives back the results.
+    """
+    def __init__(self, clair_obj, writers, list_images, resolve, jobs=1,
+                 poll_interval=300, rescan_interval=86400,
+                 results_in_memory=256, notification_delay=30):
+        """
+        __init__
+
+        :param clair_obj Clair: The clair object to use for the analysis
+        :param writers list: The ReportWriters to write each scan to
+        :param list_images function: Returns the images the source has now,
+            as an ImageSet or ImageResolver
+        :param resolve function: Called with an image reference from the
+            API, returns the image object
+        :param jobs int: How many images to scan at the same time
+        :param poll_interval int: Seconds between asking the source for
+            its images
+        :param rescan_interval int: Seconds before an image is scanned again
+        :param results_in_memory int: How many images' full results the API
+            can give back
+        :param notification_delay int: Seconds to gather Clair's
+            notifications for before acting on them, as an update sends a
+            burst of them
+        """
+        self.clair_obj = clair_obj
+        self.writers = writers
+        self.list_images = list_images
+        self.resolve = resolve
+        self.jobs = jobs
+        self.poll_interval = poll_interval
+        self.rescan_interval = rescan_interval
+        self.notification_delay = notification_delay
+        self._queue = queue.PriorityQueue()
+        self._order = itertools.count()  # Keeps the queue FIFO per priority
+        self._queued = set()  # Image ids and references in the queue
+        # What is known about each image {image_id:{'image', 'name',
+        # 'source', 'consumers', 'layers', 'scanned', 'counts'}}
+        self._images = {}
+        self._scans = LRUCache(results_in_memory)  # {image_id:ImageScan}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._server = None
+        # Notifications from Clair waiting to be acted on, and the timer
+        # that will
+        self._notifications = set()
+        self._notification_timer = None
+
+    def submit(self, image, priority, source=None):
+        """
+        submit
+
+        Queue an image to be scanned, unless it is already queued
+
+        :param image docker.Image: The image, or a reference to resolve
+        :param priority int: One of the PRIORITY_ values
+        :param source ImageSet: Where the image was found, to get its
+            consumers from
+        :return: True if it was queued
+        """
+        key = image if isinstance(image, str) else image.id
+        with self._lock:
+            if key in self._queued:
+                return False
+            self._queued.add(key)
+        self._queue.put((priority, next(self._order), key, image, source))
+        return True
+
+    def rescan_all(self, clair_db_version=None):
+        """
+        rescan_all
+
+        Queue every image that has been scanned, throwing away the kept
+        results first if the Clair DB was updated
+
+        :param clair_db_version str: The new Clair DB version, None if it
+            hasn't changed
+        """
+        if clair_db_version is not None:
+            self.clair_obj.forget_results(clair_db_version)
+            ImageScan.layer_sections.clear()
+            # Only the images scanned from now on use these
+            _Feature._interned.clear()
+            _Vulnerability._interned.clear()
+            for writer in self.writers:
+                # The index only writes each layer's findings once
+                if isinstance(writer, FleetIndex):
+                    writer.reset()
+        with self._lock:
+            images = [(entry['image'], entry['source'])
+                      for entry in self._images.values()]
+        for image, source in images:
+            self.submit(image, PRIORITY_RESCAN, source)
+
+    def notify(self, notification):
+        """
+        notify
+
+        Take a notification from Clair's notifier. It is acted on
+        notification_delay seconds after the first one of a burst, along
+        with the rest of the burst.
+
+        :param notification str: The name of the notification
+        """
+        with self._lock:
+            self._notifications.add(notification)
+            if self._notification_timer is not None:
+                return
+            self._notification_timer = threading.Timer(
+                        self.notification_delay, self._handle_notifications)
+            self._notification_timer.daemon = True
+            self._notification_timer.start()
+
+    def _handle_notifications(self):
+        """
+        _handle_notifications
+
+        Rescan the images with a layer the notifications name, without their
+        kept results. If a notification can't be read, every image is
+        rescanned without the kept results instead.
+        """
+        with self._lock:
+            notifications = self._notifications
+            self._notifications = set()
+            self._notification_timer = None
+        layer_ids = set()
+        for notification in sorted(notifications):
+            try:
+                layers = self.clair_obj.get_notification_layers(notification)
+            except Exception as ex:
+                logging.error('Failed to get notification {}: {}'.format(
+                                notification, ex))
+                layers = None
+            if layers is None:
+                self.rescan_all(str(time.time()))
+                return
+            layer_ids.update(layers)
+        self.rescan_layers(layer_ids)
+
+    def rescan_layers(self, layer_ids):
+        """
+        rescan_layers
+
+        Queue every scanned image with one of the layers, throwing away the
+        kept results of its layers first
+
+        :param layer_ids set: The layers whose vulnerabilities changed
+        """
+        with self._lock:
+            entries = [entry for entry in self._images.values()
+                       if not layer_ids.isdisjoint(entry['layers'])]
+        # In image query mode an image's results are kept under its top
+        # layer, so forget every layer of the images
+        forget = set(layer_ids)
+        for entry in entries:
+            forget.update(entry['layers'])
+        self.clair_obj.forget_layers(forget)
+        for entry in entries:
+            self.submit(entry['image'], PRIORITY_RESCAN, entry['source'])
+
+    def run(self, api_address=None):
+        """
+        run
+
+        Scan until stop is called (or the process is interrupted)
+
+        :param api_address tuple: (host, port) to serve the API on, None for
+            no API
+        """
+        if api_address is not None:
+            self._server = ThreadingHTTPServer(api_address, _ApiHandler)
+            self._server.scan_daemon = self
+            threading.Thread(target=self._server.serve_forever,
+                             daemon=True).start()
+            print('Serving the API on http://{}:{}'.format(
+                        *self._server.server_address[:2]))
+        workers = [threading.Thread(target=self._work, daemon=True)
+                   for _ in range(self.jobs)]
+        for worker in workers:
+            worker.start()
+        poller = None
+        try:
+            while not self._stop.is_set():
+                # A poll can take a while (or never end, for a watch), so it
+                # runs on its own and the next one waits for it
+                if poller is None or not poller.is_alive():
+                    poller = threading.Thread(target=self._poll, daemon=True)
+                    poller.start()
+                self._schedule_rescans()
+                self._stop.wait(self.poll_interval)
+        finally:
+            self._stop.set()
+            # Ahead of everything still queued
+            for _ in workers:
+                self._queue.put((-1, next(self._order), None, None, None))
+            for worker in workers:
+                worker.join()
+            if self._server is not None:
+                self._server.shutdown()
+                self._server.server_close()
+            with self._lock:
+                if self._notification_timer is not None:
+                    self._notification_timer.cancel()
+
+    def stop(self):
+        """
+        stop
+
+        Stop after the scans that are running now
+        """
+        self._stop.set()
+
+    def _poll(self):
+        """
+        _poll
+
+        Queue the images the source has that haven't been scanned, and stop
+        rescanning the ones it doesn't have anymore
+        """
+        try:
+            images = self.list_images()
+            for image in images:
+                with self._lock:
+                    known = image.id in self._images
+                    if known:
+                        self._images[image.id]['source'] = images
+                if not known:
+                    self.submit(image, PRIORITY_NEW, images)
+            with self._lock:
+                # Images from the API have no source and are kept
+                gone = [image_id for image_id, entry in self._images.items()
+                        if entry['source'] not in (None, images)]
+                for image_id in gone:
+                    del self._images[image_id]
+        except Exception as ex:
+            logging.error('Failed to list the images: ' + str(ex))
+
+    def _schedule_rescans(self):
+        """
+        _schedule_rescans
+
+        Queue the images that were last scanned more than rescan_interval
+        ago
+        """
+        due = time.time() - self.rescan_interval
+        with self._lock:
+            images = [(entry['image'], entry['source'])
+                      for entry in self._images.values()
+                      if entry['scanned'] < due]
+        for image, source in images:
+            self.submit(image, PRIORITY_RESCAN, source)
+
+    def _work(self):
+        while True:
+            _, _, key, image, source = self._queue.get()
+            if key is None:
+                return
+            try:
+                if isinstance(image, str):
+                    image = self.resolve(image)
+                self._scan(image, source)
+            except Exception as ex:
+                logging.error('Failed to scan {}: {}'.format(key, ex))
+            finally:
+                with self._lock:
+                    self._queued.discard(key)
+
+    def _scan(self, image, source):
+        """
+        _scan
+
+        Scan an image, write its reports and keep its results
+
+        :param image docker.Image: The image to scan
+        :param source ImageSet: Where the image was found, or None
+        """
+        name = image.tags[0] if image.tags else image.id[:16]
+        print('Starting scan on {}...'.format(name))
+        image_scan = ImageScan(image, self.clair_obj)
+        consumers = source.get_consumers(image) if source is not None else []
+        for writer in self.writers:
+            writer.write(image_scan, name, consumers)
+        self._scans[image.id] = image_scan
+        counts = Counter(row[5] for row in image_scan.iter_rows())
+        layers = [layer_name for layer_name, _
+                  in image_scan.get_vulnerabilites()]
+        with self._lock:
+            self._images[image.id] = {'image': image,
+                                      'name': name,
+                                      'source': source,
+                                      'consumers': consumers,
+                                      'layers': layers,
+                                      'scanned': time.time(),
+                                      'counts': dict(counts)}
+        print('{} done'.format(name))
+
+    def get_status(self):
+        """
+        get_status
+
+        :return: {'queued', 'scanned'} counts
+        """
+        with self._lock:
+            return {'queued': len(self._queued), 'scanned': len(self._images)}
+
+    def get_images(self):
+        """
+        get_images
+
+        :return: A summary of every scanned image, with how many
+            vulnerabilities of each severity it has
+        """
+        with self._lock:
+            return [_summary(image_id, entry)
+                    for image_id, entry in self._images.items()]
+
+    def get_results(self, image):
+        """
+        get_results
+
+        :param image str: The image id or name
+        :return: The summary of the image and its vulnerabilities, or None if
+            it hasn't been scanned. The vulnerabilities are None if they are
+            no longer kept in memory.
+        """
+        with self._lock:
+            for image_id, entry in self._images.items():
+                if image in (image_id, entry['name']):
+                    result = _summary(image_id, entry)
+                    break
+            else:
+                return None
+        image_scan = self._scans.get(result['id'])
+        result['vulnerabilities'] = None
+        if image_scan is not None:
+            result['vulnerabilities'] = [dict(zip(ROW_FIELDS, row))
+                                         for row in image_scan.iter_rows()]
+        return result
+
+
+def _summary(image_id, entry):
+    return {'id': image_id,
+            'name': entry['name'],
+            'consumers': entry['consumers'],
+            'scanned': entry['scanned'],
+            'counts': entry['counts']}
+
+
+class _ApiHandler(BaseHTTPRequestHandler):
+    """
+    _ApiHandler
+
+    The daemon's HTTP API:
+
+        GET  /status             How many images are queued and scanned
+        GET  /images             A summary of every scanned image
+        GET  /images/<id|name>   An image's summary and vulnerabilities
+        POST /images             {"image": reference} to scan it next
+        POST /rescan             Scan every image again
+        POST /notifications      The Clair notifier webhook. The images with
+                                 a layer the notification names are scanned
+                                 again without the kept results, once the
+                                 burst of notifications is over.
+    """
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+    def do_GET(self):
+        daemon = self.server.scan_daemon
+        if self.path == '/status':
+            self._send(200, daemon.get_status())
+        elif self.path == '/images':
+            self._send(200, daemon.get_images())
+        elif self.path.startswith('/images/'):
+            result = daemon.get_results(
+                            unquote(self.path[len('/images/'):]))
+            if result is None:
+                self._send(404, {'error': 'Not scanned'})
+            else:
+                self._send(200, result)
+        else:
+            self._send(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        daemon = self.server.scan_daemon
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+        except ValueError:
+            self._send(400, {'error': 'The body must be json'})
+            return
+        if self.path == '/images':
+            if not isinstance(body.get('image'), str):
+                self._send(400, {'error': 'Give the image to scan as'
+                                          ' {"image": reference}'})
+                return
+            queued = daemon.submit(body['image'], PRIORITY_SUBMITTED)
+            self._send(202, {'queued': queued})
+        elif self.path == '/rescan':
+            daemon.rescan_all()
+            self._send(202, {'queued': True})
+        elif self.path == '/notifications':
+            # {"Notification": {"Name": ...}}, the layers it is about are
+            # read from Clair
+            name = body.get('Notification', {}).get('Name')
+            if not isinstance(name, str):
+                self._send(400, {'error': 'Give the notification as'
+                                          ' {"Notification": {"Name": name}}'})
+                return
+            daemon.notify(name)
+            self._send(200, {})
+        else:
+            self._send(404, {'error': 'Not found'})
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
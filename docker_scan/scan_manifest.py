@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+
+class ScanManifest:
+    """
+    ScanManifest
+
+    A class to remember what the last run found, so an incremental run only
+    scans images that are new or whose results may have changed since (the
+    Clair DB was updated), and can report which vulnerabilities are new and
+    which were resolved.
+
+    The manifest is a json file:
+
+        {
+            image_id: {
+                'name': The image's print tag,
+                'report_hash': sha256 of the image's findings,
+                'clair_db_version': The Clair DB version it was scanned with,
+                'findings': [[layer, feature, version, vulnerability,
+                              severity], ...]
+            }
+        }
+    """
+    def __init__(self, path, delta_path, clair_db_version=None):
+        """
+        __init__
+
+        Load the manifest from the last run, if there is one
+
+        :param path str: Where the manifest is kept
+        :param delta_path str: Where to write what changed since the last run
+        :param clair_db_version str: The Clair DB version for this run
+        """
+        self.path = path
+        self.delta_path = delta_path
+        self.clair_db_version = clair_db_version
+        self.previous = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.previous = json.load(f)
+        self.current = {}  # {image_id:entry} for this run
+        self.new = {}  # {name:[finding]}
+        self.resolved = {}  # {name:[finding]}
+        self._lock = threading.Lock()
+
+    def needs_scan(self, image):
+        """
+        needs_scan
+
+        :param image docker.Image: The image to check
+        :return: True if the image wasn't in the last run or was scanned
+            against a different Clair DB. Otherwise the last run's entry is
+            carried over.
+        """
+        entry = self.previous.get(image.id)
+        if (entry is None or
+                entry['clair_db_version'] != self.clair_db_version):
+            return True
+        with self._lock:
+            self.current[image.id] = entry
+        return False
+
+    def write(self, image_scan, name, consumers):
+        """
+        write
+
+        Store the results of scanning an image and work out what changed.
+        Called like a report writer's write.
+
+        :param image_scan ImageScan: The scanned image
+        :param name str: The image's print tag
+        :param consumers list: Everything that was found using the image
+        """
+        image = image_scan.image
+        findings = image_scan.get_findings()
+        report_hash = hashlib.sha256(json.dumps(
+                            sorted(findings)).encode('utf-8')).hexdigest()
+        old = set(tuple(finding) for finding in
+                  self.previous.get(image.id, {}).get('findings', []))
+        with self._lock:
+            self.current[image.id] = {
+                'name': name,
+                'report_hash': report_hash,
+                'clair_db_version': self.clair_db_version,
+                'findings': sorted(findings)
+            }
+            if findings - old:
+                self.new[name] = sorted(findings - old)
+            if old - findings:
+                self.resolved[name] = sorted(old - findings)
+
+    def close(self):
+        """
+        close
+
+        Save the manifest and write the delta report
+        """
+        self.save()
+        self.write_delta(self.delta_path)
+
+    def save(self):
+        """
+        save
+
+        Write this run's manifest over the last one
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.current, f)
+        os.replace(tmp_path, self.path)
+
+    def write_delta(self, path):
+        """
+        write_delta
+
+        Write what changed since the last run: new and resolved
+        vulnerabilities per image, and images that weren't found this time
+
+        :param path str: Where to write the delta report
+        """
+        removed = sorted(entry['name'] for image_id, entry in
+                         self.previous.items() if image_id not in self.current)
+        with open(path, 'w') as f:
+            f.write('Run: ' + time.strftime('%Y-%m-%d %H:%M:%S') + '\n\n')
+            for title, changes in (('New vulnerabilities', self.new),
+                                   ('Resolved vulnerabilities',
+                                    self.resolved)):
+                f.write(title + ':\n')
+                if not changes:
+                    f.write('  None\n')
+                for name in sorted(changes):
+                    f.write('  ' + name + '\n')
+                    for layer, feature, version, vuln, severity in \
+                            changes[name]:
+                        f.write('    {} {} {} ({}) in layer {}\n'.format(
+                                    feature, version, vuln, severity, layer))
+                f.write('\n')
+            f.write('Images no longer found:\n')
+            if not removed:
+                f.write('  None\n')
+            for name in removed:
+                f.write('  ' + name + '\n')
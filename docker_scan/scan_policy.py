@@ -0,0 +1,115 @@
+import threading
+
+from image_scan import _Vulnerability
+from metrics import registry
+
+
+class ScanPolicy:
+    """
+    ScanPolicy
+
+    A class to gate a run (e.g. in CI) on the vulnerabilities found. An
+    image fails the policy if it has a vulnerability at or above the
+    severity threshold that isn't in the allowlist. Severities are ranked by
+    _Vulnerability.sev_vals, so Unknown counts as worse than High.
+
+    With fail_fast, the first image to fail stops the run: stopped is set,
+    so nothing else is scheduled and only the reports of failing images are
+    written.
+    """
+    # What the run exits with when an image fails, so it can be told apart
+    # from bad args (2) or a run that couldn't scan (1)
+    exit_code = 3
+
+    def __init__(self, fail_on, allowed=(), fail_fast=False):
+        """
+        __init__
+
+        :param fail_on str: The lowest severity that fails an image
+            (a key of _Vulnerability.sev_vals)
+        :param allowed iterable: The vulnerabilities (e.g. CVE-2018-1000001)
+            that never fail an image
+        :param fail_fast bool: Stop the run as soon as an image fails
+        """
+        self.fail_on = fail_on
+        self.threshold = _Vulnerability.sev_vals[fail_on]
+        self.allowed = frozenset(allowed)
+        self.fail_fast = fail_fast
+        self.stopped = threading.Event()
+        self.checked = 0
+        self.failures = {}  # {name:[finding]}
+        self._lock = threading.Lock()
+
+    def check(self, name, findings):
+        """
+        check
+
+        :param name str: The image's print tag
+        :param findings iterable: (layer, feature, version, vulnerability,
+            severity) tuples, like ImageScan.get_findings gives
+        :return: True if the image passes the policy
+        """
+        violations = sorted(
+                finding for finding in findings
+                if finding[3] not in self.allowed and
+                _Vulnerability.sev_vals.get(finding[4], 0) >= self.threshold)
+        with self._lock:
+            self.checked += 1
+            if violations:
+                self.failures[name] = violations
+        if not violations:
+            return True
+        registry.inc('docker_scan_policy_failures_total')
+        print('{} fails the policy with {} {} or worse'
+              ' vulnerabilities'.format(name, len(violations), self.fail_on))
+        if self.fail_fast:
+            self.stopped.set()
+        return False
+
+    @property
+    def failed(self):
+        """
+        :return: True if any image has failed the policy
+        """
+        return bool(self.failures)
+
+    def print_summary(self):
+        """
+        print_summary
+
+        Print every vulnerability that failed the policy, by image
+        """
+        if not self.failed:
+            print('Policy passed: no {} or worse vulnerabilities in {}'
+                  ' images'.format(self.fail_on, self.checked))
+            return
+        print('Policy failed: {} of {} images have {} or worse'
+              ' vulnerabilities'.format(len(self.failures), self.checked,
+                                        self.fail_on))
+        if self.stopped.is_set():
+            print('Stopped at the first failure, the other images were not'
+                  ' checked')
+        for name in sorted(self.failures):
+            print('  ' + name)
+            for layer, feature, version, vulnerability, severity in \
+                    self.failures[name]:
+                print('    {} ({}) in {} {}, layer {}'.format(
+                            vulnerability, severity, feature, version,
+                            layer[:16]))
+
+
+def read_allowlist(path):
+    """
+    read_allowlist
+
+    :param path str: A file with a vulnerability per line. Anything after a
+        # is a comment.
+    :return: The set of vulnerabilities in the file
+    """
+    allowed = set()
+    with open(path, 'r') as f:
+        for line in f:
+            vulnerability = line.split('#', 1)[0].strip()
+            if vulnerability:
+                allowed.add(vulnerability)
+    return allowed
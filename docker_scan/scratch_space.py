@@ -0,0 +1,248 @@
+import os
+import sys
+import time
+import atexit
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+
+from metrics import registry
+
+
+class ScratchSpace:
+    """
+    ScratchSpace
+
+    A class to manage the disk the exported layers are written to. Every
+    export gets its own folder under one folder for the process, which is
+    removed when the process exits, and folders left by processes that were
+    killed are removed on start. Each layer file is deleted as soon as
+    Clair has read it, instead of when the whole image is done.
+
+    With a quota, an export waits to start until the layers on disk (plus
+    what the exports already running are expected to write) leave room for
+    the image, so running many scans at once can't fill the disk. The
+    scratch folder can be a tmpfs (e.g. /dev/shm) to keep small images off
+    the disk entirely.
+    """
+    prefix = 'docker-scan-'
+
+    def __init__(self, root=None, quota=None):
+        """
+        __init__
+
+        :param root str: The folder to make the scratch folder in. Defaults
+            to the system's tmp folder.
+        :param quota int: How many bytes of layers can be on disk at once,
+            None for no limit
+        """
+        root = root or tempfile.gettempdir()
+        os.makedirs(root, exist_ok=True)
+        _remove_abandoned(root, self.prefix)
+        self.quota = quota
+        self.path = tempfile.mkdtemp(prefix='{}{}-'.format(self.prefix,
+                                                           _owner()),
+                                     dir=root)
+        self._used = 0  # Bytes of layers on disk
+        self._reserved = 0  # Bytes the running exports are expected to add
+        self._condition = threading.Condition()
+        atexit.register(self.close)
+
+    def export(self, estimate=0):
+        """
+        export
+
+        Wait until there is room for an export, then make its folder
+
+        :param estimate int: How many bytes the export is expected to write
+            (e.g. the size of the image)
+        :return: A ScratchDir to write the layers to, to close when the
+            export is done
+        """
+        start = time.monotonic()
+        with self._condition:
+            if self.quota is not None:
+                # An export bigger than the quota runs on its own
+                self._condition.wait_for(
+                    lambda: (self._used + self._reserved + estimate <=
+                             self.quota or
+                             self._used + self._reserved == 0))
+            self._reserved += estimate
+        registry.observe('docker_scan_scratch_wait_seconds',
+                         time.monotonic() - start)
+        try:
+            path = tempfile.mkdtemp(suffix='-image-archive', dir=self.path)
+        except OSError:
+            self._free(0, estimate)
+            raise
+        return ScratchDir(self, path, estimate)
+
+    def _add(self, size, reservation):
+        """
+        _add
+
+        :param size int: The bytes written
+        :param reservation int: How much of the export's reservation they
+            used up
+        """
+        with self._condition:
+            self._used += size
+            self._reserved -= reservation
+
+    def _free(self, size, reservation):
+        """
+        _free
+
+        :param size int: The bytes removed
+        :param reservation int: The reservation given back
+        """
+        with self._condition:
+            self._used -= size
+            self._reserved -= reservation
+            self._condition.notify_all()
+
+    def close(self):
+        """
+        close
+
+        Remove the scratch folder and everything in it
+        """
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class ScratchDir:
+    """
+    ScratchDir
+
+    The folder of one export, keeping count of the layer files in it
+    """
+    def __init__(self, scratch_space, path, estimate):
+        """
+        __init__
+
+        :param scratch_space ScratchSpace: The space it is in
+        :param path str: The folder
+        :param estimate int: How many bytes were reserved for it
+        """
+        self.scratch_space = scratch_space
+        self.path = path
+        self._reserved = estimate
+        self._files = {}  # {path:size}
+        self._lock = threading.Lock()
+
+    def add(self, path, size):
+        """
+        add
+
+        Count a file that is about to be written
+
+        :param path str: The file, in this folder
+        :param size int: How big it will be
+        """
+        with self._lock:
+            self._files[path] = size
+            reservation = min(size, self._reserved)
+            self._reserved -= reservation
+        self.scratch_space._add(size, reservation)
+
+    def done_writing(self):
+        """
+        done_writing
+
+        Give back what is left of the reservation once every layer has been
+        written (layers Clair already had aren't), so other exports can
+        start
+        """
+        with self._lock:
+            reservation = self._reserved
+            self._reserved = 0
+        self.scratch_space._free(0, reservation)
+
+    def release(self, path):
+        """
+        release
+
+        Delete a file once nothing needs it anymore. It is fine to release a
+        file more than once, or one that was never written.
+
+        :param path str: The file
+        """
+        with self._lock:
+            size = self._files.pop(path, None)
+        if size is None:
+            return
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        self.scratch_space._free(size, 0)
+
+    def close(self):
+        """
+        close
+
+        Remove the folder and give back its space
+        """
+        shutil.rmtree(self.path, ignore_errors=True)
+        with self._lock:
+            size = sum(self._files.values())
+            reservation = self._reserved
+            self._files = {}
+            self._reserved = 0
+        self.scratch_space._free(size, reservation)
+
+
+def _owner():
+    """
+    _owner
+
+    :return: pid@hostname of this process. The tmp folder may be shared
+        with other machines or containers (which reuse pids), so the pid
+        alone doesn't say whose a folder is.
+    """
+    return '{}@{}'.format(os.getpid(), socket.gethostname())
+
+
+def _remove_abandoned(root, prefix):
+    """
+    _remove_abandoned
+
+    Remove the scratch folders of processes on this host that are no longer
+    running
+
+    :param root str: The folder the scratch folders are made in
+    :param prefix str: How the scratch folders are named
+    """
+    hostname = socket.gethostname()
+    for name in os.listdir(root):
+        if not name.startswith(prefix):
+            continue
+        # The random part of the name never has a -
+        owner = name[len(prefix):].rpartition('-')[0]
+        pid, _, host = owner.partition('@')
+        if host != hostname or not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+        except OSError:
+            # Someone else's process, still running
+            pass
+
+
+def exit_on_signals():
+    """
+    exit_on_signals
+
+    Exit normally on SIGTERM and SIGHUP, so the finally blocks and atexit
+    handlers (which remove the scratch folder) run like they do for a
+    Ctrl-C. Must be called from the main thread.
+    """
+    def handler(signum, frame):
+        sys.exit(128 + signum)
+    for signum in (signal.SIGTERM, getattr(signal, 'SIGHUP', None)):
+        if signum is not None:
+            signal.signal(signum, handler)
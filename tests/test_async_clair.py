@@ -0,0 +1,52 @@
+"""
+Cancel a call to Clair that another image is waiting on, and check the
+waiting image is let go of instead of hanging. From Python 3.8 on the
+CancelledError isn't an Exception.
+"""
+import os
+import sys
+import asyncio
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'docker_scan'))
+
+from async_clair import AsyncClair  # noqa: E402
+
+
+class AsyncClairTest(unittest.TestCase):
+    def setUp(self):
+        self.clair = AsyncClair({'clair.host': 'http://clair.invalid'}, None)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.clair.shutdown()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_cancelled_call_lets_waiters_go(self):
+        started = asyncio.Event()
+
+        async def call():
+            started.set()
+            await asyncio.sleep(60)
+
+        async def run():
+            first = asyncio.ensure_future(
+                        self.clair._once(('GET', 'layer'), call))
+            await started.wait()
+            waiter = asyncio.ensure_future(
+                        self.clair._once(('GET', 'layer'), call))
+            # Let it start waiting on the first call
+            await asyncio.sleep(0)
+            first.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await asyncio.wait_for(waiter, 5)
+            self.assertEqual(self.clair._in_flight, {})
+
+        self.loop.run_until_complete(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+"""
+Two images share a base layer that added openssl 1.0, which has CVE-OLD.
+Image A upgrades openssl in its top layer, image B doesn't. In image query
+mode the base layer's features come from each image's top layer, so B must
+report CVE-OLD in its base layer whatever was scanned before it, in this
+run or an earlier one through the layer cache.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'docker_scan'))
+
+from clair import Clair  # noqa: E402
+from fleet_index import FleetIndex  # noqa: E402
+from image_scan import ImageScan  # noqa: E402
+from layer_cache import LayerCache  # noqa: E402
+
+OLD = {'Name': 'CVE-OLD', 'NamespaceName': 'debian:9', 'Severity': 'High',
+       'Link': 'https://example.com/CVE-OLD', 'Description': 'old openssl'}
+
+
+def make_response(top, features):
+    """
+    make_response
+
+    :param top str: The top layer of the image
+    :param features list: (name, version, added by, vulnerabilities)
+    :return: Clair's response for the top layer
+    """
+    return {'Layer': {'Name': top, 'ParentName': 'base',
+                      'Features': [{'Name': name, 'Version': version,
+                                    'VersionFormat': 'dpkg',
+                                    'AddedBy': added_by,
+                                    'Vulnerabilities': vulns}
+                                   for name, version, added_by, vulns
+                                   in features]}}
+
+
+RESPONSES = {
+    # A upgraded openssl, so Clair says its top layer added 1.1
+    'a-top': make_response('a-top', [('openssl', '1.1', 'a-top', [])]),
+    'b-top': make_response('b-top', [('openssl', '1.0', 'base', [OLD])]),
+}
+
+
+class ImageQueryModeTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.fetched = []
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def make_clair(self):
+        """
+        make_clair
+
+        :return: A Clair in image query mode with a layer cache, answering
+            GETs from RESPONSES
+        """
+        clair = Clair({'clair.host': 'http://clair.invalid'}, None,
+                      LayerCache(self.cache_dir))
+
+        def get_layer_vulnerabilities(layer_id):
+            self.fetched.append(layer_id)
+            return RESPONSES.get(layer_id)
+        clair.get_layer_vulnerabilities = get_layer_vulnerabilities
+        return clair
+
+    def scan(self, clair, top):
+        image = SimpleNamespace(id='image-' + top)
+        return ImageScan(image, None, clair.get_layers_vulnerabilities(
+                                        ['base', top]))
+
+    def test_shared_base_isnt_reused_from_another_image(self):
+        clair = self.make_clair()
+        a = self.scan(clair, 'a-top')
+        b = self.scan(clair, 'b-top')
+        self.assertEqual(a.get_findings(), set())
+        self.assertEqual(b.get_findings(),
+                         {('base', 'openssl', '1.0', 'CVE-OLD', 'High')})
+        # Rendered with its own features, not A's section for the base
+        self.assertIn('CVE-OLD', ''.join(b.iter_report()))
+        self.assertNotIn('CVE-OLD', ''.join(a.iter_report()))
+        self.assertEqual(self.fetched, ['a-top', 'b-top'])
+
+    def test_shared_base_isnt_reused_from_the_layer_cache(self):
+        self.scan(self.make_clair(), 'a-top')
+        b = self.scan(self.make_clair(), 'b-top')
+        self.assertEqual(b.get_findings(),
+                         {('base', 'openssl', '1.0', 'CVE-OLD', 'High')})
+        # Each top layer is fetched once, the second run only needed B's
+        self.fetched = []
+        self.scan(self.make_clair(), 'b-top')
+        self.assertEqual(self.fetched, [])
+
+    def test_fleet_index_keeps_each_images_findings(self):
+        clair = self.make_clair()
+        index = FleetIndex(os.path.join(self.cache_dir, 'fleet.sqlite'),
+                           os.path.join(self.cache_dir, 'summary.txt'))
+        index.write(self.scan(clair, 'a-top'), 'a', [])
+        index.write(self.scan(clair, 'b-top'), 'b', [])
+        self.assertEqual(index.get_affected_images('CVE-OLD'),
+                         [('b', 'base', 'openssl', '1.0')])
+        index.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+"""
+Feed the pod watch the events the kubernetes client sends and check that
+an expired resourceVersion, which comes as an ERROR event with a 410
+Status rather than as an ApiException, lists the pods again and watches on
+from the new list.
+"""
+import os
+import sys
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'docker_scan'))
+
+import kubernetes_helper  # noqa: E402
+from kubernetes_helper import KubernetesHelper  # noqa: E402
+
+
+class StopWatching(Exception):
+    pass
+
+
+class Resolver:
+    def __init__(self):
+        self.added = []  # [(reference, consumer)]
+
+    def add(self, reference, consumer):
+        self.added.append((reference, consumer))
+
+
+def make_pod(name, resource_version):
+    """
+    make_pod
+
+    :param name str: The pod's name
+    :param resource_version str: The pod's resourceVersion
+    :return: Something shaped like a V1Pod with one container
+    """
+    container = SimpleNamespace(name='app', image=name + ':latest',
+                                image_id=None)
+    return SimpleNamespace(
+        metadata=SimpleNamespace(namespace='default', name=name,
+                                 resource_version=resource_version),
+        status=SimpleNamespace(container_statuses=[container]))
+
+
+def make_event(event_type, pod):
+    return {'type': event_type, 'object': pod, 'raw_object': {}}
+
+
+def make_error(code):
+    """
+    make_error
+
+    An ERROR event as Watch.stream gives it: the Status only makes sense as
+    raw_object, object is the Status read as a pod
+
+    :param code int: The Status code
+    :return: The event
+    """
+    status = {'kind': 'Status', 'status': 'Failure', 'code': code,
+              'reason': 'Expired', 'message': 'too old resource version'}
+    return {'type': 'ERROR', 'raw_object': status,
+            'object': SimpleNamespace(metadata=SimpleNamespace(
+                                        resource_version=None))}
+
+
+class WatchPodImagesTest(unittest.TestCase):
+    def setUp(self):
+        self.helper = KubernetesHelper.__new__(KubernetesHelper)
+        self.helper.context = None
+        self.helper.v1 = mock.Mock()
+        self.helper.v1.list_pod_for_all_namespaces.return_value = \
+            SimpleNamespace(items=[make_pod('listed', '20')],
+                            metadata=SimpleNamespace(_continue=None,
+                                                     resource_version='20'))
+        self.resolver = Resolver()
+
+    def watch(self, *streams):
+        """
+        watch
+
+        :param streams list: The events each Watch.stream call gives, the
+            call after the last stops the watch
+        :return: The resource_version each stream was started from
+        """
+        stream = mock.Mock(side_effect=[iter(events) for events in streams] +
+                           [StopWatching()])
+        with mock.patch.object(kubernetes_helper, 'watch') as watch:
+            watch.Watch.return_value.stream = stream
+            with self.assertRaises(StopWatching):
+                self.helper.watch_pod_images(self.resolver, '10')
+        return [call[1]['resource_version'] for call in stream.call_args_list]
+
+    def test_expired_resource_version_relists(self):
+        started = self.watch([make_event('ADDED', make_pod('first', '11')),
+                              make_error(410)],
+                             [make_event('ADDED', make_pod('after', '21'))])
+        self.assertEqual(started, ['10', '20', '21'])
+        self.assertEqual(self.resolver.added,
+                         [('first:latest', 'default/first/app'),
+                          ('listed:latest', 'default/listed/app'),
+                          ('after:latest', 'default/after/app')])
+        self.helper.v1.list_pod_for_all_namespaces.assert_called_once_with(
+                watch=False, limit=500)
+
+    def test_other_errors_are_raised(self):
+        with self.assertRaises(kubernetes_helper.ApiException) as ctx:
+            self.watch([make_error(500)])
+        self.assertEqual(ctx.exception.status, 500)
+        self.helper.v1.list_pod_for_all_namespaces.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+"""
+Scan an image into the layer cache, then reset Clair (a new stub Clair,
+like clair-runner's postgres being recreated) and scan an image built on
+top of it. The cached layers aren't in Clair anymore, so they have to be
+sent again, or the new layer can't be: Clair refuses a layer whose parent
+it doesn't have.
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import urllib.request
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'docker_scan'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from clair import Clair  # noqa: E402
+from image_scan import ImageScan  # noqa: E402
+from layer_cache import LayerCache  # noqa: E402
+from stub_clair import StubClair  # noqa: E402
+from synthetic_images import SyntheticImage  # noqa: E402
+
+BASE = ['base-0', 'base-1', 'app']
+
+
+class LayerCacheResetTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.stubs = []
+
+    def tearDown(self):
+        for stub in self.stubs:
+            stub.close()
+        shutil.rmtree(self.cache_dir)
+
+    def run_scan(self, stub, layer_names):
+        """
+        run_scan
+
+        Scan an image the way a run of main does, with the layer cache
+
+        :param stub StubClair: The Clair to scan with
+        :param layer_names list: The image's layers
+        :return: The ImageScan
+        """
+        layer_cache = LayerCache(self.cache_dir)
+        clair = Clair({'clair.host': stub.url}, None, layer_cache)
+        try:
+            clair.check_layer_cache()
+            return ImageScan(SyntheticImage('test/app:latest', layer_names,
+                                            1024), clair)
+        finally:
+            layer_cache.close()
+
+    def start_stub(self):
+        stub = StubClair(features=2, vulnerabilities=1)
+        stub.start()
+        self.stubs.append(stub)
+        return stub
+
+    def get_stats(self, stub):
+        with urllib.request.urlopen(stub.url + '/stats') as r:
+            return json.loads(r.read().decode('utf-8'))
+
+    def test_same_clair_keeps_the_cache(self):
+        stub = self.start_stub()
+        self.run_scan(stub, BASE)
+        posts = self.get_stats(stub)['POST /v1/layers']
+        self.run_scan(stub, BASE)
+        stats = self.get_stats(stub)
+        # Every layer's result was still cached
+        self.assertEqual(stats['POST /v1/layers'], posts)
+        self.assertEqual(stats['failed'], 0)
+
+    def test_reset_clair_gets_every_layer_again(self):
+        self.run_scan(self.start_stub(), BASE)
+        stub = self.start_stub()
+        image_scan = self.run_scan(stub, BASE + ['new'])
+        stats = self.get_stats(stub)
+        # Only the check for the cached layer failed
+        self.assertEqual(stats['failed'], 1)
+        self.assertEqual(stats['POST /v1/layers'], len(BASE) + 1)
+        self.assertEqual(len(image_scan.get_vulnerabilites()), len(BASE) + 1)
+
+if __name__ == '__main__':
+    unittest.main()
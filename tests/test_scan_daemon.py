@@ -0,0 +1,82 @@
+"""
+Send the daemon a burst of Clair notifications naming a layer only one of
+its images has, and check that the burst is read in one go and only that
+image is scanned again, without its kept results. Also ask the API for an
+image by a name that has to be URL-encoded.
+"""
+import os
+import sys
+import json
+import time
+import threading
+import unittest
+import urllib.request
+from urllib.parse import quote
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'docker_scan'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from clair import Clair  # noqa: E402
+from http_server import ThreadingHTTPServer  # noqa: E402
+from scan_daemon import ScanDaemon, _ApiHandler  # noqa: E402
+from stub_clair import StubClair  # noqa: E402
+from synthetic_images import SyntheticImage  # noqa: E402
+
+
+class ScanDaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubClair(features=2, vulnerabilities=1)
+        self.stub.start()
+        self.clair = Clair({'clair.host': self.stub.url}, None)
+        self.notifications = []  # Read from Clair, in order
+        self.daemon = ScanDaemon(self.clair, [], list, None,
+                                 notification_delay=0.2)
+        self.images = {name: SyntheticImage('test/' + name + ':latest',
+                                            ['base', name], 1024)
+                       for name in ('a', 'b')}
+        for image in self.images.values():
+            self.daemon._scan(image, None)
+
+    def tearDown(self):
+        self.clair.shutdown()
+        self.stub.close()
+
+    def get_layers(self, name):
+        return self.daemon._images[self.images[name].id]['layers']
+
+    def test_notifications_rescan_the_images_with_the_layers(self):
+        a_top = self.get_layers('a')[-1]
+        b_top = self.get_layers('b')[-1]
+
+        def get_notification_layers(notification):
+            self.notifications.append(notification)
+            return {a_top} if notification == 'n1' else set()
+        self.clair.get_notification_layers = get_notification_layers
+        self.daemon.notify('n1')
+        self.daemon.notify('n2')
+        self.daemon.notify('n1')
+        time.sleep(0.6)
+        self.assertEqual(self.notifications, ['n1', 'n2'])
+        self.assertEqual(self.daemon._queued, {self.images['a'].id})
+        self.assertNotIn(a_top, self.clair.already_analysed)
+        self.assertIn(b_top, self.clair.already_analysed)
+
+    def test_get_image_by_encoded_name(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), _ApiHandler)
+        server.scan_daemon = self.daemon
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            url = 'http://127.0.0.1:{}/images/{}'.format(
+                        server.server_address[1],
+                        quote('test/a:latest', safe=''))
+            with urllib.request.urlopen(url) as r:
+                result = json.loads(r.read().decode('utf-8'))
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(result['id'], self.images['a'].id)
+
+
+if __name__ == '__main__':
+    unittest.main()
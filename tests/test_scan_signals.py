@@ -0,0 +1,118 @@
+"""
+Stop a scan with SIGTERM part way through and check that it stops soon
+after, instead of scanning every queued image first, and that the scratch
+space is cleaned up. The scan runs in a child process (this file run as a
+script) against the benchmark's stub Clair and synthetic images.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import tempfile
+import unittest
+import subprocess
+import urllib.request
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'docker_scan'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from stub_clair import StubClair  # noqa: E402
+
+IMAGES = 60
+
+
+def scan(url, scratch_root, engine):
+    """
+    scan
+
+    Scan the synthetic fleet like main does, in the child process
+
+    :param url str: The stub Clair
+    :param scratch_root str: Where to make the scratch space
+    :param engine str: threads or asyncio
+    """
+    import main
+    from clair import Clair
+    from image_set import ImageSet
+    from scratch_space import ScratchSpace, exit_on_signals
+    from synthetic_images import make_fleet
+
+    exit_on_signals()
+    scratch_space = ScratchSpace(scratch_root)
+    cfg = {'clair.host': url, 'clair.pool_size': 4, 'clair.concurrency': 4}
+    images = ImageSet()
+    for image in make_fleet(IMAGES, layer_size=16 * 1024):
+        images.add(image)
+    try:
+        if engine == 'asyncio':
+            from async_clair import AsyncClair
+            clair_obj = AsyncClair(cfg, None, scratch_space=scratch_space)
+            main.scan_images_async(images, clair_obj, [], 2)
+        else:
+            clair_obj = Clair(cfg, None, scratch_space=scratch_space)
+            main.scan_images(images, clair_obj, [], 2)
+    finally:
+        scratch_space.close()
+
+
+class ScanSignalTest(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubClair(post_latency=0.1)
+        self.stub.start()
+        self.scratch_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.stub.close()
+        shutil.rmtree(self.scratch_root)
+
+    def get_posts(self):
+        with urllib.request.urlopen(self.stub.url + '/stats') as r:
+            return json.loads(r.read().decode('utf-8'))['POST /v1/layers']
+
+    def test_sigterm_stops_the_scan(self):
+        self.check_sigterm('threads')
+
+    def test_sigterm_stops_the_async_scan(self):
+        self.check_sigterm('asyncio')
+
+    def check_sigterm(self, engine):
+        """
+        check_sigterm
+
+        :param engine str: The engine to run the scan with
+        """
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                  self.stub.url, self.scratch_root, engine],
+                                 stdout=subprocess.DEVNULL)
+        try:
+            deadline = time.monotonic() + 30
+            while self.get_posts() < 5:
+                self.assertLess(time.monotonic(), deadline)
+                self.assertIsNone(child.poll())
+                time.sleep(0.05)
+            child.send_signal(signal.SIGTERM)
+            start = time.monotonic()
+            returncode = child.wait(timeout=30)
+        finally:
+            if child.poll() is None:
+                child.kill()
+                child.wait()
+        self.assertEqual(returncode, 128 + signal.SIGTERM)
+        # Only the calls in flight finish, not the rest of the fleet
+        self.assertLess(time.monotonic() - start, 5)
+        posts = self.get_posts()
+        time.sleep(0.5)
+        self.assertEqual(self.get_posts(), posts)
+        self.assertLess(posts, IMAGES)
+        self.assertEqual([name for name in os.listdir(self.scratch_root)
+                          if name.startswith('docker-scan-')], [])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4:
+        scan(*sys.argv[1:])
+    else:
+        unittest.main()